@@ -2,6 +2,9 @@ import requests
 import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,12 +19,71 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def iter_users(filepath, chunk_size=1 << 16):
+    """Потоково читает пользователей из JSON-массива или JSONL, не загружая файл целиком."""
+    decoder = json.JSONDecoder()
+    with open(filepath, "r", encoding="utf-8") as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            # JSONL: один пользователь на строку
+            f.seek(0)
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+            return
+
+        buffer = buffer[1:]
+        eof = False
+        while True:
+            buffer = buffer.lstrip().lstrip(",").lstrip()
+            if buffer.startswith("]"):
+                return
+            try:
+                user, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer += chunk
+                continue
+            yield user
+            buffer = buffer[end:]
+            if len(buffer) < chunk_size and not eof:
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer += chunk
+
+
+class RateLimiter:
+    """Ограничивает частоту запросов (token bucket) и общую паузу после 429."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+
 class RocketChatUserManager:
     def __init__(self):
         self.url = ROCKETCHAT_URL.rstrip("/")
         self.headers = {
             "Content-Type": "application/json",
         }
+        self.session = requests.Session()
         self._login()
 
     def _login(self):
@@ -116,21 +178,184 @@ class RocketChatUserManager:
 
         return results
 
+    def _request(self, method, endpoint, limiter, retries=5, **kwargs):
+        """Запрос к REST API с учётом лимита частоты и повтором после 429."""
+        for _ in range(retries):
+            limiter.acquire()
+            resp = self.session.request(
+                method,
+                f"{self.url}/api/v1/{endpoint}",
+                headers=self.headers,
+                timeout=30,
+                **kwargs,
+            )
+            if resp.status_code != 429:
+                return resp.json()
+
+            delay = float(resp.headers.get("Retry-After", 0) or 0)
+            reset = resp.headers.get("X-RateLimit-Reset")
+            if not delay and reset:
+                delay = max(0.0, int(reset) / 1000 - time.time())
+            logger.warning(f"429 на {endpoint}, пауза {delay or 1:.1f} с")
+            limiter.pause(delay or 1)
+        return resp.json()
+
+    def prefetch_existing(self, limiter, page_size=1000):
+        """Загружает все существующие username и email постранично одним проходом."""
+        usernames, emails = set(), set()
+        offset = 0
+        while True:
+            data = self._request(
+                "GET",
+                "users.list",
+                limiter,
+                params={
+                    "count": page_size,
+                    "offset": offset,
+                    "fields": json.dumps({"username": 1, "emails": 1}),
+                },
+            )
+            users = data.get("users", [])
+            for user in users:
+                if user.get("username"):
+                    usernames.add(user["username"].lower())
+                for email in user.get("emails") or []:
+                    if email.get("address"):
+                        emails.add(email["address"].lower())
+            offset += len(users)
+            if not users or offset >= data.get("total", 0):
+                break
+        logger.info(f"Загружено существующих пользователей: {len(usernames)}")
+        return usernames, emails
+
+    def create_users_bulk(self, filepath, workers=8, rate=10.0, checkpoint=None):
+        """
+        Массовое создание пользователей: один предварительный проход по users.list,
+        потоковое чтение файла, ограниченный пул потоков и контрольная точка
+        для продолжения прерванного запуска.
+        """
+        checkpoint = checkpoint or f"{filepath}.checkpoint"
+        done = set()
+        if os.path.exists(checkpoint):
+            with open(checkpoint, "r", encoding="utf-8") as f:
+                entries = [json.loads(line) for line in f if line.strip()]
+            # Неудачные попытки (таймауты, 5xx) повторяются при следующем запуске
+            done = {
+                entry["username"]
+                for entry in entries
+                if entry.get("status") in ("created", "skipped")
+            }
+            logger.info(f"Продолжение с контрольной точки: {len(done)} уже обработано")
+
+        self.session.mount(
+            self.url,
+            requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers),
+        )
+        limiter = RateLimiter(rate)
+        usernames, emails = self.prefetch_existing(limiter)
+
+        results = {"created": [], "skipped": [], "failed": []}
+        lock = threading.Lock()
+        checkpoint_file = open(checkpoint, "a", encoding="utf-8")
+        started = time.monotonic()
+
+        def record(status, entry):
+            with lock:
+                results[status].append(entry)
+                checkpoint_file.write(
+                    json.dumps({"username": entry["username"], "status": status}) + "\n"
+                )
+                checkpoint_file.flush()
+                processed = sum(len(items) for items in results.values())
+                if processed % 500 == 0:
+                    rate_now = processed / (time.monotonic() - started)
+                    logger.info(f"Обработано: {processed} ({rate_now:.1f} польз./с)")
+
+        def provision(user):
+            username = user.get("username")
+            try:
+                result = self._request(
+                    "POST",
+                    "users.create",
+                    limiter,
+                    json={
+                        "username": username,
+                        "email": user.get("email"),
+                        "name": user.get("name", username),
+                        "password": user.get("password", "ChangeMe123!"),
+                        "joinDefaultChannels": False,
+                        **({"roles": user["roles"]} if user.get("roles") else {}),
+                    },
+                )
+                if result.get("user"):
+                    record("created", {"username": username, "email": user.get("email")})
+                else:
+                    logger.error(f"Ошибка создания {username}: {result}")
+                    record("failed", {"username": username, "error": result.get("error")})
+            except Exception as e:
+                logger.error(f"Ошибка: {username} - {e}")
+                record("failed", {"username": username, "error": str(e)})
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = set()
+                for user in iter_users(filepath):
+                    username = user.get("username")
+                    if not isinstance(username, str) or not username.strip():
+                        record("failed", {"username": username, "error": "не указан username"})
+                        continue
+                    if username in done:
+                        continue
+                    email = (user.get("email") or "").lower()
+                    # Проверка по индексу в памяти; резервируем имя, чтобы дубликаты в файле не создавались дважды
+                    if username.lower() in usernames or (email and email in emails):
+                        record("skipped", {"username": username, "email": user.get("email")})
+                        continue
+                    usernames.add(username.lower())
+                    if email:
+                        emails.add(email)
+
+                    pending.add(pool.submit(provision, user))
+                    if len(pending) >= workers * 4:
+                        _, pending = wait(pending, return_when=FIRST_COMPLETED)
+        finally:
+            checkpoint_file.close()
+
+        elapsed = time.monotonic() - started
+        processed = sum(len(items) for items in results.values())
+        results["elapsed"] = elapsed
+        results["throughput"] = processed / elapsed if elapsed else 0.0
+        return results
+
 
 if __name__ == "__main__":
+    import argparse
     import sys
 
-    if len(sys.argv) < 2:
-        print("Использование: python create_users.py <файл_с_пользователями.json>")
+    parser = argparse.ArgumentParser(description="Создание пользователей Rocket.Chat")
+    parser.add_argument("file", help="JSON-массив или JSONL с пользователями")
+    parser.add_argument("--bulk", action="store_true", help="массовый режим")
+    parser.add_argument("--workers", type=int, default=8, help="параллельных запросов")
+    parser.add_argument("--rate", type=float, default=10.0, help="запросов в секунду")
+    parser.add_argument("--checkpoint", help="файл контрольной точки")
+    args = parser.parse_args()
 
-        if not ROCKETCHAT_USER or not ROCKETCHAT_PASSWORD:
-            print("❌ Укажите ROCKETCHAT_USER и ROCKETCHAT_PASSWORD в .env файле")
-            sys.exit(1)
+    if not ROCKETCHAT_USER or not ROCKETCHAT_PASSWORD:
+        print("❌ Укажите ROCKETCHAT_USER и ROCKETCHAT_PASSWORD в .env файле")
+        sys.exit(1)
 
     manager = RocketChatUserManager()
-    results = manager.create_users_from_file(sys.argv[1])
+    if args.bulk:
+        results = manager.create_users_bulk(
+            args.file, workers=args.workers, rate=args.rate, checkpoint=args.checkpoint
+        )
+    else:
+        results = manager.create_users_from_file(args.file)
 
     print("\n=== Результаты ===")
     print(f"Создано: {len(results['created'])}")
     print(f"Пропущено: {len(results['skipped'])}")
     print(f"Ошибки: {len(results['failed'])}")
+    if args.bulk:
+        print(f"Время: {results['elapsed']:.1f} с")
+        print(f"Скорость: {results['throughput']:.1f} польз./с")
@@ -1,8 +1,23 @@
+import signal
+import threading
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from src.chatbot import RocketChatBot
 from src.llm_service import LLMService
 from src.message_handler import MessageHandler
+from src.job_queue import SummaryJobQueue, JobWorkerPool
+from src.digest_scheduler import DigestScheduler
+from src.send_queue import OutboundSendQueue
+from src.poll_scheduler import PollScheduler
+from src.webhook_server import WebhookServer
+from src.mongo_ingest import MongoMessageStream
+from src.state_snapshot import StateSnapshot
+from src.usage_meter import UsageMeter
+from src.summary_cache import SummaryCache
+from src.model_router import ModelRouter
+from src.fast_lane import FastLane
+from src.tenants import Tenant, TenantRuntime, load_tenants
 from src.config import *
 
 # Настройка логирования
@@ -22,37 +37,181 @@ def main():
     Инициализирует бота, сервис LLM и обработчик сообщений,
     затем входит в бесконечный цикл для обработки личных сообщений.
     """
+    if TENANTS_FILE:
+        run_tenants() # Несколько ботов в одном процессе
+        return
+
     try:
+        started = time.perf_counter() # Замер времени запуска
         logger.info("Запуск бота...")
         
         chatbot = RocketChatBot() # Создание экземпляра бота Rocket.Chat
+        poll_scheduler = PollScheduler() # Адаптивный интервал опроса и выбор активных комнат
+        chatbot.poll_scheduler = poll_scheduler
+        # Исходящие ЛС отправляются в фоне с ограничением частоты и повторами
+        send_queue = OutboundSendQueue(chatbot.deliver_direct_message)
+        chatbot.send_queue = send_queue
+        send_queue.start()
         llm_service = LLMService() # Создание экземпляра сервиса LLM
-        message_handler = MessageHandler(chatbot, llm_service) # Создание экземпляра обработчика сообщений
+        llm_service.usage_meter = UsageMeter() # Учёт токенов и задержек, квоты пользователей и комнат
+        llm_service.summary_cache = SummaryCache() # Повторное использование сводок почти не изменившихся бесед
+        llm_service.model_router = ModelRouter() # Короткие беседы — быстрой модели, длинные — основной
+        job_queue = SummaryJobQueue() # Персистентная очередь задач суммаризации
+        fast_lane = FastLane() # Быстрая полоса для мгновенных команд; медленная — воркеры очереди задач
+        message_handler = MessageHandler(chatbot, llm_service, job_queue, fast_lane=fast_lane) # Создание экземпляра обработчика сообщений
+        # Планировщик заранее рассчитывает сводки по подпискам и рассылает их в ЛС
+        digest_scheduler = DigestScheduler(message_handler.compute_room_summary, chatbot.send_direct_message)
+        message_handler.digest_scheduler = digest_scheduler
+        digest_scheduler.start()
+        # Воркеры подхватывают и незавершённые задачи, оставшиеся после перезапуска
+        worker_pool = JobWorkerPool(
+            job_queue,
+            {'summary': message_handler.run_summary_job, 'digest': message_handler.run_digest_job},
+            on_failure=message_handler.notify_summary_failed
+        )
+        worker_pool.start()
+        
+        # Тёплый перезапуск: ID обработанных сообщений, кэши комнат, состояние опроса,
+        # неотправленные ответы и активный промпт восстанавливаются из снимка
+        snapshot = StateSnapshot()
+        snapshot.register('chatbot', chatbot.dump_state, chatbot.restore_state)
+        snapshot.register('poll_scheduler', poll_scheduler.dump_state, poll_scheduler.restore_state)
+        snapshot.register('send_queue', send_queue.dump_state, send_queue.restore_state, final_only=True)
+        snapshot.register('message_handler', message_handler.dump_state, message_handler.restore_state)
+        snapshot.register('usage', llm_service.usage_meter.dump_state, llm_service.usage_meter.restore_state)
+        snapshot.restore()
+        snapshot.start()
+        
+        # SIGTERM (остановка контейнера, systemd) завершает работу так же аккуратно, как Ctrl+C
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+        
+        webhook_server = None
+        if INGESTION_MODE == 'webhook':
+            # Сообщения приходят от исходящих интеграций Rocket.Chat, опрос REST API не нужен
+            webhook_server = WebhookServer(message_handler.process_direct_message, bot_username=chatbot.bot_username)
+            webhook_server.start()
+
+        mongo_stream = None
+        if INGESTION_MODE == 'mongo':
+            # Сообщения и история комнат читаются напрямую из базы self-hosted Rocket.Chat
+            mongo_stream = MongoMessageStream(message_handler.process_direct_message,
+                                              chatbot.rocket.headers.get('X-User-Id'), chatbot.bot_username)
+            chatbot.message_store = mongo_stream
+            mongo_stream.start()
+        push_ingestion = webhook_server or mongo_stream
 
-        logger.info("Запуск прослушивания сообщений...")
+        logger.info(f"Бот запущен за {time.perf_counter() - started:.2f} с "
+                    f"(авторизация: {chatbot.auth_seconds:.2f} с, токен: {chatbot.auth_source})")
+        logger.info(f"Запуск прослушивания сообщений (режим: {INGESTION_MODE})...")
         logger.info("Отправьте боту личное сообщение 'help' для теста")
         
-        while True: # Бесконечный цикл для постоянной работы бота
+        while not stop_event.is_set(): # Цикл работает до SIGTERM или Ctrl+C
             try:
-                direct_messages = chatbot.get_direct_messages() # Получение новых личных сообщений
-                for message in direct_messages:
-                    message_handler.process_direct_message(message) # Обработка каждого личного сообщения
+                if push_ingestion:
+                    stop_event.wait(POLL_INTERVAL_MAX) # Сообщения обрабатываются сервером вебхуков или change stream, здесь только сохранение состояния
+                else:
+                    direct_messages = chatbot.get_direct_messages() # Получение новых личных сообщений
+                    for message in direct_messages:
+                        message_handler.process_direct_message(message) # Обработка каждого личного сообщения
                 
                 chatbot.clear_processed_messages() # Очистка списка обработанных сообщений (чтобы не рос бесконечно)
                 chatbot.save_processed_messages() # Сохранение списка обработанных сообщений в файл
                 
-                time.sleep(3) # Задержка перед следующей проверкой сообщений
+                if not push_ingestion:
+                    interval = poll_scheduler.next_interval(bool(direct_messages)) # В простое интервал растёт, при активности сбрасывается
+                    logger.debug(f"Следующий опрос через {interval:.1f} с ({poll_scheduler.stats()})")
+                    stop_event.wait(interval) # Задержка перед следующей проверкой сообщений (прерывается сигналом остановки)
                 
             except KeyboardInterrupt: # Обработка прерывания программы (например, Ctrl+C)
-                logger.info("Остановка бота...")
-                chatbot.save_processed_messages() # Сохранение обработанных сообщений перед выходом
-                break # Выход из бесконечного цикла
+                stop_event.set()
             except Exception as e: # Обработка любых других ошибок в основном цикле
                 logger.error(f"Ошибка в основном цикле: {e}")
-                time.sleep(5) # Пауза перед повторной попыткой
+                stop_event.wait(5) # Пауза перед повторной попыткой
+        
+        logger.info("Остановка бота...")
+        if mongo_stream:
+            mongo_stream.stop(timeout=10) # Дожидаемся обработки текущего сообщения
+        if webhook_server:
+            webhook_server.stop(timeout=10) # Дожидаемся обработки принятых вебхуков
+        fast_lane.stop(timeout=10) # Дожидаемся выполнения принятых команд
+        chatbot.save_processed_messages() # Сохранение обработанных сообщений перед выходом
+        worker_pool.stop(timeout=5) # Незавершённые задачи будут выполнены после перезапуска
+        digest_scheduler.stop(timeout=5)
+        send_queue.stop(timeout=10) # Дожидаемся отправки накопленных ответов
+        snapshot.stop(timeout=5) # Итоговый снимок: в нём и ответы, которые не успели отправить
+        logger.info("Бот остановлен")
                 
     except Exception as e: # Обработка критических ошибок при запуске бота
         logger.error(f"Критическая ошибка при запуске: {e}")
 
+def run_tenants():
+    """
+    Запускает в одном процессе ботов всех арендаторов из TENANTS_FILE.
+    LLM (пул соединений, квоты, кэш сводок), очередь задач, быстрая полоса, пул расчёта
+    регулярных сводок и цикл опроса общие; подключение к Rocket.Chat, обработанные сообщения,
+    очередь отправки и промпт по умолчанию у каждого арендатора свои.
+    """
+    try:
+        started = time.perf_counter()
+        configs = load_tenants()
+        logger.info(f"Запуск ботов для арендаторов: {len(configs)}...")
+        
+        llm_service = LLMService()
+        llm_service.usage_meter = UsageMeter()
+        llm_service.summary_cache = SummaryCache()
+        llm_service.model_router = ModelRouter()
+        job_queue = SummaryJobQueue()
+        fast_lane = FastLane()
+        digest_executor = ThreadPoolExecutor(max_workers=max(1, DIGEST_CONCURRENCY), thread_name_prefix='digest')
+        
+        tenants = []
+        for config in configs:
+            try:
+                tenants.append(Tenant(config, llm_service, job_queue, fast_lane, digest_executor))
+            except Exception as e: # Недоступный сервер одного арендатора не мешает запуску остальных
+                logger.error(f"Арендатор '{config['name']}' не запущен: {e}")
+        if not tenants:
+            logger.error("Не запущено ни одного арендатора")
+            return
+        runtime = TenantRuntime(tenants)
+        
+        worker_pool = JobWorkerPool(
+            job_queue,
+            {'summary': runtime.job_handler('run_summary_job'), 'digest': runtime.job_handler('run_digest_job')},
+            on_failure=runtime.notify_failed
+        )
+        
+        snapshot = StateSnapshot()
+        for tenant in tenants:
+            tenant.register_snapshot(snapshot)
+        snapshot.register('usage', llm_service.usage_meter.dump_state, llm_service.usage_meter.restore_state)
+        snapshot.restore()
+        for tenant in tenants:
+            tenant.start()
+        worker_pool.start()
+        snapshot.start()
+        
+        signal.signal(signal.SIGTERM, lambda signum, frame: runtime.stop())
+        logger.info(f"Запущено арендаторов: {len(tenants)} из {len(configs)} за {time.perf_counter() - started:.2f} с")
+        
+        try:
+            runtime.run()
+        except KeyboardInterrupt:
+            runtime.stop()
+        
+        logger.info("Остановка ботов...")
+        runtime.close(timeout=10) # Новые сообщения больше не принимаются
+        fast_lane.stop(timeout=10)
+        worker_pool.stop(timeout=5)
+        digest_executor.shutdown(wait=False)
+        for tenant in tenants:
+            tenant.stop(timeout=10)
+        snapshot.stop(timeout=5)
+        logger.info("Боты остановлены")
+        
+    except Exception as e:
+        logger.error(f"Критическая ошибка при запуске арендаторов: {e}")
+
 if __name__ == "__main__":
     main() # Запуск главной функции при выполнении скрипта напрямую
@@ -0,0 +1,94 @@
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+from src.message_model import filter_messages, parse_messages
+from src.preprocessing import MessagePreprocessor
+
+BOT_USERNAME = 'bot'
+
+
+def make_raw_messages(count, seed=42):
+    """
+    Генерирует словари сообщений в формате ответа channels.history Rocket.Chat
+    (со служебными полями, которые бот не использует).
+    """
+    rng = random.Random(seed)
+    users = [f"user_{i}" for i in range(20)] + [BOT_USERNAME]
+    words = "деплой релиз тест баг фикс ревью база ключ сервер логи ошибка задача срок".split()
+    messages = []
+    for i in range(count):
+        username = rng.choice(users)
+        messages.append({
+            '_id': f"msg{i:08d}",
+            'rid': 'GENERAL',
+            'msg': ' '.join(rng.choice(words) for _ in range(rng.randint(3, 25))),
+            'ts': '2024-05-01T10:00:00.000Z',
+            'u': {'_id': f"id_{username}", 'username': username, 'name': username.title()},
+            'username': username,
+            '_updatedAt': '2024-05-01T10:00:00.000Z',
+            'urls': [],
+            'mentions': [],
+            'channels': [],
+            'md': [{'type': 'PARAGRAPH', 'value': [{'type': 'PLAIN_TEXT', 'value': '...'}]}],
+            't': 'uj' if i % 40 == 0 else None
+        })
+    return messages
+
+
+def retained_bytes(build):
+    """
+    Измеряет объём памяти, удерживаемый результатом build().
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк памяти и скорости конвейера сообщений")
+    parser.add_argument('-n', '--messages', type=int, default=50000)
+    args = parser.parse_args()
+
+    print("🧪 Бенчмарк конвейера сообщений")
+    print("=" * 50)
+
+    # Старый путь: отфильтрованный список исходных словарей ответа
+    kept, dict_bytes = retained_bytes(lambda: [
+        message for message in make_raw_messages(args.messages)
+        if message.get('msg') and not message.get('t') and message.get('username') != BOT_USERNAME
+    ])
+    count = len(kept)
+    del kept
+
+    # Генератор не удерживает исходные словари: после построения списка в памяти остаются только записи
+    records, record_bytes = retained_bytes(lambda: list(
+        filter_messages(parse_messages(make_raw_messages(args.messages)), BOT_USERNAME)
+    ))
+    del records
+
+    print(f"Сообщений на входе: {args.messages}, после фильтрации: {count}")
+    print(f"📦 Словари Rocket.Chat: {dict_bytes / count:.0f} байт/сообщение ({dict_bytes / 2 ** 20:.1f} МБ)")
+    print(f"📦 Записи ChatMessage:  {record_bytes / count:.0f} байт/сообщение ({record_bytes / 2 ** 20:.1f} МБ)")
+    print(f"📉 Экономия: {(1 - record_bytes / dict_bytes) * 100:.0f}%")
+
+    # Полный ленивый конвейер: разбор -> фильтр -> предобработка -> строки промпта
+    raw = make_raw_messages(args.messages)
+    started = time.perf_counter()
+    lines, report = MessagePreprocessor().format_lines(
+        filter_messages(parse_messages(raw), BOT_USERNAME), BOT_USERNAME
+    )
+    total_chars = sum(len(line) for line in lines)
+    elapsed = time.perf_counter() - started
+    print(f"\n⏱  Конвейер разбор → фильтр → формат: {elapsed * 1000:.0f} мс "
+          f"({args.messages / elapsed:.0f} сообщ./с), {total_chars} символов")
+    print(f"🔤 Токены: {report}")
+
+
+if __name__ == "__main__":
+    main()
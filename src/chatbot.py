@@ -1,36 +1,69 @@
+import json
 import logging
 import pickle # Импорт модуля для сериализации и десериализации объектов Python (сохранение/загрузка состояния)
 import os
+import threading
+import time
 from rocketchat_API.rocketchat import RocketChat
 from src.config import *
+from src.message_model import filter_messages, parse_messages
+from src.rate_limiter import RateLimitedSession
 
 # Настройка логирования для данного модуля
 logger = logging.getLogger(__name__)
 
 # Класс для взаимодействия с Rocket.Chat в качестве бота
 class RocketChatBot:
-    def __init__(self):
+    def __init__(self, server_url=ROCKETCHAT_URL, user=ROCKETCHAT_USER, password=ROCKETCHAT_PASSWORD,
+                 user_id=ROCKETCHAT_USER_ID, auth_token=ROCKETCHAT_AUTH_TOKEN, data_dir=None):
         """
         Конструктор класса RocketChatBot.
         Инициализирует подключение к Rocket.Chat и загружает историю обработанных сообщений.
+        По умолчанию параметры подключения берутся из конфигурации; в режиме нескольких
+        арендаторов у каждого бота свои учётные данные и каталог данных.
+
+        :param server_url: URL-адрес сервера Rocket.Chat.
+        :param user: Имя пользователя бота.
+        :param password: Пароль бота.
+        :param user_id: ID пользователя для входа по токену.
+        :param auth_token: Токен для входа без пароля.
+        :param data_dir: Каталог для обработанных сообщений и сохранённого токена (по умолчанию src/data).
         """
         try:
-            logger.info("Инициализация бота Rocket.Chat...")
+            logger.info(f"Инициализация бота Rocket.Chat ({server_url})...")
+            self.server_url = server_url
+            self.user = user
+            self.password = password
+            
+            # Сессия учитывает лимиты частоты запросов Rocket.Chat по каждому эндпоинту
+            self.session = RateLimitedSession()
             
-            # Инициализация объекта RocketChat с учетными данными из конфига
+            # Инициализация объекта RocketChat без входа: сначала пробуем сохранённый токен
             self.rocket = RocketChat(
-                user=ROCKETCHAT_USER, # Имя пользователя бота
-                password=ROCKETCHAT_PASSWORD, # Пароль пользователя бота
-                server_url=ROCKETCHAT_URL, # URL-адрес сервера Rocket.Chat
-                timeout=30 # Таймаут для запросов
+                server_url=server_url, # URL-адрес сервера Rocket.Chat
+                timeout=30, # Таймаут для запросов
+                session=self.session # HTTP-сессия с учётом лимитов
             )
+            self.auth_token_file = os.path.join(data_dir, 'auth_token.json') if data_dir else AUTH_TOKEN_CACHE # Файл с сохранённым токеном сессии
+            self.auth_lock = threading.Lock() # Повторный вход выполняет только один поток
+            self.auth_source = None # Откуда взят действующий токен: env, cache или login
+            self.session.on_unauthorized = self.relogin # Токен отозван или истёк — входим заново и повторяем запрос
             
-            self.base_url = ROCKETCHAT_URL # Базовый URL сервера Rocket.Chat
-            self.processed_messages_file = 'src/data/processed_messages.pkl' # Путь к файлу для хранения ID обработанных сообщений
+            self.base_url = server_url # Базовый URL сервера Rocket.Chat
+            self.processed_messages_file = os.path.join(data_dir or 'src/data', 'processed_messages.pkl') # Путь к файлу для хранения ID обработанных сообщений
             self.processed_messages = self.load_processed_messages() # Загрузка ранее обработанных сообщений
             self.bot_username = None # Имя пользователя бота, будет установлено после успешного подключения
+            self.dm_rooms = {} # Кэш ID личных комнат: имя пользователя -> room_id
+            self.send_queue = None # Очередь исходящих сообщений (OutboundSendQueue), если подключена
+            self.poll_scheduler = None # Планировщик опроса ЛС (PollScheduler), если подключен
+            self.message_store = None # Прямое чтение базы Rocket.Chat (MongoMessageStream), если подключено
+            self.room_directory = {} # Каталог комнат: имя в нижнем регистре -> {'_id', 'name'}
+            self.room_directory_updated = 0 # Время последнего обновления каталога комнат
             
-            self.test_connection() # Проверка подключения к Rocket.Chat
+            started = time.perf_counter()
+            self.authenticate(user_id, auth_token) # Токен из конфигурации или кэша, иначе вход по паролю
+            self.test_connection() # Проверка подключения к Rocket.Chat (при отвергнутом токене — повторный вход)
+            self.auth_seconds = time.perf_counter() - started # Время авторизации для отчёта о запуске
             logger.info("Бот Rocket.Chat успешно инициализирован")
             logger.info(f"Загружено {len(self.processed_messages)} обработанных сообщений из файла")
             
@@ -58,11 +91,110 @@ class RocketChatBot:
         """
         try:
             with open(self.processed_messages_file, 'wb') as f: # Открываем файл в бинарном режиме для записи
-                pickle.dump(self.processed_messages, f) # Сериализуем и сохраняем данные
+                pickle.dump(self.processed_messages.copy(), f) # Сериализуем и сохраняем данные (копия: множество пополняется из других потоков)
             logger.debug("Сохранены обработанные сообщения")
         except Exception as e:
             logger.error(f"Ошибка сохранения обработанных сообщений: {e}")
 
+    def authenticate(self, user_id=None, auth_token=None):
+        """
+        Подготавливает заголовки авторизации без лишнего входа по паролю:
+        токен из конфигурации (ROCKETCHAT_USER_ID/ROCKETCHAT_AUTH_TOKEN), затем сохранённый токен,
+        и только если их нет — вход по имени пользователя и паролю.
+        """
+        if user_id and auth_token:
+            self.set_auth_token(user_id, auth_token)
+            self.auth_source = 'env'
+            logger.info("Используется токен из конфигурации")
+            return
+
+        cached = self.load_auth_token()
+        if cached:
+            self.set_auth_token(cached['user_id'], cached['auth_token'])
+            self.auth_source = 'cache'
+            logger.info("Используется сохранённый токен сессии")
+            return
+
+        self.login()
+
+    def set_auth_token(self, user_id, auth_token):
+        """
+        Устанавливает заголовки авторизации клиента RocketChat.
+        """
+        self.rocket.headers['X-User-Id'] = user_id
+        self.rocket.headers['X-Auth-Token'] = auth_token
+
+    def login(self):
+        """
+        Входит по имени пользователя и паролю и сохраняет полученный токен.
+        Вызывает исключение при ошибке аутентификации.
+        """
+        if not (self.user and self.password):
+            raise Exception("Токен недействителен, а ROCKETCHAT_USER/ROCKETCHAT_PASSWORD не заданы")
+        logger.info(f"Вход в Rocket.Chat как {self.user}...")
+        self.rocket.login(self.user, self.password) # Заголовки авторизации обновляются внутри клиента
+        self.auth_source = 'login'
+        self.save_auth_token()
+
+    def relogin(self, rejected_token):
+        """
+        Повторный вход после ответа 401. Вызывается HTTP-сессией из любого потока.
+
+        :param rejected_token: Токен, с которым был отвергнут запрос.
+        :return: True, если можно повторить запрос с новым токеном.
+        """
+        with self.auth_lock:
+            if self.rocket.headers.get('X-Auth-Token') != rejected_token:
+                return True # Другой поток уже вошёл заново
+            logger.warning("Токен сессии отвергнут сервером, выполняется повторный вход")
+            try:
+                self.login()
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка повторного входа: {e}")
+                return False
+
+    def load_auth_token(self):
+        """
+        Загружает сохранённый токен, если он выдан тому же пользователю на том же сервере.
+
+        :return: Словарь {'user_id', 'auth_token'} или None.
+        """
+        try:
+            if not os.path.exists(self.auth_token_file):
+                return None
+            with open(self.auth_token_file, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get('server_url') != self.server_url or cached.get('user') != self.user:
+                return None # Токен от другого сервера или пользователя
+            if cached.get('user_id') and cached.get('auth_token'):
+                return cached
+        except Exception as e:
+            logger.warning(f"Ошибка загрузки сохранённого токена: {e}")
+        return None
+
+    def save_auth_token(self):
+        """
+        Атомарно сохраняет текущий токен сессии в файл, доступный только владельцу.
+        """
+        try:
+            directory = os.path.dirname(self.auth_token_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            data = {
+                'server_url': self.server_url,
+                'user': self.user,
+                'user_id': self.rocket.headers.get('X-User-Id'),
+                'auth_token': self.rocket.headers.get('X-Auth-Token')
+            }
+            tmp_path = f"{self.auth_token_file}.tmp"
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.auth_token_file)
+            logger.debug("Токен сессии сохранён")
+        except Exception as e:
+            logger.warning(f"Ошибка сохранения токена сессии: {e}")
+
     def test_connection(self):
         """
         Проверяет подключение к Rocket.Chat и получает информацию о боте.
@@ -104,9 +236,71 @@ class RocketChatBot:
             logger.error(f"Исключение при отправке: {e}")
             return False
 
+    def remember_dm_room(self, username, room_id):
+        """
+        Запоминает ID личной комнаты с пользователем, чтобы не вызывать im.create при ответе.
+        
+        :param username: Имя пользователя.
+        :param room_id: ID личной комнаты.
+        """
+        if username and room_id:
+            self.dm_rooms[username] = room_id
+
+    def get_dm_room_id(self, username):
+        """
+        Возвращает ID личной комнаты с пользователем: из кэша или через im.create.
+        
+        :param username: Имя пользователя.
+        :return: ID комнаты или None при ошибке.
+        """
+        room_id = self.dm_rooms.get(username)
+        if room_id:
+            return room_id
+        
+        response = self.rocket.im_create(username) # Создаем или получаем личную беседу с пользователем
+        response_data = response.json() # Парсим ответ сервера
+        
+        if response_data.get('success'):
+            room_id = response_data.get('room', {}).get('_id') # Получаем ID комнаты личной беседы
+            if room_id:
+                self.dm_rooms[username] = room_id
+                return room_id
+            logger.error("Не найден room_id в ответе")
+        else:
+            logger.error(f"Ошибка создания личной комнаты: {response_data}")
+        return None
+
     def send_direct_message(self, username, text):
         """
         Отправляет личное сообщение указанному пользователю.
+        Если подключена очередь исходящих сообщений, сообщение ставится в неё
+        и отправляется в фоне, не блокируя обработку команд. Результаты задач,
+        доставку которых нужно подтвердить, отправляются через deliver_result_message().
+        
+        :param username: Имя пользователя, которому нужно отправить ЛС.
+        :param text: Текст сообщения.
+        :return: True, если ЛС отправлено (или принято в очередь) успешно, иначе False.
+        """
+        if self.send_queue:
+            return self.send_queue.put(username, text)
+        return self.deliver_direct_message(username, text)
+
+    def deliver_result_message(self, username, text):
+        """
+        Синхронно отправляет результат задачи после сообщений пользователю, уже стоящих
+        в очереди (например, уведомлений о ходе работы), чтобы сохранить их порядок.
+        
+        :param username: Имя пользователя, которому нужно отправить ЛС.
+        :param text: Текст сообщения.
+        :return: True, если ЛС отправлено успешно, иначе False.
+        """
+        if self.send_queue and not self.send_queue.wait_user(username, SEND_FLUSH_TIMEOUT):
+            logger.warning(f"Очередь сообщений пользователю {username} не отправлена за {SEND_FLUSH_TIMEOUT:.0f} с")
+        return self.deliver_direct_message(username, text)
+
+    def deliver_direct_message(self, username, text):
+        """
+        Синхронно отправляет личное сообщение указанному пользователю.
         
         :param username: Имя пользователя, которому нужно отправить ЛС.
         :param text: Текст сообщения.
@@ -115,18 +309,14 @@ class RocketChatBot:
         try:
             logger.info(f"Отправка ЛС пользователю: {username}")
             
-            response = self.rocket.im_create(username) # Создаем или получаем личную беседу с пользователем
-            response_data = response.json() # Парсим ответ сервера
+            room_id = self.get_dm_room_id(username)
+            if not room_id:
+                return False
             
-            if response_data.get('success'):
-                room_id = response_data.get('room', {}).get('_id') # Получаем ID комнаты личной беседы
-                if room_id:
-                    return self.send_message(room_id, text) # Отправляем сообщение в эту комнату
-                else:
-                    logger.error("Не найден room_id в ответе")
-            else:
-                logger.error(f"Ошибка создания личной комнаты: {response_data}")
+            if self.send_message(room_id, text): # Отправляем сообщение в эту комнату
+                return True
             
+            self.dm_rooms.pop(username, None) # Комната могла быть удалена, при повторе запросим заново
             return False
             
         except Exception as e:
@@ -141,19 +331,31 @@ class RocketChatBot:
         """
         try:
             logger.debug("Получение списка комнат...")
-            rooms = []
+            if self.message_store:
+                rooms = self.message_store.list_rooms() # Из базы, без запросов к REST API
+                channels_data = groups_data = {'success': True}
+            else:
+                rooms = []
+                
+                channels_response = self.rocket.channels_list() # Получаем список публичных каналов
+                channels_data = channels_response.json()
             
-            channels_response = self.rocket.channels_list() # Получаем список публичных каналов
-            channels_data = channels_response.json()
+                if channels_data.get('success'):
+                    rooms.extend(channels_data.get('channels', [])) # Добавляем каналы в общий список
             
-            if channels_data.get('success'):
-                rooms.extend(channels_data.get('channels', [])) # Добавляем каналы в общий список
+                groups_response = self.rocket.groups_list() # Получаем список приватных групп
+                groups_data = groups_response.json()
             
-            groups_response = self.rocket.groups_list() # Получаем список приватных групп
-            groups_data = groups_response.json()
+                if groups_data.get('success'):
+                    rooms.extend(groups_data.get('groups', [])) # Добавляем группы в общий список
             
-            if groups_data.get('success'):
-                rooms.extend(groups_data.get('groups', [])) # Добавляем группы в общий список
+            if channels_data.get('success') or groups_data.get('success'):
+                # Запоминаем только то, что нужно для поиска комнаты по имени
+                self.room_directory = {
+                    room.get('name', '').lower(): {'_id': room.get('_id'), 'name': room.get('name')}
+                    for room in rooms if room.get('name')
+                }
+                self.room_directory_updated = time.time()
             
             logger.info(f"Найдено комнат: {len(rooms)}")
             return rooms
@@ -169,6 +371,12 @@ class RocketChatBot:
         :param room_name: Имя комнаты для поиска.
         :return: Словарь, представляющий комнату, если найдена, иначе None.
         """
+        # Пока каталог свежий, комната ищется без запросов к Rocket.Chat
+        if time.time() - self.room_directory_updated < ROOM_DIRECTORY_TTL:
+            room = self.room_directory.get(room_name.lower())
+            if room:
+                return room
+        
         rooms = self.get_all_rooms() # Получаем все комнаты
         for room in rooms:
             if room.get('name', '').lower() == room_name.lower(): # Сравниваем имена без учета регистра
@@ -177,6 +385,18 @@ class RocketChatBot:
         logger.warning(f"Комната '{room_name}' не найдена")
         return None
 
+    def resolve_rooms(self, room_names):
+        """
+        Находит несколько комнат по именам, загружая список комнат не больше одного раза.
+        
+        :param room_names: Список имён комнат.
+        :return: Словарь {имя: комната или None}.
+        """
+        if time.time() - self.room_directory_updated >= ROOM_DIRECTORY_TTL or \
+                any(name.lower() not in self.room_directory for name in room_names):
+            self.get_all_rooms() # Обновляет каталог комнат
+        return {name: self.room_directory.get(name.lower()) for name in room_names}
+
     def get_room_messages_for_summary(self, room_id, limit=50):
         """
         Получает сообщения из указанной комнаты для дальнейшего суммаризации.
@@ -184,21 +404,22 @@ class RocketChatBot:
         
         :param room_id: ID комнаты.
         :param limit: Максимальное количество сообщений для получения.
-        :return: Список текстовых сообщений.
+        :return: Список записей ChatMessage.
         """
         try:
             logger.debug(f"Получение сообщений из комнаты {room_id}")
-            response = self.rocket.channels_history(room_id, count=limit) # Получаем историю сообщений канала
-            response_data = response.json()
+            if self.message_store:
+                # История читается напрямую из базы, без запросов к REST API
+                response_data = {'success': True, 'messages': self.message_store.room_history(room_id, limit)}
+            else:
+                response = self.rocket.channels_history(room_id, count=limit) # Получаем историю сообщений канала
+                response_data = response.json()
             
             if response_data.get('success'):
                 messages = response_data.get('messages', [])
-                text_messages = [
-                    msg for msg in messages 
-                    if (msg.get('msg') and # Проверяем наличие текста сообщения
-                        not msg.get('t') and # Исключаем системные сообщения (t - type)
-                        msg.get('username') != self.bot_username) # Исключаем сообщения от самого бота
-                ]
+                # Компактные записи без текста, системных сообщений и сообщений самого бота;
+                # исходные словари ответа не удерживаются
+                text_messages = list(filter_messages(parse_messages(messages), self.bot_username))
                 logger.info(f"Получено сообщений для анализа: {len(text_messages)}")
                 return text_messages
             else:
@@ -213,7 +434,7 @@ class RocketChatBot:
         Получает новые личные сообщения, адресованные боту.
         Фильтрует уже обработанные сообщения.
         
-        :return: Список новых личных сообщений.
+        :return: Список новых личных сообщений (записи ChatMessage с room_id и room_user).
         """
         try:
             logger.debug("Проверка личных сообщений...")
@@ -222,36 +443,47 @@ class RocketChatBot:
             
             if im_list_data.get('success'):
                 direct_rooms = im_list_data.get('ims', []) # Список личных комнат
+                if self.poll_scheduler:
+                    direct_rooms = self.poll_scheduler.select_rooms(direct_rooms) # Только комнаты, которые пора опросить
                 
                 all_messages = []
                 for room in direct_rooms:
-                    room_id = room.get('_id')
-                    room_user = room.get('username') # Имя пользователя в ЛС, если доступно
+                    try:
+                        room_id = room.get('_id')
+                        room_user = room.get('username') # Имя пользователя в ЛС, если доступно
+                    
+                        # Если имя пользователя не найдено напрямую в IM_list, пытаемся получить его из информации о комнате
+                        if not room_user:
+                            room_info = self.rocket.rooms_info(room_id=room_id).json()
+                            if room_info.get('success'):
+                                room_data = room_info.get('room', {})
+                                if room_data.get('t') == 'd': # Если это личная беседа (direct)
+                                    usernames = room_data.get('usernames', [])
+                                    # Находим имя пользователя, которое не является именем бота
+                                    room_user = next((u for u in usernames if u != self.bot_username), 'Unknown')
                     
-                    # Если имя пользователя не найдено напрямую в IM_list, пытаемся получить его из информации о комнате
-                    if not room_user:
-                        room_info = self.rocket.rooms_info(room_id=room_id).json()
-                        if room_info.get('success'):
-                            room_data = room_info.get('room', {})
-                            if room_data.get('t') == 'd': # Если это личная беседа (direct)
-                                usernames = room_data.get('usernames', [])
-                                # Находим имя пользователя, которое не является именем бота
-                                room_user = next((u for u in usernames if u != self.bot_username), 'Unknown')
+                        if room_user != 'Unknown':
+                            self.remember_dm_room(room_user, room_id) # Ответы пойдут сразу в эту комнату, без im.create
                     
-                    messages_response = self.rocket.im_history(room_id, count=20) # Получаем историю сообщений из личной беседы
-                    messages_data = messages_response.json()
+                        messages_response = self.rocket.im_history(room_id, count=20) # Получаем историю сообщений из личной беседы
+                        messages_data = messages_response.json()
                     
-                    if messages_data.get('success'):
-                        messages = messages_data.get('messages', [])
+                        if messages_data.get('success'):
+                            messages = messages_data.get('messages', [])
+                            found_before = len(all_messages)
                         
-                        for msg in messages:
-                            message_id = msg.get('_id')
-                            # Если сообщение не было обработано ранее и не отправлено самим ботом
-                            if (message_id not in self.processed_messages and 
-                                msg.get('username') != self.bot_username):
-                                msg['_room_id'] = room_id # Добавляем ID комнаты к сообщению
-                                msg['_room_user'] = room_user or msg.get('username', 'Unknown') # Добавляем имя пользователя к сообщению
+                            # Пропускаем уже обработанные сообщения и сообщения самого бота
+                            for msg in filter_messages(parse_messages(messages, room_id=room_id, room_user=room_user),
+                                                       self.bot_username, skip_ids=self.processed_messages):
+                                if not msg.room_user:
+                                    msg.room_user = msg.username or 'Unknown'
                                 all_messages.append(msg) # Добавляем сообщение в список
+                            
+                            if self.poll_scheduler:
+                                self.poll_scheduler.record_room(room_id, len(all_messages) > found_before)
+                    except Exception as e:
+                        # Ошибка одной комнаты (например, исчерпанный лимит) не срывает весь опрос
+                        logger.warning(f"Ошибка получения ЛС из комнаты {room.get('_id')}: {e}")
                 
                 if all_messages:
                     logger.info(f"Обнаружено новых ЛС: {len(all_messages)}")
@@ -269,5 +501,40 @@ class RocketChatBot:
         Это предотвращает бесконечный рост размера списка processed_messages.
         """
         if len(self.processed_messages) > 1000: # Если количество обработанных сообщений превышает 1000
-            self.processed_messages = set(list(self.processed_messages)[-500:]) # Оставляем только последние 500
+            self.processed_messages = set(list(self.processed_messages.copy())[-500:]) # Оставляем только последние 500
             logger.info("Очищена история обработанных сообщений")
+
+    def dump_state(self):
+        """
+        Выгружает состояние для снимка тёплого перезапуска.
+
+        :return: Словарь с ID обработанных сообщений, кэшем личных комнат и каталогом комнат.
+        """
+        return {
+            'processed_messages': list(self.processed_messages.copy()),
+            'dm_rooms': dict(self.dm_rooms),
+            'room_directory': dict(self.room_directory),
+            'room_directory_updated': self.room_directory_updated
+        }
+
+    def restore_state(self, state):
+        """
+        Восстанавливает состояние из снимка тёплого перезапуска.
+
+        :param state: Словарь, полученный из dump_state().
+        """
+        self.processed_messages.update(state.get('processed_messages', []))
+        self.dm_rooms.update(state.get('dm_rooms', {}))
+        if state.get('room_directory_updated', 0) > self.room_directory_updated:
+            self.room_directory = state.get('room_directory', {})
+            self.room_directory_updated = state['room_directory_updated']
+        logger.info(f"Восстановлено: {len(self.processed_messages)} обработанных сообщений, "
+                    f"{len(self.dm_rooms)} личных комнат, {len(self.room_directory)} комнат в каталоге")
+
+    def get_rate_limit_metrics(self):
+        """
+        Возвращает оставшийся бюджет запросов к Rocket.Chat API по эндпоинтам.
+        
+        :return: Словарь {эндпоинт: {'limit', 'remaining', 'reset_in', 'throttled'}}.
+        """
+        return self.session.metrics()
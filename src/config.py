@@ -9,6 +9,14 @@ ROCKETCHAT_USER = os.getenv('ROCKETCHAT_USER')
 ROCKETCHAT_PASSWORD = os.getenv('ROCKETCHAT_PASSWORD')
 ROCKETCHAT_USER_ID = os.getenv('ROCKETCHAT_USER_ID')
 ROCKETCHAT_AUTH_TOKEN = os.getenv('ROCKETCHAT_AUTH_TOKEN')
+# Файл, в котором сохраняется токен сессии, чтобы не входить по паролю при каждом запуске
+AUTH_TOKEN_CACHE = os.getenv('AUTH_TOKEN_CACHE', 'src/data/auth_token.json')
+
+# Несколько ботов (арендаторов) в одном процессе: JSON-файл со списком арендаторов.
+# Если не задан, работает один бот с параметрами ROCKETCHAT_* выше
+TENANTS_FILE = os.getenv('TENANTS_FILE', '')
+TENANTS_DATA_DIR = os.getenv('TENANTS_DATA_DIR', 'src/data/tenants')
+TENANT_POLL_WORKERS = int(os.getenv('TENANT_POLL_WORKERS', 4))
 
 # LLM конфигурация
 OPEN_AI_API_KEY = os.getenv('OPEN_AI_API_KEY')
@@ -17,6 +25,100 @@ OPEN_AI_COMPLETIONS_PATHNAME = os.getenv('OPEN_AI_COMPLETIONS_PATHNAME')
 LLM_NAME = os.getenv('LLM_NAME')
 MAX_TOKENS = int(os.getenv('MAX_TOKENS', 2200))
 TEMPERATURE = float(os.getenv('TEMPERATURE', 0.8))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 180))
+# Каскад моделей: короткие беседы получает быстрая модель LLM_SMALL_NAME (пусто — все запросы к LLM_NAME),
+# при её неудаче запрос повторяется на LLM_NAME. Длина ответа зависит от размера беседы
+LLM_SMALL_NAME = os.getenv('LLM_SMALL_NAME', '')
+LLM_SMALL_MAX_PROMPT_TOKENS = int(os.getenv('LLM_SMALL_MAX_PROMPT_TOKENS', 2500))
+LLM_SMALL_TIMEOUT = float(os.getenv('LLM_SMALL_TIMEOUT', 45))
+LLM_SMALL_COST_RATIO = float(os.getenv('LLM_SMALL_COST_RATIO', 0.2))
+LLM_ESCALATE = os.getenv('LLM_ESCALATE', 'true').lower() in ('1', 'true', 'yes')
+LLM_MIN_RESPONSE_TOKENS = int(os.getenv('LLM_MIN_RESPONSE_TOKENS', 600))
+LLM_RESPONSE_TOKENS_RATIO = float(os.getenv('LLM_RESPONSE_TOKENS_RATIO', 1.0))
+
+# Предобработка сообщений перед построением промпта
+PREPROCESS_STAGES = [s.strip() for s in os.getenv('PREPROCESS_STAGES', 'noise,quotes,code,urls,dedupe,merge').split(',') if s.strip()]
+PREPROCESS_MAX_CODE_LINES = int(os.getenv('PREPROCESS_MAX_CODE_LINES', 6))
+
+# Бюджет длины беседы в промпте и отбор значимых сообщений при его превышении
+SUMMARY_MAX_CHARS = int(os.getenv('SUMMARY_MAX_CHARS', 18000))
+
+# Кэш похожих сводок (MinHash/LSH): порог повторного использования, порог дельта-обновления (0 — выключено)
+SUMMARY_CACHE_REUSE_THRESHOLD = float(os.getenv('SUMMARY_CACHE_REUSE_THRESHOLD', 0.9))
+SUMMARY_CACHE_DELTA_THRESHOLD = float(os.getenv('SUMMARY_CACHE_DELTA_THRESHOLD', 0.6))
+SUMMARY_CACHE_TTL = int(os.getenv('SUMMARY_CACHE_TTL', 3600))
+SUMMARY_CACHE_PERMUTATIONS = int(os.getenv('SUMMARY_CACHE_PERMUTATIONS', 128))
+SUMMARY_CACHE_BANDS = int(os.getenv('SUMMARY_CACHE_BANDS', 32))
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv('SUMMARY_CACHE_MAX_ENTRIES', 256))
+
+# Очередь задач суммаризации (SQLite)
+JOB_QUEUE_DB = os.getenv('JOB_QUEUE_DB', 'src/data/jobs.sqlite3')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_VISIBILITY_TIMEOUT = int(os.getenv('JOB_VISIBILITY_TIMEOUT', 300)) # Аренда продлевается, пока задача выполняется
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+# Завершённые задачи хранятся JOB_RETENTION секунд и удаляются воркерами раз в JOB_PURGE_INTERVAL секунд
+JOB_RETENTION = int(os.getenv('JOB_RETENTION', 7 * 24 * 3600))
+JOB_PURGE_INTERVAL = int(os.getenv('JOB_PURGE_INTERVAL', 3600))
+# Быстрая полоса: потоки обработки мгновенных команд (медленная полоса — воркеры очереди задач)
+FAST_LANE_WORKERS = int(os.getenv('FAST_LANE_WORKERS', 4))
+
+# Способ получения сообщений: poll (опрос REST API), webhook (исходящие интеграции Rocket.Chat)
+# или mongo (change stream базы self-hosted Rocket.Chat, нужен pymongo)
+INGESTION_MODE = os.getenv('INGESTION_MODE', 'poll')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_TOKEN = os.getenv('WEBHOOK_TOKEN')
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+# База Rocket.Chat должна быть запущена как replica set (в том числе из одного узла)
+MONGO_URL = os.getenv('MONGO_URL', 'mongodb://localhost:27017/rocketchat?directConnection=true')
+MONGO_RESUME_TOKEN_FILE = os.getenv('MONGO_RESUME_TOKEN_FILE', 'src/data/mongo_resume_token.json')
+MONGO_MAX_AWAIT_MS = int(os.getenv('MONGO_MAX_AWAIT_MS', 500))
+
+# Адаптивный опрос личных сообщений
+POLL_INTERVAL_MIN = float(os.getenv('POLL_INTERVAL_MIN', 1))
+POLL_INTERVAL_MAX = float(os.getenv('POLL_INTERVAL_MAX', 15))
+POLL_BACKOFF = float(os.getenv('POLL_BACKOFF', 1.5))
+POLL_HOT_WINDOW = float(os.getenv('POLL_HOT_WINDOW', 300))
+POLL_ROOM_MAX_INTERVAL = float(os.getenv('POLL_ROOM_MAX_INTERVAL', 60))
+
+# Ограничения частоты запросов Rocket.Chat API
+RATE_LIMIT_MAX_RETRIES = int(os.getenv('RATE_LIMIT_MAX_RETRIES', 3))
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', 60))
+RATE_LIMIT_PACING_THRESHOLD = float(os.getenv('RATE_LIMIT_PACING_THRESHOLD', 0.2))
+
+# Очередь исходящих сообщений
+SEND_RATE = float(os.getenv('SEND_RATE', 5))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', 3))
+SEND_BATCH_MAX_CHARS = int(os.getenv('SEND_BATCH_MAX_CHARS', 4000))
+SEND_FLUSH_TIMEOUT = float(os.getenv('SEND_FLUSH_TIMEOUT', 30)) # Ожидание очереди перед синхронной отправкой результата
+
+# Администраторы бота (через запятую)
+BOT_ADMINS = [u.strip() for u in os.getenv('BOT_ADMINS', '').split(',') if u.strip()]
+
+# Подписки на регулярные сводки
+DIGEST_DB = os.getenv('DIGEST_DB', 'src/data/digests.sqlite3')
+DIGEST_CONCURRENCY = int(os.getenv('DIGEST_CONCURRENCY', 2))
+DIGEST_FRESHNESS = int(os.getenv('DIGEST_FRESHNESS', 3600))
+DIGEST_LIMIT = int(os.getenv('DIGEST_LIMIT', 50))
+DIGEST_TICK = int(os.getenv('DIGEST_TICK', 30))
+
+# Команда digest: сводка нескольких комнат одним сообщением
+MULTI_DIGEST_CONCURRENCY = int(os.getenv('MULTI_DIGEST_CONCURRENCY', 3))
+MULTI_DIGEST_MAX_ROOMS = int(os.getenv('MULTI_DIGEST_MAX_ROOMS', 8))
+
+# Снимок состояния для тёплого перезапуска и кэш каталога комнат
+STATE_SNAPSHOT_FILE = os.getenv('STATE_SNAPSHOT_FILE', 'src/data/state_snapshot.json')
+STATE_SNAPSHOT_INTERVAL = int(os.getenv('STATE_SNAPSHOT_INTERVAL', 60))
+STATE_SNAPSHOT_MAX_AGE = int(os.getenv('STATE_SNAPSHOT_MAX_AGE', 86400))
+ROOM_DIRECTORY_TTL = int(os.getenv('ROOM_DIRECTORY_TTL', 600))
+
+# Квоты на использование LLM (0 — без ограничения) и окно учёта
+LLM_USER_TOKENS_PER_HOUR = int(os.getenv('LLM_USER_TOKENS_PER_HOUR', 60000))
+LLM_ROOM_TOKENS_PER_HOUR = int(os.getenv('LLM_ROOM_TOKENS_PER_HOUR', 120000))
+LLM_USER_CONCURRENCY = int(os.getenv('LLM_USER_CONCURRENCY', 1))
+LLM_ROOM_CONCURRENCY = int(os.getenv('LLM_ROOM_CONCURRENCY', 2))
+USAGE_WINDOW = int(os.getenv('USAGE_WINDOW', 3600))
+USAGE_BUCKET = int(os.getenv('USAGE_BUCKET', 60))
 
 # Проверка обязательных переменных
 def check_config():
@@ -0,0 +1,290 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timedelta
+from src.config import *
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+# Поддерживаемые периодичности подписки
+CADENCES = ('hourly', 'daily', 'weekdays')
+
+
+def parse_schedule(cadence, at_time=None):
+    """
+    Проверяет и нормализует расписание подписки.
+
+    :param cadence: Периодичность: hourly, daily или weekdays.
+    :param at_time: Время запуска "ЧЧ:ММ" (для hourly достаточно минут "ММ").
+    :return: Кортеж (cadence, "ЧЧ:ММ").
+    :raises ValueError: Если расписание задано неверно.
+    """
+    cadence = cadence.lower()
+    if cadence not in CADENCES:
+        raise ValueError(f"Неизвестная периодичность '{cadence}'. Доступные: {', '.join(CADENCES)}")
+
+    if not at_time:
+        if cadence != 'hourly':
+            raise ValueError("Укажите время в формате ЧЧ:ММ, например `08:30`")
+        at_time = '00:00'
+    elif cadence == 'hourly' and ':' not in at_time:
+        at_time = f"00:{at_time}"
+
+    try:
+        hour, minute = (int(part) for part in at_time.split(':'))
+    except ValueError:
+        raise ValueError(f"Неверное время '{at_time}'. Используйте формат ЧЧ:ММ")
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"Неверное время '{at_time}'. Используйте формат ЧЧ:ММ")
+    return cadence, f"{hour:02d}:{minute:02d}"
+
+
+def next_run_time(cadence, at_time, after):
+    """
+    Вычисляет ближайший момент запуска подписки строго после указанного времени.
+
+    :param cadence: Периодичность подписки.
+    :param at_time: Время запуска "ЧЧ:ММ".
+    :param after: datetime, после которого ищется запуск.
+    :return: datetime следующего запуска.
+    """
+    hour, minute = (int(part) for part in at_time.split(':'))
+    if cadence == 'hourly':
+        candidate = after.replace(minute=minute, second=0, microsecond=0)
+        if candidate <= after:
+            candidate += timedelta(hours=1)
+        return candidate
+
+    candidate = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if candidate <= after:
+        candidate += timedelta(days=1)
+    if cadence == 'weekdays':
+        while candidate.weekday() >= 5: # Пропускаем субботу и воскресенье
+            candidate += timedelta(days=1)
+    return candidate
+
+
+# Планировщик регулярных сводок по подпискам
+class DigestScheduler:
+    def __init__(self, compute_summary, send_direct_message, db_path=DIGEST_DB,
+                 concurrency=DIGEST_CONCURRENCY, freshness=DIGEST_FRESHNESS, limit=DIGEST_LIMIT, tick=DIGEST_TICK,
+                 executor=None):
+        """
+        Конструктор класса DigestScheduler.
+        Хранит подписки и готовые сводки в SQLite, по расписанию заранее
+        рассчитывает сводки (не более concurrency одновременно) и рассылает их в ЛС.
+
+        :param compute_summary: Функция (room_name, limit, prompt_name) -> (текст сводки, количество сообщений) или None.
+        :param send_direct_message: Функция (username, text) для отправки ЛС.
+        :param db_path: Путь к файлу базы SQLite.
+        :param concurrency: Максимальное количество одновременно рассчитываемых сводок.
+        :param freshness: Время в секундах, в течение которого готовая сводка считается свежей.
+        :param limit: Количество сообщений, анализируемых для регулярной сводки.
+        :param tick: Интервал проверки расписания в секундах.
+        :param executor: Общий пул расчёта сводок (несколько арендаторов); если не задан, создаётся свой
+            на concurrency потоков и останавливается вместе с планировщиком.
+        """
+        self.compute_summary = compute_summary
+        self.send_direct_message = send_direct_message
+        self.db_path = db_path
+        self.freshness = freshness
+        self.limit = limit
+        self.tick = tick
+        self.owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='digest')
+        self.in_progress = set() # Ключи (комната, промпт), которые сейчас рассчитываются
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with closing(self._connect()) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS subscriptions (
+                    username TEXT NOT NULL,
+                    room_name TEXT NOT NULL,
+                    cadence TEXT NOT NULL,
+                    at_time TEXT NOT NULL,
+                    prompt_name TEXT NOT NULL,
+                    next_run REAL NOT NULL,
+                    PRIMARY KEY (username, room_name)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS digests (
+                    room_name TEXT NOT NULL,
+                    prompt_name TEXT NOT NULL,
+                    summary TEXT NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (room_name, prompt_name)
+                )
+            """)
+
+    def _connect(self):
+        """
+        Открывает новое соединение с базой подписок.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def subscribe(self, username, room_name, cadence, at_time, prompt_name):
+        """
+        Создаёт или обновляет подписку пользователя на регулярную сводку комнаты.
+
+        :return: datetime первого запуска.
+        :raises ValueError: Если расписание задано неверно.
+        """
+        cadence, at_time = parse_schedule(cadence, at_time)
+        next_run = next_run_time(cadence, at_time, datetime.now())
+        with self.lock, closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO subscriptions VALUES (?, ?, ?, ?, ?, ?)",
+                (username, room_name.lower(), cadence, at_time, prompt_name, next_run.timestamp())
+            )
+        logger.info(f"Подписка {username} на #{room_name}: {cadence} {at_time}")
+        return next_run
+
+    def unsubscribe(self, username, room_name):
+        """
+        Удаляет подписку пользователя.
+
+        :return: True, если подписка существовала.
+        """
+        with self.lock, closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "DELETE FROM subscriptions WHERE username = ? AND room_name = ?",
+                (username, room_name.lower())
+            )
+            return cursor.rowcount > 0
+
+    def list_subscriptions(self, username=None):
+        """
+        Возвращает подписки пользователя (или все, если пользователь не указан).
+
+        :return: Список словарей подписок.
+        """
+        with closing(self._connect()) as conn:
+            if username:
+                rows = conn.execute("SELECT * FROM subscriptions WHERE username = ? ORDER BY room_name", (username,)).fetchall()
+            else:
+                rows = conn.execute("SELECT * FROM subscriptions ORDER BY username, room_name").fetchall()
+        return [dict(row) for row in rows]
+
+    def get_fresh_digest(self, room_name, prompt_name):
+        """
+        Возвращает заранее рассчитанную сводку, если она ещё свежая.
+
+        :return: Словарь с ключами summary, message_count, created_at или None.
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT * FROM digests WHERE room_name = ? AND prompt_name = ? AND created_at >= ?",
+                (room_name.lower(), prompt_name, time.time() - self.freshness)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def _store_digest(self, room_name, prompt_name, summary, message_count):
+        """
+        Сохраняет рассчитанную сводку.
+        """
+        with self.lock, closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)",
+                (room_name, prompt_name, summary, message_count, time.time())
+            )
+
+    def start(self):
+        """
+        Запускает фоновый поток проверки расписания.
+        """
+        self.thread = threading.Thread(target=self._run, name='digest-scheduler', daemon=True)
+        self.thread.start()
+        logger.info(f"Планировщик сводок запущен, подписок: {len(self.list_subscriptions())}")
+
+    def stop(self, timeout=None):
+        """
+        Останавливает планировщик. Уже начатые расчёты сводок не прерываются.
+        """
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout)
+        if self.owns_executor:
+            self.executor.shutdown(wait=False)
+
+    def _run(self):
+        """
+        Основной цикл планировщика.
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.run_due()
+            except Exception as e:
+                logger.error(f"Ошибка планировщика сводок: {e}")
+            self.stop_event.wait(self.tick)
+
+    def run_due(self):
+        """
+        Находит подписки, время которых наступило, сдвигает их следующий запуск
+        и ставит расчёт сводок в пул. Подписчики одной комнаты с одним промптом
+        получают одну общую сводку. Подписки комнаты, сводка которой ещё рассчитывается,
+        остаются в ожидании и запускаются на следующей проверке (свежей сводкой из базы).
+        """
+        now = datetime.now()
+        with self.lock, closing(self._connect()) as conn:
+            due = [dict(row) for row in conn.execute(
+                "SELECT * FROM subscriptions WHERE next_run <= ?", (now.timestamp(),)
+            ).fetchall()]
+            groups = {}
+            for sub in due:
+                groups.setdefault((sub['room_name'], sub['prompt_name']), []).append(sub)
+            groups = {key: subs for key, subs in groups.items() if key not in self.in_progress}
+            self.in_progress.update(groups)
+            # Следующий запуск фиксируется сразу, чтобы подписка не сработала дважды
+            for subs in groups.values():
+                for sub in subs:
+                    next_run = next_run_time(sub['cadence'], sub['at_time'], now)
+                    conn.execute(
+                        "UPDATE subscriptions SET next_run = ? WHERE username = ? AND room_name = ?",
+                        (next_run.timestamp(), sub['username'], sub['room_name'])
+                    )
+
+        for key, subs in groups.items():
+            self.executor.submit(self._build_and_deliver, key[0], key[1], [sub['username'] for sub in subs])
+        return len(groups)
+
+    def _build_and_deliver(self, room_name, prompt_name, usernames):
+        """
+        Рассчитывает (или берёт свежую) сводку комнаты и рассылает её подписчикам.
+        """
+        try:
+            digest = self.get_fresh_digest(room_name, prompt_name)
+            if not digest:
+                started = time.time()
+                computed = self.compute_summary(room_name, self.limit, prompt_name)
+                if not computed:
+                    logger.warning(f"Не удалось рассчитать сводку для #{room_name}")
+                    return
+                summary, message_count = computed
+                self._store_digest(room_name, prompt_name, summary, message_count)
+                digest = {'summary': summary, 'message_count': message_count}
+                logger.info(f"Сводка для #{room_name} рассчитана за {time.time() - started:.1f} с")
+
+            text = f"🗓 **Регулярная сводка: #{room_name}**\n\n{digest['summary']}\n\n---\n*На основе анализа {digest['message_count']} сообщений*"
+            for username in usernames:
+                self.send_direct_message(username, text)
+        except Exception as e:
+            logger.error(f"Ошибка расчёта сводки для #{room_name}: {e}")
+        finally:
+            with self.lock:
+                self.in_progress.discard((room_name, prompt_name))
@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from src.config import *
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+
+# Быстрая полоса обработки команд: параллельно между пользователями, по порядку для одного пользователя
+class FastLane:
+    def __init__(self, workers=FAST_LANE_WORKERS):
+        """
+        Конструктор класса FastLane.
+        У каждого пользователя своя очередь команд. За один заход поток выполняет
+        одну команду пользователя и ставит его очередь в конец общей, поэтому
+        пользователь с десятком команд не задерживает остальных.
+
+        :param workers: Количество потоков.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='fast-lane')
+        self.queues = {} # Пользователь -> deque вызовов (функция, аргументы)
+        self.lock = threading.Lock()
+
+    def submit(self, key, fn, *args):
+        """
+        Ставит вызов в очередь пользователя.
+
+        :param key: Ключ очереди (имя пользователя).
+        :param fn: Функция.
+        :param args: Аргументы функции.
+        """
+        with self.lock:
+            pending = self.queues.get(key)
+            if pending is not None:
+                pending.append((fn, args)) # Очередь пользователя уже обслуживается
+                return
+            self.queues[key] = deque([(fn, args)])
+        self.executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        """
+        Выполняет одну команду пользователя и при необходимости возвращает его очередь в общую.
+        """
+        with self.lock:
+            fn, args = self.queues[key].popleft()
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.error(f"Ошибка в быстрой полосе для {key}: {e}")
+        with self.lock:
+            if self.queues[key]:
+                self.executor.submit(self._drain, key)
+            else:
+                del self.queues[key]
+
+    def size(self):
+        """
+        Возвращает количество команд, ожидающих выполнения.
+        """
+        with self.lock:
+            return sum(len(pending) for pending in self.queues.values())
+
+    def stop(self, timeout=None):
+        """
+        Дожидается выполнения принятых команд и останавливает потоки.
+
+        :param timeout: Максимальное время ожидания в секундах.
+        """
+        # Очередь пользователя перезапускает себя через executor, поэтому сначала ждём её опустошения
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self.queues: # Ключ удаляется только после выполнения последней команды пользователя
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.warning(f"Не выполнено команд при остановке: {self.size()}")
+                break
+            time.sleep(0.05)
+        self.executor.shutdown(wait=deadline is None)
@@ -0,0 +1,424 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from src.config import *
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+# Состояния задачи
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled' # Отменена пользователем или заменена более новой задачей
+
+
+# Персистентная очередь задач суммаризации на SQLite
+class SummaryJobQueue:
+    def __init__(self, db_path=JOB_QUEUE_DB, visibility_timeout=JOB_VISIBILITY_TIMEOUT, max_attempts=JOB_MAX_ATTEMPTS,
+                 user_concurrency=LLM_USER_CONCURRENCY):
+        """
+        Конструктор класса SummaryJobQueue.
+        Открывает (или создаёт) базу задач. Задачи переживают перезапуск процесса:
+        незавершённые задачи с истёкшей арендой снова выдаются воркерам. Время выдачи
+        (leased_at) служит токеном аренды: результат записывает только её текущий владелец.
+
+        :param db_path: Путь к файлу базы SQLite.
+        :param visibility_timeout: Время аренды задачи воркером в секундах.
+        :param max_attempts: Максимальное количество попыток выполнения задачи.
+        :param user_concurrency: Максимальное количество одновременно выполняемых задач одного пользователя
+            (0 — без ограничения). Совпадает с квотой одновременных запросов пользователя, чтобы
+            лишняя задача ждала в очереди, а не отклонялась квотой при выполнении.
+        """
+        self.db_path = db_path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.user_concurrency = user_concurrency
+        self.lock = threading.Lock() # Сериализация записи между потоками одного процесса
+
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with closing(self._connect()) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_until REAL,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            # Поля для справедливой выдачи и отмены задач (добавляются и в существующую базу)
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, definition in (('username', 'TEXT'), ('dedupe_key', 'TEXT'), ('leased_at', 'REAL'), ('tenant', 'TEXT')):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, lease_until)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_username ON jobs (username, status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_tenant ON jobs (tenant, status)")
+            # Время последней выдачи арендатору и пользователю для порядка в lease()
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_leased ON jobs (tenant, username, leased_at)")
+        logger.info(f"Очередь задач открыта: {self.db_path} ({self.stats()})")
+
+    def _connect(self):
+        """
+        Открывает новое соединение с базой (по одному на операцию, безопасно для потоков и процессов).
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL") # Читатели не блокируют писателей
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def enqueue(self, payload, kind='summary', dedupe_key=None):
+        """
+        Добавляет задачу в очередь.
+        Если указан ключ дедупликации, ожидающие задачи с тем же ключом заменяются новой,
+        а точная копия уже выполняющейся задачи не ставится вовсе.
+
+        :param payload: Словарь с параметрами задачи (сериализуется в JSON).
+        :param kind: Тип задачи.
+        :param dedupe_key: Ключ дедупликации (например, пользователь и комната).
+        :return: ID созданной задачи или None, если такая задача уже выполняется.
+        """
+        now = time.time()
+        data = json.dumps(payload, ensure_ascii=False)
+        with self.lock, closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                superseded = 0
+                if dedupe_key:
+                    duplicate = conn.execute(
+                        "SELECT id FROM jobs WHERE dedupe_key = ? AND status = ? AND lease_until >= ? AND payload = ?",
+                        (dedupe_key, STATUS_RUNNING, now, data)
+                    ).fetchone()
+                    if duplicate:
+                        conn.execute("COMMIT")
+                        logger.info(f"Задача {dedupe_key} уже выполняется ({duplicate['id']}), повтор отброшен")
+                        return None
+                    superseded = conn.execute(
+                        "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE dedupe_key = ? AND status = ?",
+                        (STATUS_CANCELLED, 'superseded', now, dedupe_key, STATUS_QUEUED)
+                    ).rowcount
+                cursor = conn.execute(
+                    """INSERT INTO jobs (kind, payload, status, username, tenant, dedupe_key, created_at, updated_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (kind, data, STATUS_QUEUED, payload.get('username'), payload.get('tenant'), dedupe_key, now, now)
+                )
+                job_id = cursor.lastrowid
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        if superseded:
+            logger.info(f"Задача {job_id} заменила ожидающих задач: {superseded}")
+        logger.info(f"Задача {job_id} ({kind}) поставлена в очередь")
+        return job_id
+
+    def cancel_queued(self, username, dedupe_key=None, tenant=None):
+        """
+        Отменяет ожидающие задачи пользователя.
+
+        :param username: Имя пользователя.
+        :param dedupe_key: Отменить только задачи с этим ключом.
+        :param tenant: Арендатор, к которому относится пользователь.
+        :return: Количество отменённых задач.
+        """
+        query = "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE username = ? AND tenant IS ? AND status = ?"
+        params = [STATUS_CANCELLED, 'cancelled', time.time(), username, tenant, STATUS_QUEUED]
+        if dedupe_key:
+            query += " AND dedupe_key = ?"
+            params.append(dedupe_key)
+        with self.lock, closing(self._connect()) as conn:
+            return conn.execute(query, params).rowcount
+
+    def lease(self):
+        """
+        Атомарно выдаёт следующую задачу воркеру.
+        Берутся задачи в состоянии queued, а также running с истёкшей арендой
+        (воркер упал или процесс был перезапущен). Задачи выдаются справедливо:
+        сначала арендаторам и пользователям без выполняющихся задач, затем тем, кого обслуживали давнее всего.
+        Пока арендатор один, порядок определяется только пользователями. Задачи пользователя,
+        у которого уже выполняется user_concurrency задач, ждут в очереди.
+        Задача с истёкшей арендой, попытки которой исчерпаны (воркер падает на ней), не выдаётся
+        снова, а помечается проваленной и возвращается со статусом failed, чтобы воркер сообщил о провале.
+
+        :return: Словарь задачи или None, если очередь пуста.
+        """
+        now = time.time()
+        with self.lock, closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE") # Блокировка на запись, чтобы два воркера не взяли одну задачу
+            try:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? AND lease_until < ? AND attempts >= ? LIMIT 1",
+                    (STATUS_RUNNING, now, self.max_attempts)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, lease_until = NULL, error = ?, updated_at = ? WHERE id = ?",
+                        (STATUS_FAILED, 'lease expired', now, row['id'])
+                    )
+                    conn.execute("COMMIT")
+                    logger.error(f"Задача {row['id']} провалена: аренда истекла после {row['attempts']} попыток")
+                    job = dict(row)
+                    job['payload'] = json.loads(job['payload'])
+                    job['status'] = STATUS_FAILED
+                    return job
+
+                row = conn.execute(
+                    """SELECT * FROM jobs AS j
+                       WHERE (j.status = ? OR (j.status = ? AND j.lease_until < ?))
+                         AND (? <= 0 OR (SELECT COUNT(*) FROM jobs AS r
+                                         WHERE r.tenant IS j.tenant AND r.username IS j.username
+                                           AND r.status = ? AND r.lease_until >= ?) < ?)
+                       ORDER BY
+                           (SELECT COUNT(*) FROM jobs AS r
+                            WHERE r.tenant IS j.tenant AND r.status = ? AND r.lease_until >= ?),
+                           (SELECT COUNT(*) FROM jobs AS r
+                            WHERE r.tenant IS j.tenant AND r.username IS j.username AND r.status = ? AND r.lease_until >= ?),
+                           (SELECT COALESCE(MAX(r.leased_at), 0) FROM jobs AS r WHERE r.tenant IS j.tenant),
+                           (SELECT COALESCE(MAX(r.leased_at), 0) FROM jobs AS r WHERE r.tenant IS j.tenant AND r.username IS j.username),
+                           j.id
+                       LIMIT 1""",
+                    (STATUS_QUEUED, STATUS_RUNNING, now, self.user_concurrency, STATUS_RUNNING, now, self.user_concurrency,
+                     STATUS_RUNNING, now, STATUS_RUNNING, now)
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, leased_at = ?, updated_at = ? WHERE id = ?",
+                    (STATUS_RUNNING, now + self.visibility_timeout, now, now, row['id'])
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['attempts'] += 1
+        job['status'] = STATUS_RUNNING
+        job['leased_at'] = now
+        return job
+
+    def renew(self, job_id, leased_at):
+        """
+        Продлевает аренду выполняющейся задачи (вызывается воркером, пока задача выполняется).
+
+        :param job_id: ID задачи.
+        :param leased_at: Токен аренды (поле leased_at задачи, выданной lease()).
+        :return: True, если аренда продлена; False, если задача уже выдана другому воркеру или завершена.
+        """
+        now = time.time()
+        with self.lock, closing(self._connect()) as conn:
+            return conn.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND status = ? AND leased_at = ?",
+                (now + self.visibility_timeout, now, job_id, STATUS_RUNNING, leased_at)
+            ).rowcount > 0
+
+    def complete(self, job_id, leased_at):
+        """
+        Отмечает задачу как успешно выполненную.
+
+        :param job_id: ID задачи.
+        :param leased_at: Токен аренды.
+        :return: True, если результат записан; False, если аренда потеряна.
+        """
+        if not self._set_status(job_id, leased_at, STATUS_DONE):
+            return False
+        logger.info(f"Задача {job_id} выполнена")
+        return True
+
+    def fail(self, job_id, error, attempts, leased_at):
+        """
+        Отмечает неудачную попытку. Если попытки не исчерпаны, задача возвращается в очередь.
+
+        :param job_id: ID задачи.
+        :param error: Текст ошибки.
+        :param attempts: Количество уже сделанных попыток.
+        :param leased_at: Токен аренды.
+        :return: True, если задача окончательно провалена.
+        """
+        final = attempts >= self.max_attempts
+        if not self._set_status(job_id, leased_at, STATUS_FAILED if final else STATUS_QUEUED, error=str(error)):
+            return False
+        if final:
+            logger.error(f"Задача {job_id} провалена после {attempts} попыток: {error}")
+        else:
+            logger.warning(f"Задача {job_id} будет повторена (попытка {attempts}): {error}")
+        return final
+
+    def _set_status(self, job_id, leased_at, status, error=None):
+        """
+        Меняет состояние задачи и снимает аренду, если аренда всё ещё принадлежит вызывающему.
+
+        :return: True, если состояние изменено.
+        """
+        with self.lock, closing(self._connect()) as conn:
+            changed = conn.execute(
+                """UPDATE jobs SET status = ?, lease_until = NULL, error = ?, updated_at = ?
+                   WHERE id = ? AND status = ? AND leased_at = ?""",
+                (status, error, time.time(), job_id, STATUS_RUNNING, leased_at)
+            ).rowcount > 0
+        if not changed:
+            logger.warning(f"Задача {job_id}: аренда потеряна (задача выдана другому воркеру или отменена), результат не записан")
+        return changed
+
+    def stats(self):
+        """
+        Возвращает количество задач в каждом состоянии.
+
+        :return: Словарь {состояние: количество}.
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def purge_finished(self, older_than=JOB_RETENTION):
+        """
+        Удаляет давно завершённые задачи, чтобы база не росла бесконечно.
+
+        :param older_than: Возраст задачи в секундах.
+        :return: Количество удалённых задач.
+        """
+        with self.lock, closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?, ?) AND updated_at < ?",
+                (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED, time.time() - older_than)
+            )
+            return cursor.rowcount
+
+
+# Пул потоков-воркеров, разбирающих очередь задач
+class JobWorkerPool:
+    def __init__(self, job_queue, handler, on_failure=None, workers=JOB_WORKERS, poll_interval=1.0,
+                 purge_interval=JOB_PURGE_INTERVAL):
+        """
+        Конструктор класса JobWorkerPool.
+
+        :param job_queue: Экземпляр SummaryJobQueue.
+        :param handler: Функция, принимающая payload задачи, или словарь {тип задачи: функция}.
+            Исключение означает неудачную попытку.
+        :param on_failure: Функция (payload, error), вызываемая, когда попытки задачи исчерпаны.
+        :param workers: Количество потоков-воркеров.
+        :param poll_interval: Пауза между проверками пустой очереди в секундах.
+        :param purge_interval: Интервал удаления давно завершённых задач в секундах.
+        """
+        self.job_queue = job_queue
+        self.handler = handler
+        self.on_failure = on_failure
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        self.purge_interval = purge_interval
+        self.heartbeat_interval = job_queue.visibility_timeout / 3 # Период продления аренды выполняющейся задачи
+        self.next_purge = 0.0 # Время следующей очистки (monotonic)
+        self.purge_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def start(self):
+        """
+        Запускает потоки-воркеры.
+        """
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"Запущено воркеров очереди: {self.workers}")
+
+    def stop(self, timeout=None):
+        """
+        Останавливает воркеры. Задача, выполняемая в момент остановки, будет
+        выдана повторно после истечения аренды.
+
+        :param timeout: Максимальное время ожидания каждого потока в секундах.
+        """
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def _run(self):
+        """
+        Основной цикл воркера: взять задачу, выполнить, отметить результат.
+        """
+        while not self.stop_event.is_set():
+            self._purge_if_due()
+            try:
+                job = self.job_queue.lease()
+            except Exception as e:
+                logger.error(f"Ошибка получения задачи из очереди: {e}")
+                job = None
+
+            if job is None:
+                self.stop_event.wait(self.poll_interval)
+                continue
+            if job['status'] == STATUS_FAILED: # Попытки исчерпаны падениями воркеров
+                self._notify_failed(job, RuntimeError("аренда задачи истекла"))
+                continue
+
+            # Пока задача выполняется, аренда продлевается: долгая сводка не должна достаться второму воркеру
+            heartbeat_stop = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat, args=(job, heartbeat_stop),
+                                         name=f"job-heartbeat-{job['id']}", daemon=True)
+            heartbeat.start()
+            try:
+                handler = self.handler.get(job['kind']) if isinstance(self.handler, dict) else self.handler
+                if handler is None:
+                    raise ValueError(f"Нет обработчика для задач типа '{job['kind']}'")
+                handler(job['payload'])
+                heartbeat_stop.set()
+                self.job_queue.complete(job['id'], job['leased_at'])
+            except Exception as e:
+                heartbeat_stop.set()
+                if self.job_queue.fail(job['id'], e, job['attempts'], job['leased_at']):
+                    self._notify_failed(job, e)
+
+    def _heartbeat(self, job, stop_event):
+        """
+        Продлевает аренду задачи каждые heartbeat_interval секунд, пока не установлен stop_event.
+        """
+        while not stop_event.wait(self.heartbeat_interval):
+            try:
+                if not self.job_queue.renew(job['id'], job['leased_at']):
+                    logger.warning(f"Аренда задачи {job['id']} не продлена: задача выдана другому воркеру или отменена")
+                    return
+            except Exception as e:
+                logger.error(f"Ошибка продления аренды задачи {job['id']}: {e}")
+
+    def _notify_failed(self, job, error):
+        """
+        Вызывает on_failure для окончательно проваленной задачи.
+        """
+        if self.on_failure:
+            try:
+                self.on_failure(job['payload'], error)
+            except Exception as callback_error:
+                logger.error(f"Ошибка обработчика провала задачи {job['id']}: {callback_error}")
+
+    def _purge_if_due(self):
+        """
+        Раз в purge_interval удаляет давно завершённые задачи (выполняет один из воркеров).
+        """
+        with self.purge_lock:
+            now = time.monotonic()
+            if now < self.next_purge:
+                return
+            self.next_purge = now + self.purge_interval
+        try:
+            purged = self.job_queue.purge_finished()
+            if purged:
+                logger.info(f"Удалено завершённых задач: {purged}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки очереди задач: {e}")
@@ -0,0 +1,12 @@
+def percentile(values, p):
+    """
+    Возвращает p-й перцентиль отсортированного списка.
+
+    :param values: Отсортированный по возрастанию список значений.
+    :param p: Перцентиль от 0 до 100.
+    :return: Значение перцентиля или 0.0 для пустого списка.
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
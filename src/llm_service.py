@@ -1,14 +1,44 @@
+import importlib
 import requests
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from src.config import *
-from src.prompts.rick_and_morty_prompt import get_rick_and_morty_prompt, RICK_AND_MORTY_RESPONSES, RICK_AND_MORTY_SETTINGS
-from src.prompts.george_carlin_prompt import get_george_carlin_prompt, GEORGE_CARLIN_RESPONSES, GEORGE_CARLIN_SETTINGS
-from src.prompts.get_quentin_tarantino_prompt import get_quentin_tarantino_prompt, TARANTINO_RESPONSES, TARANTINO_SETTINGS
-from src.prompts.get_neutral_professional_prompt import get_neutral_professional_prompt, NEUTRAL_RESPONSES, PROF_SETTINGS
+from src.preprocessing import MessagePreprocessor, estimate_tokens
+from src.salience import select_salient
+from src.summary_cache import MODE_REUSE
+from src.usage_meter import QuotaExceededError
 
 # Настройка логирования для данного модуля
 logger = logging.getLogger(__name__)
 
+# Запрос к LLM отменён пользователем
+class RequestCancelledError(Exception):
+    pass
+
+
+# Сводка не получена (лимит запросов, таймаут, ошибка API); текст исключения — ответ промпта для пользователя
+class SummaryFailedError(Exception):
+    pass
+
+
+# Промпты загружаются по требованию: имя -> (модуль, функция-генератор, ответы, настройки)
+PROMPT_MODULES = {
+    'rick_and_morty': ('src.prompts.rick_and_morty_prompt', 'get_rick_and_morty_prompt', 'RICK_AND_MORTY_RESPONSES', 'RICK_AND_MORTY_SETTINGS'),
+    'george_carlin': ('src.prompts.george_carlin_prompt', 'get_george_carlin_prompt', 'GEORGE_CARLIN_RESPONSES', 'GEORGE_CARLIN_SETTINGS'),
+    'quentin_tarantino': ('src.prompts.get_quentin_tarantino_prompt', 'get_quentin_tarantino_prompt', 'TARANTINO_RESPONSES', 'TARANTINO_SETTINGS'),
+    'prof': ('src.prompts.get_neutral_professional_prompt', 'get_neutral_professional_prompt', 'NEUTRAL_RESPONSES', 'PROF_SETTINGS')
+    # Добавьте другие промпты здесь
+}
+
+# Дописывается к промпту при дельта-обновлении: модели передаются только новые строки и прошлая сводка
+DELTA_INSTRUCTION = (
+    "\n\nВыше только сообщения, появившиеся после прошлой сводки этой беседы. "
+    "Обнови прошлую сводку с их учётом, сохранив её стиль и формат, и верни сводку целиком.\n"
+    "Прошлая сводка:\n{summary}"
+)
+
 # Класс для взаимодействия с Large Language Models (LLM)
 class LLMService:
     def __init__(self, default_prompt='prof'):
@@ -18,31 +48,19 @@ class LLMService:
         :param default_prompt: Имя промпта по умолчанию.
         """
         logger.info(f"Инициализация LLM сервиса с промптом: {default_prompt}...")
-        # Словарь функций, генерирующих промпты
-        self.prompts = {
-            'rick_and_morty': get_rick_and_morty_prompt,
-            'george_carlin': get_george_carlin_prompt,
-            'quentin_tarantino': get_quentin_tarantino_prompt,
-            'prof': get_neutral_professional_prompt
-            # Добавьте другие промпты здесь
-        }
-        # Словарь предварительно заданных ответов для разных промптов
-        self.responses = {
-            'rick_and_morty': RICK_AND_MORTY_RESPONSES,
-            'george_carlin': GEORGE_CARLIN_RESPONSES,
-            'quentin_tarantino': TARANTINO_RESPONSES,
-            'prof': NEUTRAL_RESPONSES
-        }
-        # Словарь настроек для разных промптов (например, temperature)
-        self.settings = {
-            'rick_and_morty': RICK_AND_MORTY_SETTINGS,
-            'george_carlin': GEORGE_CARLIN_SETTINGS,
-            'quentin_tarantino': TARANTINO_SETTINGS,
-            'prof': PROF_SETTINGS
-        }
+        self.prompts = PROMPT_MODULES # Доступные промпты (модули импортируются при первом использовании)
+        self.loaded_prompts = {} # Имя промпта -> (генератор, ответы, настройки)
+        self.load_lock = threading.Lock()
         self.current_prompt_name = None # Текущее имя активного промпта
         self.current_responses = None # Текущие предварительно заданные ответы
         self.current_settings = None # Текущие настройки промпта
+        self.preprocessor = MessagePreprocessor() # Сокращение сообщений перед построением промпта
+        self.usage_meter = None # Учёт использования и квоты (UsageMeter), если подключены
+        self.summary_cache = None # Кэш сводок похожих бесед (SummaryCache), если подключён
+        self.model_router = None # Выбор модели по размеру беседы (ModelRouter), если подключён
+        # Потоки для отменяемых запросов: при отмене воркер сразу освобождается,
+        # а брошенный HTTP-запрос завершается здесь и его результат отбрасывается
+        self.http_executor = ThreadPoolExecutor(max_workers=max(4, JOB_WORKERS * 2), thread_name_prefix='llm-http')
         self.set_prompt(default_prompt) # Установка промпта по умолчанию
 
     def set_prompt(self, prompt_name):
@@ -53,61 +71,92 @@ class LLMService:
         :return: True, если промпт успешно установлен, False в противном случае.
         """
         if prompt_name in self.prompts: # Проверяем, существует ли промпт с таким именем
-            self.current_prompt_generator = self.prompts[prompt_name] # Устанавливаем функцию-генератор промпта
+            generator, responses, settings = self.load_prompt(prompt_name)
+            self.current_prompt_generator = generator # Устанавливаем функцию-генератор промпта
             self.current_prompt_name = prompt_name # Обновляем имя активного промпта
-            self.current_responses = self.responses[prompt_name] # Обновляем текущие ответы
-            self.current_settings = self.settings[prompt_name] # Обновляем текущие настройки
+            self.current_responses = responses # Обновляем текущие ответы
+            self.current_settings = settings # Обновляем текущие настройки
             logger.info(f"Активный промпт установлен на: {prompt_name}")
             return True
         else:
             logger.warning(f"Промпт '{prompt_name}' не найден. Использование промпта по умолчанию ('prof').")
             return False
 
-    def summarize_with_llm(self, messages_text, bot_username, prompt_name=None):
+    def load_prompt(self, prompt_name):
+        """
+        Импортирует модуль промпта при первом обращении и кэширует его содержимое.
+
+        :param prompt_name: Имя промпта из PROMPT_MODULES.
+        :return: Кортеж (функция-генератор, ответы, настройки).
+        """
+        loaded = self.loaded_prompts.get(prompt_name)
+        if loaded:
+            return loaded
+        with self.load_lock:
+            if prompt_name not in self.loaded_prompts:
+                module_name, generator, responses, settings = self.prompts[prompt_name]
+                module = importlib.import_module(module_name)
+                self.loaded_prompts[prompt_name] = (getattr(module, generator), getattr(module, responses), getattr(module, settings))
+                logger.debug(f"Загружен модуль промпта: {module_name}")
+            return self.loaded_prompts[prompt_name]
+
+    def summarize_with_llm(self, messages_text, bot_username, prompt_name=None, username=None, room_name=None, cancel_event=None, fanout=False, strict=False):
         """
         Суммаризирует сообщения чата с использованием выбранной LLM и промпта.
         
         :param messages_text: Список сообщений для суммаризации.
         :param bot_username: Имя пользователя бота (для исключения его сообщений).
         :param prompt_name: Имя промпта, который нужно использовать для суммаризации (если отличается от текущего).
+        :param username: Пользователь, запросивший суммаризацию (для учёта и квот).
+        :param room_name: Суммаризируемая комната (для учёта и квот).
+        :param cancel_event: threading.Event, установка которого прерывает ожидание ответа LLM.
+        :param fanout: Запрос — часть сводки нескольких комнат (слот пользователя уже занят).
+        :param strict: При неудаче вызывать SummaryFailedError вместо возврата сообщения об ошибке
+            (для сводок, которые сохраняются и рассылаются повторно).
         :return: Суммаризированный текст или сообщение об ошибке.
+        :raises QuotaExceededError: Если квота пользователя или комнаты исчерпана (LLM не вызывается).
+        :raises RequestCancelledError: Если запрос отменён через cancel_event.
+        :raises SummaryFailedError: Если strict и сводку получить не удалось.
         """
-        try:
-            # Если указан другой промпт, пытаемся его установить
-            if prompt_name and prompt_name != self.current_prompt_name:
-                if not self.set_prompt(prompt_name):
-                    # Откат к текущему промпту, если новый не найден
-                    logger.warning(f"Не удалось установить промпт '{prompt_name}'. Использование текущего промпта '{self.current_prompt_name}'.")
+        # Промпт, ответы и настройки берутся локально, без изменения общего состояния:
+        # метод вызывается параллельно из нескольких воркеров очереди задач
+        if prompt_name and prompt_name not in self.prompts:
+            logger.warning(f"Промпт '{prompt_name}' не найден. Использование текущего промпта '{self.current_prompt_name}'.")
+            prompt_name = None
+        prompt_name = prompt_name or self.current_prompt_name
+        prompt_generator, responses, settings = self.load_prompt(prompt_name)
 
-            logger.info(f"Начало суммаризации с промптом '{self.current_prompt_name}'...")
+        try:
+            logger.info(f"Начало суммаризации с промптом '{prompt_name}'...")
 
             if not messages_text:
-                return self.current_responses.get("empty_messages_text", "Ничего нет. Абсолютно.") # Ответ, если нет сообщений
-
-            participants = set() # Множество участников беседы
-            lines = [] # Список обработанных строк сообщений
-
-            # Обработка сообщений: собираем текст и участников
-            for msg in reversed(messages_text): # Обрабатываем сообщения в обратном порядке (от старых к новым)
-                username = msg.get('username') or msg.get('u', {}).get('username') # Извлекаем имя пользователя
-                if not username or username == bot_username: # Игнорируем сообщения от бота
-                    continue
+                return responses.get("empty_messages_text", "Ничего нет. Абсолютно.") # Ответ, если нет сообщений
 
-                participants.add(username) # Добавляем участника
-                text = msg.get('msg', '').strip() # Извлекаем текст сообщения
-                if text:
-                    lines.append(f"@{username}: {text}") # Формируем строку "Пользователь: Текст"
+            # Потоковая предобработка: цитаты, код, ссылки, повторы, склейка сообщений одного автора
+            lines, report = self.preprocessor.format_lines(reversed(messages_text), bot_username) # От старых к новым
+            lines = list(lines)
+            logger.info(f"Предобработка сообщений: {report}")
 
             if not lines:
-                return self.current_responses.get("only_bot_messages", "Только автоматические сообщения. Ничего интересного.") # Ответ, если остались только сообщения бота
+                return responses.get("only_bot_messages", "Только автоматические сообщения. Ничего интересного.") # Ответ, если остались только сообщения бота
 
-            conversation = "\n".join(lines) # Объединяем все строки в одну беседу
-            # Обрезаем беседу, если она слишком длинная, чтобы избежать превышения лимитов токенов
-            if len(conversation) > 18000:
-                conversation = conversation[-17500:] + "\n\n...а до этого была целая простыня бреда, поверь мне на слово."
+            # Почти такая же беседа уже суммаризирована: отдаём готовую сводку или дополняем её новыми строками
+            cache = self.summary_cache if room_name else None
+            match = cache.lookup(room_name, prompt_name, lines) if cache else None
+            if match and match.mode == MODE_REUSE:
+                return match.summary + responses.get("summary_suffix", "")
+            prompt_lines = match.new_lines if match else lines
+
+            conversation = "\n".join(prompt_lines) # Объединяем все строки в одну беседу
+            # Если беседа не помещается в бюджет, оставляем самые значимые сообщения (решения, упоминания, числа, ссылки),
+            # а не просто хвост переписки
+            if len(conversation) > SUMMARY_MAX_CHARS:
+                conversation = "\n".join(select_salient(prompt_lines, SUMMARY_MAX_CHARS - 100)) + "\n\n...а между строками была целая простыня бреда, поверь мне на слово."
 
             # Используем вынесенный промпт для генерации запроса к LLM
-            prompt = self.current_prompt_generator(conversation)
+            prompt = prompt_generator(conversation)
+            if match:
+                prompt += DELTA_INSTRUCTION.format(summary=match.summary)
 
             # Параметры HTTP-запроса к API LLM
             url = f"{OPEN_AI_BASE_URL}{OPEN_AI_COMPLETIONS_PATHNAME}"
@@ -116,27 +165,131 @@ class LLMService:
                 "Content-Type": "application/json"
             }
 
-            data = {
-                "model": LLM_NAME, # Используемая модель LLM
-                "messages": [{"role": "user", "content": prompt}], # Сообщения для модели (наш промпт)
-                "max_tokens": MAX_TOKENS, # Максимальное количество токенов в ответе
-                "temperature": self.current_settings.get("temperature", TEMPERATURE) # Температура генерации (креативность)
-            }
+            # Модель, длина ответа и таймаут выбираются по размеру беседы и настройкам промпта
+            router = self.model_router
+            conversation_tokens = estimate_tokens(conversation) + (estimate_tokens(match.summary) if match else 0)
+            route = router.choose(conversation_tokens, settings) if router else None
 
-            response = requests.post(url, headers=headers, json=data, timeout=180) # Отправляем запрос
+            if cancel_event and cancel_event.is_set():
+                raise RequestCancelledError(f"Суммаризация #{room_name} отменена")
+            usage = self.usage_meter
+            if usage:
+                usage.acquire(username, room_name, fanout) # При исчерпанной квоте запрос к LLM не отправляется
+            outcome, prompt_tokens, completion_tokens = 'error', 0, 0
+            started = time.perf_counter()
+            try:
+                while True:
+                    data = {
+                        "model": route.model if route else LLM_NAME, # Используемая модель LLM
+                        "messages": [{"role": "user", "content": prompt}], # Сообщения для модели (наш промпт)
+                        "max_tokens": route.max_tokens if route else settings.get("max_tokens", MAX_TOKENS), # Максимальное количество токенов в ответе
+                        "temperature": settings.get("temperature", TEMPERATURE) # Температура генерации (креативность)
+                    }
+                    attempt_started = time.perf_counter()
+                    try:
+                        response = self._post(url, headers, data, cancel_event, route.timeout if route else LLM_TIMEOUT) # Отправляем запрос
+                    except requests.exceptions.Timeout:
+                        if not (route and route.fallback):
+                            if route:
+                                router.record(route, estimate_tokens(prompt), 0, time.perf_counter() - attempt_started, 'timeout')
+                            raise
+                        response = None # Малая модель не успела — повторяем на основной
 
-            # Обработка ответа от API LLM
-            if response.status_code == 200:
-                summary = response.json()['choices'][0]['message']['content'].strip() # Извлекаем суммаризацию
-                return summary + self.current_responses.get("summary_suffix", "") # Добавляем суффикс, если есть
+                    summary, tokens, failure = self._read_completion(response)
+                    attempt_prompt_tokens = tokens.get('prompt_tokens', estimate_tokens(prompt)) # Фактический расход, если API его сообщает
+                    attempt_completion_tokens = tokens.get('completion_tokens', estimate_tokens(summary or ''))
+                    prompt_tokens += attempt_prompt_tokens
+                    completion_tokens += attempt_completion_tokens
+                    escalate = bool(failure and route and route.fallback)
+                    if route:
+                        router.record(route, attempt_prompt_tokens, attempt_completion_tokens,
+                                      time.perf_counter() - attempt_started, failure, escalate)
+                    if not escalate:
+                        break
+                    route = route.fallback
 
-            elif response.status_code == 429: # Если превышен лимит запросов
-                return self.current_responses.get("too_many_requests", "Слишком много запросов. Попробуйте позже.")
-            else: # Другие ошибки API
-                return self.current_responses.get("api_error", "Произошла ошибка: код {status_code}.").format(status_code=response.status_code)
+                # Обработка ответа от API LLM
+                if response.status_code == 200:
+                    if summary is None:
+                        raise ValueError("Некорректный ответ API LLM")
+                    if not summary: # Пустой ответ без возможности эскалации — ошибка, а не сводка
+                        logger.warning(f"LLM вернула пустой ответ для #{room_name or '-'}")
+                        raise SummaryFailedError(responses.get("generic_exception", "Произошла внутренняя ошибка."))
+                    outcome = 'ok'
+                    if cache:
+                        cache.store(room_name, prompt_name, lines, summary)
+                    return summary + responses.get("summary_suffix", "") # Добавляем суффикс, если есть
+
+                elif response.status_code == 429: # Если превышен лимит запросов
+                    outcome = 'rate_limited'
+                    raise SummaryFailedError(responses.get("too_many_requests", "Слишком много запросов. Попробуйте позже."))
+                else: # Другие ошибки API
+                    outcome = 'api_error'
+                    raise SummaryFailedError(responses.get("api_error", "Произошла ошибка: код {status_code}.").format(status_code=response.status_code))
+            except requests.exceptions.Timeout:
+                outcome = 'timeout'
+                raise
+            except RequestCancelledError:
+                outcome = 'cancelled'
+                raise
+            finally:
+                if usage:
+                    usage.release(username, room_name, prompt_name, prompt_tokens or estimate_tokens(prompt), completion_tokens,
+                                  time.perf_counter() - started, outcome, fanout)
 
         except requests.exceptions.Timeout: # Обработка исключения таймаута
-            return self.current_responses.get("timeout", "Превышено время ожидания ответа от LLM.")
+            error = SummaryFailedError(responses.get("timeout", "Превышено время ожидания ответа от LLM."))
+        except (QuotaExceededError, RequestCancelledError):
+            raise # Обрабатывается вызывающим кодом: пользователю уходит отдельное сообщение
+        except SummaryFailedError as e:
+            error = e
         except Exception as e: # Общая обработка других исключений
             logger.error(f"Ошибка в summarize_with_llm: {e}")
-            return self.current_responses.get("generic_exception", "Произошла внутренняя ошибка.")
+            error = SummaryFailedError(responses.get("generic_exception", "Произошла внутренняя ошибка."))
+        if strict:
+            raise error # Текст ошибки не должен сохраниться как сводка
+        return str(error)
+
+    @staticmethod
+    def _read_completion(response):
+        """
+        Извлекает сводку и расход токенов из ответа API LLM.
+
+        :param response: Ответ API или None, если запрос не дождался ответа.
+        :return: Кортеж (сводка или None, если ответ не разобран; словарь usage; причина неудачи или None).
+            Неудачей считаются таймаут, код ответа не 200, некорректный, пустой и обрезанный по max_tokens ответ.
+        """
+        if response is None:
+            return None, {}, 'timeout'
+        if response.status_code != 200:
+            return None, {}, f"HTTP {response.status_code}"
+        try:
+            body = response.json()
+            choice = body['choices'][0]
+            summary = choice['message']['content'].strip() # Извлекаем суммаризацию
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+            return None, {}, 'invalid'
+        tokens = body.get('usage') or {}
+        if not summary:
+            return summary, tokens, 'empty'
+        if choice.get('finish_reason') == 'length':
+            return summary, tokens, 'truncated'
+        return summary, tokens, None
+
+    def _post(self, url, headers, data, cancel_event=None, timeout=LLM_TIMEOUT):
+        """
+        Отправляет запрос к API LLM. Если передан cancel_event, ожидание ответа
+        можно прервать из другого потока.
+
+        :param timeout: Таймаут HTTP-запроса в секундах.
+        :raises RequestCancelledError: Если запрос отменён.
+        """
+        if cancel_event is None:
+            return requests.post(url, headers=headers, json=data, timeout=timeout)
+
+        future = self.http_executor.submit(requests.post, url, headers=headers, json=data, timeout=timeout)
+        while not wait([future], timeout=0.2).done:
+            if cancel_event.is_set():
+                future.cancel() # Если запрос ещё не начат, он не будет отправлен
+                raise RequestCancelledError("Запрос к LLM отменён")
+        return future.result()
@@ -1,49 +1,113 @@
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+from src.config import *
+from src.llm_service import RequestCancelledError, SummaryFailedError
+from src.usage_meter import QuotaExceededError
+from src.model_router import ROUTE_SMALL, ROUTE_LARGE
 
 # Настройка логирования для данного модуля
 logger = logging.getLogger(__name__)
 
 # Класс для обработки входящих сообщений
 class MessageHandler:
-    def __init__(self, chatbot, llm_service):
+    def __init__(self, chatbot, llm_service, job_queue=None, digest_scheduler=None, fast_lane=None,
+                 tenant=None, admins=None, default_prompt=None):
         """
         Конструктор класса MessageHandler.
         
         :param chatbot: Экземпляр RocketChatBot для взаимодействия с Rocket.Chat.
         :param llm_service: Экземпляр LLMService для взаимодействия с языковой моделью.
+        :param job_queue: Экземпляр SummaryJobQueue. Если не задан, суммаризация выполняется синхронно.
+        :param digest_scheduler: Экземпляр DigestScheduler для подписок на регулярные сводки.
+        :param fast_lane: Экземпляр FastLane для выполнения команд. Если не задан, команды выполняются в потоке приёма.
+        :param tenant: Имя арендатора, если в процессе работают несколько ботов (общие очередь, квоты и кэши
+            разделяются по нему).
+        :param admins: Администраторы бота (по умолчанию BOT_ADMINS).
+        :param default_prompt: Промпт по умолчанию (по умолчанию текущий промпт LLMService).
         """
         self.chatbot = chatbot # Объект бота Rocket.Chat
         self.llm_service = llm_service # Объект сервиса языковой модели
+        self.job_queue = job_queue # Персистентная очередь задач суммаризации
+        self.digest_scheduler = digest_scheduler # Планировщик регулярных сводок
+        self.fast_lane = fast_lane # Быстрая полоса для мгновенных команд
+        self.running_jobs = {} # (пользователь, комната) -> threading.Event отмены выполняющейся суммаризации
+        self.running_lock = threading.Lock()
+        self.tenant = tenant # Арендатор (None — единственный бот в процессе)
+        self.admins = BOT_ADMINS if admins is None else admins # Администраторы бота
         # TODO: Это должно быть привязано к пользователю, а не глобально
-        self.current_prompt = self.llm_service.current_prompt_name # Текущий активный промпт (пока что один для всех)
+        self.current_prompt = default_prompt or self.llm_service.current_prompt_name # Текущий активный промпт (пока что один для всех)
         logger.info("Инициализация обработчика сообщений...")
 
-    def process_direct_message(self, message):
+    def process_direct_message(self, message, on_done=None, deduplicate=True):
         """
         Обрабатывает входящие личные сообщения (Direct Messages).
         
-        :param message: Словарь, содержащий данные сообщения.
+        :param message: Запись ChatMessage с данными сообщения.
+        :param on_done: Функция без аргументов, вызываемая после выполнения команды (или отбрасывания
+            сообщения); для подтверждения приёма источником сообщений.
+        :param deduplicate: Отбрасывать сообщения из processed_messages (источник может отслеживать
+            выполненные сообщения сам, надёжнее, чем периодически сохраняемый processed_messages).
         """
+        deferred = False # Команда выполнится в быстрой полосе, on_done вызовет она
         try:
-            text = message.get('msg', '').strip() # Извлекаем текст сообщения, удаляя пробелы по краям
-            username = message.get('_room_user', 'Unknown') # Имя пользователя, отправившего сообщение
-            message_id = message.get('_id') # ID сообщения
-            sender_username = message.get('username', 'Unknown') # Имя отправителя сообщения
+            text = message.text # Текст сообщения (пробелы по краям удалены при разборе)
+            username = message.room_user or 'Unknown' # Имя пользователя, отправившего сообщение
+            message_id = message.id # ID сообщения
+            sender_username = message.username or 'Unknown' # Имя отправителя сообщения
 
             # Игнорируем сообщения от самого бота, пустые имена пользователей или уже обработанные сообщения
             if (sender_username == self.chatbot.bot_username or 
                 username == self.chatbot.bot_username or 
                 not username or 
                 username == 'Unknown' or
-                message_id in self.chatbot.processed_messages):
+                (deduplicate and message_id in self.chatbot.processed_messages)):
                 return
             
             # Добавляем ID сообщения в список обработанных, чтобы избежать повторной обработки
             if message_id:
                 self.chatbot.processed_messages.add(message_id)
             
+            self.chatbot.remember_dm_room(username, message.room_id) # Ответ пойдёт прямо в известную комнату
+            
             logger.info(f"ЛС от {username}: {text}") # Логируем полученное ЛС
             
+            # Команды выполняются в быстрой полосе (по порядку для каждого пользователя),
+            # поэтому медленный ответ одному пользователю не задерживает остальных
+            # (кроме cancel: иначе она ждала бы в очереди пользователя ту самую суммаризацию, которую отменяет)
+            if self.fast_lane and text.lower().split(' ', 1)[0] != 'cancel':
+                self.fast_lane.submit(self.scoped(username), self._run_command, username, text, on_done)
+                deferred = True
+            else:
+                self.handle_command(username, text)
+                
+        except Exception as e:
+            logger.error(f"Ошибка обработки ЛС: {e}")
+        finally:
+            if on_done and not deferred:
+                on_done()
+
+    def _run_command(self, username, text, on_done=None):
+        """
+        Выполняет команду в быстрой полосе и подтверждает её выполнение.
+        """
+        try:
+            self.handle_command(username, text)
+        finally:
+            if on_done:
+                on_done()
+
+    def handle_command(self, username, text):
+        """
+        Выполняет команду из личного сообщения.
+        
+        :param username: Имя пользователя.
+        :param text: Текст сообщения.
+        """
+        try:
             # Обработка команды '!help' или 'help'
             if text.lower() in ['!help', '!помощь', 'help', 'помощь']:
                 help_text = f"""🤖 **Бот суммаризации чатов**
@@ -53,13 +117,20 @@ class MessageHandler:
 • `rooms` - список доступных комнат
 • `summary <имя_комнаты>` - создать суммаризацию чата
 • `summary <имя_комнаты> <количество_сообщений>` - суммаризация с указанием количества сообщений
+• `digest <комната1> <комната2> ... [количество_сообщений]` - сводка нескольких комнат одним сообщением
 • `prompt <имя_промпта>` - установить активный промпт (текущий: `{self.current_prompt}`)
 • `list_prompts` - показать список доступных промптов
+• `subscribe <имя_комнаты> <hourly|daily|weekdays> [ЧЧ:ММ]` - подписаться на регулярную сводку в ЛС
+• `unsubscribe <имя_комнаты>` - отменить подписку
+• `subscriptions` - показать ваши подписки
+• `cancel [имя_комнаты]` - отменить ваши суммаризации (все или по комнате)
 
 **Примеры:**
 • `summary general` - суммаризация комнаты general (30 сообщений)
 • `summary random 50` - суммаризация 50 сообщений из комнаты random
+• `digest backend frontend ops` - общая сводка трёх комнат
 • `prompt rick_and_morty` - установить промпт "Рик и Морти"
+• `subscribe general daily 08:30` - сводка комнаты general каждый день в 08:30
 
 *Примечание: суммаризация может занять некоторое время (до 2 минут)*"""
                 
@@ -110,33 +181,168 @@ class MessageHandler:
                 
                 room_name = parts[1] # Извлекаем имя комнаты
                 limit = 30 # Лимит сообщений по умолчанию
+                requested = None # Количество сообщений, явно указанное пользователем
                 if len(parts) > 2 and parts[2].isdigit():
-                    limit = min(int(parts[2]), 100) # Извлекаем и устанавливаем лимит сообщений (макс. 100)
-                
-                self.chatbot.send_direct_message(username, f"🔄 Создаю суммаризацию для комнаты '{room_name}' (анализирую последние {limit} сообщений)...\n*Это может занять до 2 минут*")
+                    limit = requested = min(int(parts[2]), 100) # Извлекаем и устанавливаем лимит сообщений (макс. 100)
                 
-                room = self.chatbot.get_room_by_name(room_name) # Находим комнату по имени
-                if not room:
-                    self.chatbot.send_direct_message(username, f"❌ Комната '{room_name}' не найдена. Используйте `rooms` для списка доступных комнат.")
+                # Для комнат с подпиской сразу отдаём заранее рассчитанную свежую сводку
+                digest = self.fresh_digest(room_name, self.current_prompt, requested)
+                if digest:
+                    created = datetime.fromtimestamp(digest['created_at']).strftime('%H:%M')
+                    result = f"📊 **Краткое содержание: #{room_name}**\n\n{digest['summary']}\n\n---\n*На основе анализа {digest['message_count']} сообщений (сводка от {created})*"
+                    self.chatbot.send_direct_message(username, result)
+                    logger.info(f"Отправлена готовая сводка #{room_name} пользователю {username}")
                     return
                 
-                messages = self.chatbot.get_room_messages_for_summary(room['_id'], limit) # Получаем сообщения для суммаризации
+                # Исчерпанную квоту сообщаем сразу, не ставя задачу в очередь
+                if self.llm_service.usage_meter:
+                    try:
+                        self.llm_service.usage_meter.check(self.scoped(username), self.scoped(room_name))
+                    except QuotaExceededError as e:
+                        self.chatbot.send_direct_message(username, f"⛔ {e}")
+                        return
                 
-                if not messages:
-                    self.chatbot.send_direct_message(username, f"❌ В комнате '{room_name}' нет сообщений для анализа")
-                    return
+                self.chatbot.send_direct_message(username, f"🔄 Создаю суммаризацию для комнаты '{room_name}' (анализирую последние {limit} сообщений)...\n*Это может занять до 2 минут*")
                 
-                self.chatbot.send_direct_message(username, f"📊 Анализирую {len(messages)} сообщений...")
+                job = {
+                    'tenant': self.tenant,
+                    'username': username,
+                    'room_name': room_name,
+                    'limit': limit,
+                    'prompt_name': self.current_prompt
+                }
+                if self.job_queue:
+                    # Ожидающие задачи пользователя по этой комнате заменяются новой, точный повтор выполняющейся отбрасывается
+                    if self.job_queue.enqueue(job, dedupe_key=self.job_key(username, room_name)) is None:
+                        self.chatbot.send_direct_message(username, f"⏳ Суммаризация #{room_name} уже выполняется. Отменить: `cancel {room_name}`")
+                else:
+                    self.run_summary_job(job)
+            
+            # Обработка команды 'digest <комната1> <комната2> ... [количество_сообщений]'
+            elif text.lower().startswith('digest '):
+                parts = text.split()[1:]
+                limit = 30
+                requested = None
+                if parts and parts[-1].isdigit():
+                    limit = requested = min(int(parts.pop()), 100)
+                rooms = list(dict.fromkeys(room.lstrip('#') for room in parts)) # Без повторов, в порядке перечисления
+                if not rooms:
+                    self.chatbot.send_direct_message(username, "❌ Укажите комнаты. Например: `digest backend frontend ops`")
+                    return
+                if len(rooms) > MULTI_DIGEST_MAX_ROOMS:
+                    self.chatbot.send_direct_message(username, f"❌ Не больше {MULTI_DIGEST_MAX_ROOMS} комнат в одной сводке")
+                    return
                 
-                # Получаем суммаризацию от языковой модели
-                summary = self.llm_service.summarize_with_llm(messages, self.chatbot.bot_username, prompt_name=self.current_prompt)
-                result = f"📊 **Краткое содержание: #{room_name}**\n\n{summary}\n\n---\n*На основе анализа {len(messages)} сообщений*"
+                self.chatbot.send_direct_message(username, f"🔄 Готовлю сводку по {len(rooms)} комнатам: {', '.join('#' + room for room in rooms)}...")
+                job = {
+                    'tenant': self.tenant,
+                    'username': username,
+                    'rooms': rooms,
+                    'limit': limit,
+                    'requested_limit': requested,
+                    'prompt_name': self.current_prompt
+                }
+                if self.job_queue:
+                    dedupe_key = f"{self.scoped(username)}:digest:{','.join(sorted(room.lower() for room in rooms))}"
+                    if self.job_queue.enqueue(job, kind='digest', dedupe_key=dedupe_key) is None:
+                        self.chatbot.send_direct_message(username, "⏳ Такая сводка уже готовится")
+                else:
+                    self.run_digest_job(job)
+            
+            # Обработка команды 'cancel [имя_комнаты]'
+            elif text.lower() == 'cancel' or text.lower().startswith('cancel '):
+                parts = text.split()
+                room_name = parts[1] if len(parts) > 1 else None
+                queued = self.job_queue.cancel_queued(username, self.job_key(username, room_name) if room_name else None,
+                                                      tenant=self.tenant) if self.job_queue else 0
+                running = self.cancel_running(username, room_name)
+                if not queued and not running:
+                    self.chatbot.send_direct_message(username, "🤷 Нет суммаризаций для отмены")
+                    return
+                self.chatbot.send_direct_message(username, f"🛑 Отменено: выполняющихся {running}, в очереди {queued}")
+            
+            # Обработка команды 'subscribe <имя_комнаты> <периодичность> [ЧЧ:ММ] [@пользователь]'
+            elif text.lower().startswith('subscribe ') and self.digest_scheduler:
+                parts = text.split()
+                target = username
+                if parts[-1].startswith('@'): # Администратор может подписать другого пользователя
+                    if username not in self.admins:
+                        self.chatbot.send_direct_message(username, "❌ Подписывать других пользователей может только администратор")
+                        return
+                    target = parts.pop()[1:]
+                if len(parts) < 3:
+                    self.chatbot.send_direct_message(username, "❌ Формат: `subscribe имя_комнаты daily 08:30`")
+                    return
                 
-                # Отправляем результат суммаризации
-                if self.chatbot.send_direct_message(username, result):
-                    logger.info(f"Суммаризация отправлена пользователю {username}")
+                room_name = parts[1]
+                try:
+                    next_run = self.digest_scheduler.subscribe(target, room_name, parts[2], parts[3] if len(parts) > 3 else None, self.current_prompt)
+                except ValueError as e:
+                    self.chatbot.send_direct_message(username, f"❌ {e}")
+                    return
+                self.chatbot.send_direct_message(username, f"✅ Подписка на #{room_name} для @{target} оформлена. Ближайшая сводка: {next_run.strftime('%d.%m %H:%M')}")
+
+            # Обработка команды 'unsubscribe <имя_комнаты>'
+            elif text.lower().startswith('unsubscribe ') and self.digest_scheduler:
+                room_name = text.split()[1]
+                if self.digest_scheduler.unsubscribe(username, room_name):
+                    self.chatbot.send_direct_message(username, f"✅ Подписка на #{room_name} отменена")
                 else:
-                    logger.error(f"Не удалось отправить суммаризацию пользователю {username}")
+                    self.chatbot.send_direct_message(username, f"❌ Подписки на #{room_name} нет")
+
+            # Обработка команды 'subscriptions'
+            elif text.lower() == 'subscriptions' and self.digest_scheduler:
+                subscriptions = self.digest_scheduler.list_subscriptions(username)
+                if not subscriptions:
+                    self.chatbot.send_direct_message(username, "📋 У вас нет подписок. Используйте: `subscribe имя_комнаты daily 08:30`")
+                    return
+                subscriptions_list = "\n".join([f"• #{sub['room_name']} - {sub['cadence']} {sub['at_time']} (`{sub['prompt_name']}`)" for sub in subscriptions])
+                self.chatbot.send_direct_message(username, f"📋 **Ваши подписки:**\n\n{subscriptions_list}")
+            
+            # Обработка команды 'limits' (только для администраторов)
+            elif text.lower() == 'limits' and username in self.admins:
+                metrics = self.chatbot.get_rate_limit_metrics()
+                if not metrics:
+                    self.chatbot.send_direct_message(username, "📈 Сервер пока не сообщал о лимитах запросов")
+                    return
+                limits_list = "\n".join([
+                    f"• `{endpoint}` - осталось {m['remaining']}/{m['limit']}, сброс через {m['reset_in']:.0f} с, 429: {m['throttled']}"
+                    for endpoint, m in sorted(metrics.items())
+                ])
+                self.chatbot.send_direct_message(username, f"📈 **Лимиты Rocket.Chat API:**\n\n{limits_list}")
+            
+            # Обработка команды 'usage' (только для администраторов)
+            elif text.lower() == 'usage' and username in self.admins and self.llm_service.usage_meter:
+                meter = self.llm_service.usage_meter
+                prefix = self.scoped('') # Администратор арендатора видит только своих пользователей и комнаты
+                sections = []
+                for scope, title in (('user', 'Пользователи'), ('room', 'Комнаты'), ('persona', 'Промпты')):
+                    rows = meter.report(scope, prefix=prefix if scope != 'persona' else None)
+                    if rows:
+                        sections.append(f"**{title}:**\n" + "\n".join([
+                            f"• `{row['name'].removeprefix(prefix)}` - {row['tokens']}" + (f"/{row['limit']}" if row['limit'] else "") +
+                            f" токенов, запросов: {row['requests']}, ошибок: {row['errors']}, в среднем {row['avg_latency']:.1f} с"
+                            for row in rows
+                        ]))
+                if not sections:
+                    self.chatbot.send_direct_message(username, f"📈 За последние {meter.window // 60} мин. запросов к LLM не было")
+                    return
+                outcomes = ", ".join(f"{outcome}: {count}" for outcome, count in sorted(meter.outcomes.items()))
+                cache_line = ""
+                if self.llm_service.summary_cache:
+                    stats = self.llm_service.summary_cache.stats()
+                    cache_line = (f"\nКэш похожих сводок: {stats['hit_rate'] * 100:.0f}% попаданий из {stats['lookups']} "
+                                  f"(готовых: {stats['reuse']}, дельта: {stats['delta']}, промахов: {stats['misses']}), записей: {stats['entries']}")
+                router_line = ""
+                if self.llm_service.model_router and self.llm_service.model_router.small_model:
+                    stats = self.llm_service.model_router.stats()
+                    router_line = "\nМодели с запуска: " + "; ".join(
+                        f"{route} - запросов: {stats[route]['requests']}, неудач: {stats[route]['failures']}, "
+                        f"эскалаций: {stats[route]['escalations']}, {stats[route]['tokens']} токенов, в среднем {stats[route]['avg_latency']:.1f} с"
+                        for route in (ROUTE_SMALL, ROUTE_LARGE)
+                    ) + f". Экономия: ~{stats['saved_tokens']} токенов основной модели, ~{stats['saved_seconds']:.0f} с"
+                self.chatbot.send_direct_message(username, f"📈 **Использование LLM за {meter.window // 60} мин.:**\n\n" + "\n\n".join(sections) +
+                                                 f"\n\nИсходы с запуска: {outcomes}. Отклонено по квотам: {meter.rejected}{cache_line}{router_line}")
             
             # Приветствие
             elif any(word in text.lower() for word in ['привет', 'hello', 'hi', 'start', 'начать']):
@@ -148,4 +354,242 @@ class MessageHandler:
                 self.chatbot.send_direct_message(username, response)
                 
         except Exception as e:
-            logger.error(f"Ошибка обработки ЛС: {e}")
+            logger.error(f"Ошибка выполнения команды '{text}' от {username}: {e}")
+
+    def scoped(self, name):
+        """
+        Имя пользователя или комнаты в общих для арендаторов компонентах (квоты, кэш сводок, быстрая полоса):
+        одинаковые имена на разных серверах не должны смешиваться.
+        """
+        return f"{self.tenant}/{name}" if self.tenant else name
+
+    def job_key(self, username, room_name):
+        """
+        Ключ задачи суммаризации для дедупликации и отмены.
+        """
+        return f"{self.scoped(username)}:{room_name.lower()}"
+
+    def cancel_running(self, username, room_name=None):
+        """
+        Прерывает выполняющиеся суммаризации пользователя: ожидание ответа LLM
+        прекращается, слот воркера и квоты освобождается.
+
+        :param username: Имя пользователя.
+        :param room_name: Отменить только суммаризацию этой комнаты.
+        :return: Количество отменённых суммаризаций.
+        """
+        cancelled = 0
+        with self.running_lock:
+            for (job_user, job_room), cancel_event in self.running_jobs.items():
+                if job_user == username and (not room_name or job_room == room_name.lower()) and not cancel_event.is_set():
+                    cancel_event.set()
+                    cancelled += 1
+        return cancelled
+
+    def dump_state(self):
+        """
+        Выгружает состояние обработчика для снимка тёплого перезапуска.
+        """
+        return {'current_prompt': self.current_prompt}
+
+    def restore_state(self, state):
+        """
+        Восстанавливает активный промпт из снимка.
+        """
+        prompt_name = state.get('current_prompt')
+        if prompt_name and self.llm_service.set_prompt(prompt_name):
+            self.current_prompt = prompt_name
+
+    def run_summary_job(self, job):
+        """
+        Выполняет задачу суммаризации: находит комнату, получает сообщения,
+        суммаризирует их и отправляет результат пользователю.
+        Вызывается воркером очереди задач или напрямую, если очередь не используется.
+        
+        :param job: Словарь с ключами username, room_name, limit, prompt_name.
+        """
+        username = job['username']
+        room_name = job['room_name']
+        limit = job['limit']
+
+        key = (username, room_name.lower())
+        cancel_event = threading.Event()
+        with self.running_lock:
+            self.running_jobs[key] = cancel_event
+        try:
+            self._summarize_for_user(username, room_name, limit, job.get('prompt_name'), cancel_event)
+        except RequestCancelledError:
+            logger.info(f"Суммаризация #{room_name} для {username} отменена")
+        finally:
+            with self.running_lock:
+                if self.running_jobs.get(key) is cancel_event:
+                    del self.running_jobs[key]
+
+    def _summarize_for_user(self, username, room_name, limit, prompt_name, cancel_event):
+        """
+        Находит комнату, суммаризирует её сообщения и отправляет результат пользователю.
+        """
+        room = self.chatbot.get_room_by_name(room_name) # Находим комнату по имени
+        if not room:
+            self.chatbot.send_direct_message(username, f"❌ Комната '{room_name}' не найдена. Используйте `rooms` для списка доступных комнат.")
+            return
+        
+        messages = self.chatbot.get_room_messages_for_summary(room['_id'], limit) # Получаем сообщения для суммаризации
+        
+        if not messages:
+            self.chatbot.send_direct_message(username, f"❌ В комнате '{room_name}' нет сообщений для анализа")
+            return
+        
+        self.chatbot.send_direct_message(username, f"📊 Анализирую {len(messages)} сообщений...")
+        
+        # Получаем суммаризацию от языковой модели
+        try:
+            summary = self.llm_service.summarize_with_llm(messages, self.chatbot.bot_username, prompt_name=prompt_name,
+                                                          username=self.scoped(username), room_name=self.scoped(room_name),
+                                                          cancel_event=cancel_event)
+        except QuotaExceededError as e:
+            self.chatbot.send_direct_message(username, f"⛔ {e}")
+            return
+        result = f"📊 **Краткое содержание: #{room_name}**\n\n{summary}\n\n---\n*На основе анализа {len(messages)} сообщений*"
+        
+        # Результат отправляется синхронно после уведомлений из очереди: задача завершается только после фактической доставки
+        if self.chatbot.deliver_result_message(username, result):
+            logger.info(f"Суммаризация отправлена пользователю {username}")
+        else:
+            # Исключение вернёт задачу в очередь для повторной попытки
+            raise RuntimeError(f"Не удалось отправить суммаризацию пользователю {username}")
+
+    def run_digest_job(self, job):
+        """
+        Выполняет задачу сводки нескольких комнат: комнаты находятся один раз,
+        затем для каждой параллельно (не больше MULTI_DIGEST_CONCURRENCY одновременно)
+        загружается история и запрашивается суммаризация. Результаты объединяются
+        в одно сообщение, поэтому общее время близко к времени самой медленной комнаты.
+        
+        :param job: Словарь с ключами username, rooms, limit, requested_limit, prompt_name.
+        """
+        username = job['username']
+        rooms = job['rooms']
+        started = time.perf_counter()
+        
+        keys = [(username, room_name.lower()) for room_name in rooms]
+        cancel_event = threading.Event() # Одно событие на всю сводку: `cancel` и `cancel <комната>` прерывают её целиком
+        with self.running_lock:
+            for key in keys:
+                self.running_jobs[key] = cancel_event
+        
+        try:
+            meter = self.llm_service.usage_meter
+            try:
+                # Сводка занимает один слот пользователя, запросы по комнатам идут внутри него
+                with meter.user_slot(self.scoped(username)) if meter else nullcontext():
+                    resolved = self.chatbot.resolve_rooms(rooms) # Комнаты находятся один раз на всю сводку
+                    with ThreadPoolExecutor(max_workers=max(1, MULTI_DIGEST_CONCURRENCY), thread_name_prefix='multi-digest') as pool:
+                        futures = [pool.submit(self._digest_room, username, room_name, resolved[room_name], job['limit'],
+                                               job.get('requested_limit'), job.get('prompt_name'), cancel_event)
+                                   for room_name in rooms]
+                        sections = [future.result() for future in futures] # В порядке, указанном пользователем
+            except QuotaExceededError as e:
+                self.chatbot.send_direct_message(username, f"⛔ {e}")
+                return
+            
+            if cancel_event.is_set():
+                logger.info(f"Сводка {rooms} для {username} отменена")
+                return
+            
+            elapsed = time.perf_counter() - started
+            total = sum(count for _, count in sections)
+            result = (f"📚 **Сводка: {', '.join('#' + room for room in rooms)}**\n\n" +
+                      "\n\n".join(text for text, _ in sections) +
+                      f"\n\n---\n*На основе анализа {total} сообщений, готово за {elapsed:.0f} с*")
+            logger.info(f"Сводка {len(rooms)} комнат для {username} за {elapsed:.1f} с")
+            if not self.chatbot.deliver_result_message(username, result): # Синхронно: задача завершается после доставки
+                raise RuntimeError(f"Не удалось отправить сводку пользователю {username}")
+        finally:
+            with self.running_lock:
+                for key in keys:
+                    if self.running_jobs.get(key) is cancel_event:
+                        del self.running_jobs[key]
+
+    def _digest_room(self, username, room_name, room, limit, requested, prompt_name, cancel_event):
+        """
+        Готовит раздел сводки для одной комнаты.
+        
+        :return: Кортеж (текст раздела, количество проанализированных сообщений).
+        """
+        title = f"**#{room_name}**"
+        # Готовая свежая сводка по подписке экономит запрос к LLM
+        digest = self.fresh_digest(room_name, prompt_name, requested)
+        if digest:
+            return f"{title}\n{digest['summary']}", digest['message_count']
+        
+        if not room:
+            return f"{title}\n❌ Комната не найдена", 0
+        messages = self.chatbot.get_room_messages_for_summary(room['_id'], limit)
+        if not messages:
+            return f"{title}\n❌ Нет сообщений для анализа", 0
+        
+        try:
+            summary = self.llm_service.summarize_with_llm(messages, self.chatbot.bot_username, prompt_name=prompt_name,
+                                                          username=self.scoped(username), room_name=self.scoped(room_name),
+                                                          cancel_event=cancel_event, fanout=True)
+        except QuotaExceededError as e:
+            return f"{title}\n⛔ {e}", 0
+        except RequestCancelledError:
+            return f"{title}\n🛑 Отменено", 0
+        return f"{title}\n{summary}", len(messages)
+
+    def fresh_digest(self, room_name, prompt_name, requested=None):
+        """
+        Возвращает свежую сводку комнаты по подписке, если она подходит под запрос.
+        
+        :param room_name: Имя комнаты.
+        :param prompt_name: Имя промпта.
+        :param requested: Количество сообщений, явно указанное пользователем (None — по умолчанию).
+            Сводка по другому числу сообщений не подходит, и запрос выполняется заново.
+        :return: Словарь сводки или None.
+        """
+        if not self.digest_scheduler:
+            return None
+        digest = self.digest_scheduler.get_fresh_digest(room_name, prompt_name)
+        if digest and requested is not None and digest['message_count'] != requested:
+            return None
+        return digest
+
+    def compute_room_summary(self, room_name, limit, prompt_name):
+        """
+        Рассчитывает сводку комнаты без отправки промежуточных сообщений.
+        Используется планировщиком регулярных сводок.
+        
+        :param room_name: Имя комнаты.
+        :param limit: Количество анализируемых сообщений.
+        :param prompt_name: Имя промпта.
+        :return: Кортеж (текст сводки, количество сообщений) или None, если комната не найдена, пуста
+            или сводку не удалось получить (текст ошибки не сохраняется как сводка).
+        """
+        room = self.chatbot.get_room_by_name(room_name)
+        if not room:
+            return None
+        
+        messages = self.chatbot.get_room_messages_for_summary(room['_id'], limit)
+        if not messages:
+            return None
+        
+        try:
+            summary = self.llm_service.summarize_with_llm(messages, self.chatbot.bot_username, prompt_name=prompt_name,
+                                                          room_name=self.scoped(room_name), strict=True)
+        except (SummaryFailedError, QuotaExceededError) as e:
+            logger.warning(f"Сводка #{room_name} не получена: {e}")
+            return None
+        return summary, len(messages)
+
+    def notify_summary_failed(self, job, error):
+        """
+        Сообщает пользователю, что задача суммаризации окончательно провалена.
+        
+        :param job: Словарь задачи.
+        :param error: Исключение последней попытки.
+        """
+        rooms = job.get('rooms') or [job['room_name']]
+        target = f"комнаты '{rooms[0]}'" if len(rooms) == 1 else f"комнат {', '.join('#' + room for room in rooms)}"
+        self.chatbot.send_direct_message(job['username'], f"❌ Не удалось создать суммаризацию для {target}. Попробуйте позже.")
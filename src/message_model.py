@@ -0,0 +1,82 @@
+import sys
+
+
+# Компактная запись сообщения: только поля, которые использует бот
+class ChatMessage:
+    __slots__ = ('id', 'room_id', 'room_user', 'username', 'text', 'type', 'has_attachment')
+
+    def __init__(self, id, username, text, room_id=None, room_user=None, type=None, has_attachment=False):
+        """
+        Конструктор класса ChatMessage.
+
+        :param id: ID сообщения.
+        :param username: Имя автора сообщения.
+        :param text: Текст сообщения.
+        :param room_id: ID комнаты (для ЛС — комната, куда отвечать).
+        :param room_user: Собеседник бота в ЛС.
+        :param type: Тип системного сообщения Rocket.Chat (поле t) или None.
+        :param has_attachment: Есть ли у сообщения файл или вложения.
+        """
+        self.id = id
+        self.username = username
+        self.text = text
+        self.room_id = room_id
+        self.room_user = room_user
+        self.type = type
+        self.has_attachment = has_attachment
+
+    @classmethod
+    def from_raw(cls, raw, room_id=None, room_user=None):
+        """
+        Создаёт запись из словаря сообщения Rocket.Chat, не сохраняя ссылок на исходный словарь.
+
+        :param raw: Словарь сообщения из REST API.
+        :param room_id: ID комнаты (по умолчанию поле rid).
+        :param room_user: Собеседник бота в ЛС.
+        """
+        username = raw.get('username') or (raw.get('u') or {}).get('username')
+        return cls(
+            id=raw.get('_id'),
+            username=sys.intern(username) if username else None, # Имена повторяются — храним одну копию строки
+            text=(raw.get('msg') or '').strip(),
+            room_id=room_id or raw.get('rid'),
+            room_user=room_user,
+            type=raw.get('t'),
+            has_attachment=bool(raw.get('file') or raw.get('attachments'))
+        )
+
+    def __repr__(self):
+        return f"ChatMessage(id={self.id!r}, username={self.username!r}, text={self.text[:40]!r})"
+
+
+def parse_messages(raw_messages, room_id=None, room_user=None):
+    """
+    Лениво превращает словари сообщений Rocket.Chat в компактные записи.
+
+    :param raw_messages: Итерируемые словари сообщений.
+    :param room_id: ID комнаты.
+    :param room_user: Собеседник бота в ЛС.
+    :return: Генератор ChatMessage.
+    """
+    for raw in raw_messages:
+        yield ChatMessage.from_raw(raw, room_id=room_id, room_user=room_user)
+
+
+def filter_messages(messages, bot_username, skip_ids=None, skip_system=True):
+    """
+    Лениво отбрасывает сообщения бота, пустые, системные и уже обработанные.
+
+    :param messages: Итерируемые ChatMessage.
+    :param bot_username: Имя пользователя бота.
+    :param skip_ids: Множество ID, которые нужно пропустить.
+    :param skip_system: Отбрасывать ли системные сообщения.
+    :return: Генератор ChatMessage.
+    """
+    for message in messages:
+        if message.username == bot_username or not message.text:
+            continue
+        if skip_system and message.type:
+            continue
+        if skip_ids is not None and message.id in skip_ids:
+            continue
+        yield message
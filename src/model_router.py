@@ -0,0 +1,136 @@
+import logging
+import threading
+from src.config import *
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+ROUTE_SMALL = 'small' # Короткая беседа — быстрая дешёвая модель
+ROUTE_LARGE = 'large' # Длинная беседа или эскалация — основная модель
+
+
+# Параметры запроса к LLM, выбранные для беседы
+class Route:
+    __slots__ = ('name', 'model', 'max_tokens', 'timeout', 'fallback')
+
+    def __init__(self, name, model, max_tokens, timeout, fallback=None):
+        """
+        :param name: ROUTE_SMALL или ROUTE_LARGE.
+        :param model: Имя модели.
+        :param max_tokens: Максимальная длина ответа в токенах.
+        :param timeout: Таймаут HTTP-запроса в секундах.
+        :param fallback: Маршрут, на который запрос повторяется при неудаче (None — без эскалации).
+        """
+        self.name = name
+        self.model = model
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+        self.fallback = fallback
+
+
+# Выбор модели по размеру беседы и учёт экономии по маршрутам
+class ModelRouter:
+    def __init__(self, small_model=LLM_SMALL_NAME, large_model=LLM_NAME, small_max_prompt_tokens=LLM_SMALL_MAX_PROMPT_TOKENS,
+                 small_timeout=LLM_SMALL_TIMEOUT, large_timeout=LLM_TIMEOUT, escalate=LLM_ESCALATE,
+                 cost_ratio=LLM_SMALL_COST_RATIO):
+        """
+        Конструктор класса ModelRouter.
+        Беседы до small_max_prompt_tokens токенов отправляются малой модели, остальные — основной.
+        Длина ответа малой модели с эскалацией растёт с размером беседы (LLM_RESPONSE_TOKENS_RATIO)
+        от LLM_MIN_RESPONSE_TOKENS до предела промпта: обрезанный ответ повторяется на основной модели.
+        Последнему маршруту (без эскалации) всегда даётся полный предел промпта. Настройки промпта (*_SETTINGS) могут задать свои "max_tokens"
+        и "small_max_prompt_tokens" (0 — промпт всегда использует основную модель).
+
+        :param small_model: Имя малой модели (пусто — каскад выключен, все запросы к основной модели).
+        :param large_model: Имя основной модели.
+        :param small_max_prompt_tokens: Размер беседы в токенах, до которого используется малая модель.
+        :param small_timeout: Таймаут запроса к малой модели в секундах.
+        :param large_timeout: Таймаут запроса к основной модели в секундах.
+        :param escalate: Повторять запрос к основной модели, если малая не ответила или вернула пустой/обрезанный ответ.
+        :param cost_ratio: Цена токена малой модели относительно основной (для оценки экономии).
+        """
+        self.small_model = small_model
+        self.large_model = large_model
+        self.small_max_prompt_tokens = small_max_prompt_tokens
+        self.small_timeout = small_timeout
+        self.large_timeout = large_timeout
+        self.escalate = escalate
+        self.cost_ratio = cost_ratio
+        self.lock = threading.Lock()
+        # Маршрут -> [запросов, неудач, эскалаций, токены промпта, токены ответа, сумма задержек]
+        self.counters = {ROUTE_SMALL: [0, 0, 0, 0, 0, 0.0], ROUTE_LARGE: [0, 0, 0, 0, 0, 0.0]}
+
+    def choose(self, conversation_tokens, settings=None):
+        """
+        Выбирает маршрут для беседы.
+
+        :param conversation_tokens: Оценка размера беседы в токенах (без текста промпта).
+        :param settings: Настройки промпта.
+        :return: Route.
+        """
+        settings = settings or {}
+        limit = settings.get('max_tokens', MAX_TOKENS)
+        # Обрезанный ответ последнего маршрута повторить негде, поэтому он получает полный предел длины
+        large = Route(ROUTE_LARGE, self.large_model, limit, self.large_timeout)
+        threshold = settings.get('small_max_prompt_tokens', self.small_max_prompt_tokens)
+        if not self.small_model or conversation_tokens > threshold:
+            return large
+        if not self.escalate:
+            return Route(ROUTE_SMALL, self.small_model, limit, self.small_timeout)
+        # Оценка в 4 символа на токен занижает размер кириллических бесед, но обрезанный ответ эскалируется
+        max_tokens = min(limit, max(LLM_MIN_RESPONSE_TOKENS, int(conversation_tokens * LLM_RESPONSE_TOKENS_RATIO)))
+        return Route(ROUTE_SMALL, self.small_model, max_tokens, self.small_timeout, large)
+
+    def record(self, route, prompt_tokens, completion_tokens, latency, failure=None, escalated=False):
+        """
+        Записывает результат одной попытки запроса.
+
+        :param route: Route попытки.
+        :param prompt_tokens: Токены промпта.
+        :param completion_tokens: Токены ответа.
+        :param latency: Длительность попытки в секундах.
+        :param failure: Причина неудачи (timeout, HTTP 500, empty, truncated, invalid) или None.
+        :param escalated: Запрос после неудачи повторён на основной модели.
+        """
+        with self.lock:
+            counters = self.counters[route.name]
+            counters[0] += 1
+            counters[1] += failure is not None
+            counters[2] += escalated
+            counters[3] += prompt_tokens
+            counters[4] += completion_tokens
+            counters[5] += latency
+        if failure:
+            logger.warning(f"Модель {route.model} ({route.name}): {failure}"
+                           f"{', повтор на ' + route.fallback.model if escalated else ''}")
+
+    def stats(self):
+        """
+        Возвращает использование маршрутов и оценку экономии относительно отправки всех бесед основной модели:
+        токены малой модели в пересчёте на цену основной (за вычетом попыток, закончившихся эскалацией)
+        и время, сэкономленное за счёт меньшей средней задержки малой модели.
+
+        :return: Словарь {маршрут: {'requests', 'failures', 'escalations', 'tokens', 'avg_latency'},
+            'saved_tokens', 'saved_seconds'}.
+        """
+        with self.lock:
+            counters = {name: list(values) for name, values in self.counters.items()}
+        stats = {}
+        for name, (requests_count, failures, escalations, prompt_tokens, completion_tokens, latency) in counters.items():
+            stats[name] = {
+                'requests': requests_count,
+                'failures': failures,
+                'escalations': escalations,
+                'tokens': prompt_tokens + completion_tokens,
+                'avg_latency': latency / requests_count if requests_count else 0.0
+            }
+        small, large = stats[ROUTE_SMALL], stats[ROUTE_LARGE]
+        answered = small['requests'] - small['escalations'] # Беседы, которые не дошли до основной модели
+        # Токены эскалированных попыток потрачены зря; доля токенов оценивается пропорционально числу попыток
+        useful_tokens = small['tokens'] * answered / small['requests'] if small['requests'] else 0
+        wasted_tokens = small['tokens'] - useful_tokens
+        stats['saved_tokens'] = round(useful_tokens * (1 - self.cost_ratio) - wasted_tokens * self.cost_ratio)
+        stats['saved_seconds'] = 0.0
+        if large['requests'] and small['requests']:
+            stats['saved_seconds'] = answered * large['avg_latency'] - small['requests'] * small['avg_latency']
+        return stats
@@ -0,0 +1,373 @@
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import timezone
+from src.config import *
+from src.latency_stats import percentile
+from src.webhook_server import normalize_webhook_payload
+
+try:
+    import pymongo
+    from pymongo.errors import OperationFailure, PyMongoError
+except ImportError: # Необязательная зависимость: нужна только для INGESTION_MODE=mongo
+    pymongo = None
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+# Поля сообщения, которые нужны для суммаризации (как в ответе channels.history)
+HISTORY_FIELDS = {'_id': 1, 'rid': 1, 'msg': 1, 'u': 1, 't': 1, 'ts': 1, 'file': 1, 'attachments': 1}
+
+# Код ошибки MongoDB: точка возобновления уже вытеснена из oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+# Приём сообщений из change stream коллекции rocketchat_message (self-hosted Rocket.Chat)
+class MongoMessageStream:
+    def __init__(self, dispatch, bot_user_id, bot_username, url=MONGO_URL, database=None,
+                 resume_file=MONGO_RESUME_TOKEN_FILE, max_await_ms=MONGO_MAX_AWAIT_MS):
+        """
+        Конструктор класса MongoMessageStream.
+        Новые ЛС боту и упоминания бота приходят из change stream сразу после записи в базу,
+        без опроса REST API. Команды выполняются параллельно (быстрая полоса), поэтому токен
+        возобновления продвигается только до последнего сообщения, перед которым все команды
+        выполнены (или поставлены в персистентную очередь задач). Вместе с токеном атомарно
+        сохраняются ID сообщений, выполненных после него: после перезапуска невыполненные
+        команды повторяются, а выполненные не повторяются.
+
+        :param dispatch: Функция (ChatMessage, on_done=..., deduplicate=False), вызывающая on_done() после
+            выполнения команды (MessageHandler.process_direct_message).
+        :param bot_user_id: ID пользователя бота (входит в ID его личных комнат).
+        :param bot_username: Имя пользователя бота (для упоминаний).
+        :param url: Строка подключения к MongoDB Rocket.Chat (replica set — условие работы change stream).
+        :param database: Имя базы (по умолчанию из строки подключения, иначе rocketchat).
+        :param resume_file: Файл с токеном возобновления.
+        :param max_await_ms: Сколько ждать новых событий за один запрос к серверу (влияет только на реакцию на остановку).
+        """
+        if pymongo is None:
+            raise ImportError("Для INGESTION_MODE=mongo установите pymongo: pip install pymongo")
+        self.dispatch = dispatch
+        self.bot_user_id = bot_user_id
+        self.bot_username = bot_username
+        self.client = pymongo.MongoClient(url, serverSelectionTimeoutMS=10000, appname='rocket_chat_ai')
+        self.db = self.client[database] if database else self.client.get_default_database('rocketchat')
+        self.messages = self.db['rocketchat_message']
+        self.resume_file = resume_file
+        self.max_await_ms = max_await_ms
+        self.lock = threading.Lock()
+        self.resume_token, done_ids = self.load_resume_token()
+        self.done_ids = set(done_ids) # ID сообщений, выполненных после сохранённого токена
+        self.pending = {} # Номер события -> (токен события, ID сообщения), пока токен не продвинут за него
+        self.completed = set() # Номера событий, выполненных раньше предыдущих
+        self.next_seq = 0 # Номер следующего события
+        self.low_seq = 0 # Номер самого раннего события, за которое токен ещё не продвинут
+        self.ready = threading.Event() # Change stream открыт
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.received = 0 # Принято сообщений
+        self.lag_total = 0.0 # Сумма задержек от записи сообщения до передачи в обработчик, с
+
+    def pipeline(self):
+        """
+        Фильтр change stream: только новые сообщения пользователей (не системные и не от бота)
+        в личных комнатах бота или с упоминанием бота.
+        """
+        return [{'$match': {
+            'operationType': 'insert',
+            'fullDocument.u._id': {'$ne': self.bot_user_id},
+            'fullDocument.t': {'$exists': False},
+            '$or': [
+                {'fullDocument.rid': {'$regex': re.escape(self.bot_user_id)}}, # ID личной комнаты — склейка ID участников
+                {'fullDocument.mentions.username': self.bot_username}
+            ]
+        }}]
+
+    def to_message(self, doc):
+        """
+        Превращает документ rocketchat_message в запись ChatMessage (как для вебхука).
+        """
+        user = doc.get('u') or {}
+        return normalize_webhook_payload({
+            'channel_id': doc.get('rid'),
+            'user_id': user.get('_id'),
+            'user_name': user.get('username'),
+            'message_id': doc.get('_id'),
+            'text': doc.get('msg')
+        }, self.bot_username)
+
+    def load_resume_token(self):
+        """
+        Загружает сохранённый токен возобновления.
+
+        :return: Кортеж (токен или None, список ID сообщений, выполненных после токена).
+        """
+        try:
+            if os.path.exists(self.resume_file):
+                with open(self.resume_file, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                return state.get('token'), state.get('message_ids', [])
+        except Exception as e:
+            logger.warning(f"Ошибка загрузки токена возобновления change stream: {e}")
+        return None, []
+
+    def save_resume_token(self):
+        """
+        Атомарно сохраняет токен возобновления вместе с ID сообщений, выполненных после него.
+        Вызывается под блокировкой.
+        """
+        try:
+            directory = os.path.dirname(self.resume_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.resume_file}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'token': self.resume_token, 'message_ids': sorted(self.done_ids), 'saved_at': time.time()}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.resume_file)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения токена возобновления change stream: {e}")
+
+    def start(self):
+        """
+        Запускает поток чтения change stream.
+        """
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name='mongo-stream', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Останавливает чтение. Команды, принятые до остановки, подтверждаются по мере выполнения;
+        невыполненные будут получены повторно после перезапуска.
+
+        :param timeout: Максимальное время ожидания потока в секундах.
+        """
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
+        self.client.close()
+
+    def _run(self):
+        """
+        Читает change stream, переподключаясь при ошибках с того же токена.
+        """
+        backoff = 1
+        while not self.stop_event.is_set():
+            self._wait_pending()
+            try:
+                options = {'resume_after': self.resume_token} if self.resume_token else {}
+                with self.messages.watch(self.pipeline(), max_await_time_ms=self.max_await_ms, **options) as stream:
+                    logger.info(f"Change stream {self.db.name}.rocketchat_message открыт"
+                                f"{' с сохранённого токена' if self.resume_token else ''}")
+                    self.ready.set()
+                    backoff = 1
+                    while not self.stop_event.is_set() and stream.alive:
+                        change = stream.try_next() # None, если за max_await_ms событий не было
+                        if change is not None:
+                            self._handle(change)
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    # Бот простаивал дольше, чем хранится oplog: читаем с текущего момента
+                    logger.warning("Токен возобновления устарел, change stream открывается с текущего момента")
+                    self.resume_token = None
+                    continue
+                logger.error(f"Ошибка change stream: {e}")
+            except PyMongoError as e:
+                logger.warning(f"Change stream прерван: {e}. Переподключение через {backoff} с")
+            self.ready.clear()
+            self.stop_event.wait(backoff)
+            backoff = min(backoff * 2, 30)
+
+    def _wait_pending(self):
+        """
+        Дожидается подтверждения всех переданных команд: после переподключения с токена
+        они не будут получены повторно, а номера событий снова идут в порядке потока.
+        """
+        while not self.stop_event.is_set():
+            with self.lock:
+                if not self.pending:
+                    return
+            self.stop_event.wait(0.1)
+
+    def _handle(self, change):
+        """
+        Передаёт сообщение в обработчик; токен продвигается, когда команда будет выполнена.
+        """
+        doc = change['fullDocument']
+        message_id = doc.get('_id')
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            duplicate = message_id in self.done_ids # Выполнено до перезапуска, но токен за него не продвинут
+            self.pending[seq] = (change['_id'], message_id)
+        if duplicate:
+            self._complete(seq)
+        else:
+            try:
+                self.dispatch(self.to_message(doc), on_done=lambda: self._complete(seq), deduplicate=False)
+            except Exception as e:
+                logger.error(f"Ошибка обработки сообщения из change stream: {e}")
+                self._complete(seq)
+
+        self.received += 1
+        if doc.get('ts'):
+            lag = time.time() - doc['ts'].replace(tzinfo=timezone.utc).timestamp()
+            self.lag_total += lag
+            logger.debug(f"Сообщение {doc.get('_id')} получено через {lag * 1000:.0f} мс после записи")
+
+    def _complete(self, seq):
+        """
+        Отмечает событие выполненным, продвигает токен за все подряд выполненные события и сохраняет его.
+        """
+        with self.lock:
+            if seq not in self.pending or seq in self.completed:
+                return
+            self.completed.add(seq)
+            self.done_ids.add(self.pending[seq][1])
+            while self.low_seq in self.completed:
+                token, message_id = self.pending.pop(self.low_seq)
+                self.completed.discard(self.low_seq)
+                self.done_ids.discard(message_id) # Сообщения до токена не будут получены повторно
+                self.resume_token = token
+                self.low_seq += 1
+            self.save_resume_token()
+
+    def room_history(self, room_id, limit=50):
+        """
+        Читает последние сообщения комнаты напрямую из базы (от новых к старым, как channels.history).
+
+        :param room_id: ID комнаты.
+        :param limit: Количество сообщений.
+        :return: Список словарей сообщений.
+        """
+        cursor = self.messages.find({'rid': room_id, '_hidden': {'$ne': True}}, HISTORY_FIELDS)
+        return list(cursor.sort('ts', pymongo.DESCENDING).limit(limit))
+
+    def list_rooms(self):
+        """
+        Возвращает комнаты, доступные боту: все публичные каналы и приватные группы, в которых он состоит.
+
+        :return: Список словарей {'_id', 'name'}.
+        """
+        rooms = [{'_id': room['_id'], 'name': room.get('name')}
+                 for room in self.db['rocketchat_room'].find({'t': 'c'}, {'name': 1})]
+        rooms.extend({'_id': sub['rid'], 'name': sub.get('name')}
+                     for sub in self.db['rocketchat_subscription'].find({'u._id': self.bot_user_id, 't': 'p'}, {'rid': 1, 'name': 1}))
+        return rooms
+
+    def stats(self):
+        """
+        Возвращает количество принятых сообщений и среднюю задержку доставки.
+        """
+        return {
+            'received': self.received,
+            'avg_lag_ms': self.lag_total / self.received * 1000 if self.received else 0.0
+        }
+
+
+def self_test(url, database, count):
+    """
+    Проверка на локальном replica set: задержка доставки, фильтрация и возобновление по токену.
+    Работает в отдельной базе, которую удаляет после проверки.
+    """
+    from datetime import datetime
+
+    client = pymongo.MongoClient(url, serverSelectionTimeoutMS=10000)
+    client.drop_database(database)
+    collection = client[database]['rocketchat_message']
+    resume_file = os.path.join('src/data', f"{database}_resume_token.json")
+    if os.path.exists(resume_file):
+        os.remove(resume_file)
+
+    bot_id, bot_username = 'BOTUSERID00000000', 'summary-bot'
+    received = {}
+
+    def dispatch(message, on_done=None, deduplicate=True):
+        received.setdefault(message.id, []).append(time.perf_counter())
+        if on_done:
+            on_done()
+
+    def make(i, kind):
+        user = {'_id': f"USER{i % 10:013d}", 'username': f"user{i % 10}"}
+        doc = {'_id': f"{kind}-{i}", 'rid': bot_id + user['_id'], 'msg': 'help', 'u': user, 'ts': datetime.utcnow()}
+        if kind == 'mention':
+            doc.update(rid='GENERALROOM000000', msg=f"@{bot_username} summary general", mentions=[{'username': bot_username}])
+        elif kind == 'channel':
+            doc.update(rid='GENERALROOM000000', msg='обычное сообщение')
+        elif kind == 'own':
+            doc.update(u={'_id': bot_id, 'username': bot_username})
+        elif kind == 'system':
+            doc.update(t='uj')
+        return doc
+
+    def start_stream():
+        stream = MongoMessageStream(dispatch, bot_id, bot_username, url=url, database=database, resume_file=resume_file)
+        stream.start()
+        if not stream.ready.wait(15):
+            raise RuntimeError("Change stream не открылся (нужен replica set: rs.initiate())")
+        return stream
+
+    print("🧪 Проверка приёма из change stream MongoDB")
+    print("=" * 50)
+    stream = start_stream()
+    sent = {}
+    kinds = ('dm', 'mention', 'channel', 'own', 'system')
+    for i in range(count):
+        doc = make(i, kinds[i % len(kinds)])
+        sent[doc['_id']] = time.perf_counter()
+        collection.insert_one(doc)
+    expected = {doc_id for doc_id in sent if doc_id.split('-')[0] in ('dm', 'mention')}
+    deadline = time.time() + 10
+    while len(received) < len(expected) and time.time() < deadline:
+        time.sleep(0.01)
+    latencies = sorted((received[doc_id][0] - sent[doc_id]) * 1000 for doc_id in expected if doc_id in received)
+    unexpected = set(received) - expected
+    print(f"⏱  Задержка доставки, мс: p50={percentile(latencies, 50):.1f} p95={percentile(latencies, 95):.1f} "
+          f"p99={percentile(latencies, 99):.1f} (получено {len(latencies)} из {len(expected)})")
+    print(f"{'✅' if not unexpected else '❌'} Лишних сообщений (каналы, бот, системные): {len(unexpected)}")
+
+    # Сообщения, записанные при остановленном приёме, доставляются после запуска ровно один раз
+    stream.stop(timeout=5)
+    before = len(received)
+    offline = [make(count + i, 'dm') for i in range(10)]
+    collection.insert_many(offline)
+    stream = start_stream()
+    deadline = time.time() + 10
+    while len(received) < before + len(offline) and time.time() < deadline:
+        time.sleep(0.01)
+    stream.stop(timeout=5)
+    missing = [doc['_id'] for doc in offline if doc['_id'] not in received]
+    duplicates = [doc_id for doc_id, times in received.items() if len(times) > 1]
+    print(f"{'✅' if not missing and not duplicates else '❌'} Возобновление по токену: пропущено {len(missing)}, повторов {len(duplicates)}")
+
+    history = MongoMessageStream(dispatch, bot_id, bot_username, url=url, database=database, resume_file=resume_file)
+    started = time.perf_counter()
+    rows = history.room_history('GENERALROOM000000', 100)
+    print(f"📚 История комнаты из базы: {len(rows)} сообщений за {(time.perf_counter() - started) * 1000:.1f} мс")
+    history.client.close()
+
+    client.drop_database(database)
+    client.close()
+    os.remove(resume_file)
+    return not unexpected and not missing and not duplicates and len(latencies) == len(expected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка приёма сообщений из change stream MongoDB")
+    parser.add_argument('--url', default=MONGO_URL)
+    parser.add_argument('--db', default='rocket_chat_ai_ingest_test', help="временная база для проверки (будет удалена)")
+    parser.add_argument('-n', '--messages', type=int, default=200)
+    args = parser.parse_args()
+    if pymongo is None:
+        raise SystemExit("Установите pymongo: pip install pymongo")
+    raise SystemExit(0 if self_test(args.url, args.db, args.messages) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from src.config import *
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+
+# Планировщик опроса личных сообщений с учётом активности
+class PollScheduler:
+    def __init__(self, floor=POLL_INTERVAL_MIN, ceiling=POLL_INTERVAL_MAX, backoff=POLL_BACKOFF,
+                 hot_window=POLL_HOT_WINDOW, room_max_interval=POLL_ROOM_MAX_INTERVAL):
+        """
+        Конструктор класса PollScheduler.
+        Интервал опроса растёт в простое и сбрасывается до минимума при активности.
+        Комнаты с недавней активностью опрашиваются на каждом шаге, давно молчащие —
+        тем реже, чем дольше молчат. Комнаты, у которых по данным im.list изменилось
+        последнее сообщение, опрашиваются всегда.
+
+        :param floor: Минимальный интервал опроса в секундах.
+        :param ceiling: Максимальный интервал опроса в секундах.
+        :param backoff: Множитель увеличения интервала на шаге без активности.
+        :param hot_window: Время в секундах после активности, в течение которого комната считается активной.
+        :param room_max_interval: Максимальный интервал между опросами молчащей комнаты в секундах.
+        """
+        self.floor = floor
+        self.ceiling = max(floor, ceiling)
+        self.backoff = backoff
+        self.hot_window = hot_window
+        self.room_max_interval = room_max_interval
+        self.interval = floor
+        self.rooms = {} # room_id -> {'last_activity', 'last_polled', 'last_message'}
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.polled = 0 # Сколько раз комнаты опрашивались
+        self.skipped = 0 # Сколько опросов комнат пропущено
+
+    def next_interval(self, had_activity):
+        """
+        Возвращает паузу до следующего шага опроса.
+
+        :param had_activity: Были ли новые сообщения на текущем шаге.
+        :return: Интервал в секундах.
+        """
+        with self.lock:
+            if had_activity:
+                self.interval = self.floor # Активность — сразу возвращаемся к частому опросу
+            else:
+                self.interval = min(self.ceiling, self.interval * self.backoff)
+            return self.interval
+
+    def select_rooms(self, rooms):
+        """
+        Выбирает личные комнаты, которые нужно опросить на текущем шаге.
+
+        :param rooms: Список комнат из im.list.
+        :return: Список комнат для запроса истории, активные первыми.
+        """
+        now = time.time()
+        selected = []
+        with self.lock:
+            for room in rooms:
+                room_id = room.get('_id')
+                state = self.rooms.setdefault(room_id, {'last_activity': None, 'last_polled': 0, 'last_message': None})
+                last_message = room.get('lm') or room.get('_updatedAt') # Время последнего сообщения по данным im.list
+
+                if last_message and last_message != state['last_message']:
+                    due = True # Сервер сообщает о новом сообщении
+                elif state['last_activity'] and now - state['last_activity'] < self.hot_window:
+                    due = True # Активная комната — опрашиваем на каждом шаге
+                else:
+                    idle = now - (state['last_activity'] or self.started)
+                    period = min(self.room_max_interval, max(self.floor, idle * 0.1))
+                    due = now - state['last_polled'] >= period
+
+                state['last_message'] = last_message or state['last_message']
+                if due:
+                    state['last_polled'] = now
+                    selected.append((state['last_activity'] or 0, room))
+                    self.polled += 1
+                else:
+                    self.skipped += 1
+
+        selected.sort(key=lambda item: item[0], reverse=True)
+        return [room for _, room in selected]
+
+    def record_room(self, room_id, had_new_messages):
+        """
+        Отмечает результат опроса комнаты.
+
+        :param room_id: ID комнаты.
+        :param had_new_messages: Были ли в комнате новые сообщения.
+        """
+        if had_new_messages:
+            with self.lock:
+                self.rooms.setdefault(room_id, {'last_activity': None, 'last_polled': 0, 'last_message': None})
+                self.rooms[room_id]['last_activity'] = time.time()
+
+    def stats(self):
+        """
+        Возвращает статистику опроса.
+
+        :return: Словарь с текущим интервалом и количеством опрошенных и пропущенных комнат.
+        """
+        with self.lock:
+            return {
+                'interval': self.interval,
+                'rooms': len(self.rooms),
+                'polled': self.polled,
+                'skipped': self.skipped
+            }
+
+    def dump_state(self):
+        """
+        Выгружает состояние комнат для снимка тёплого перезапуска.
+        """
+        with self.lock:
+            return {'rooms': {room_id: dict(state) for room_id, state in self.rooms.items()}}
+
+    def restore_state(self, state):
+        """
+        Восстанавливает состояние комнат из снимка: после перезапуска молчащие
+        комнаты не опрашиваются все разом, а активные остаются активными.
+        """
+        with self.lock:
+            for room_id, room_state in state.get('rooms', {}).items():
+                self.rooms.setdefault(room_id, {'last_activity': None, 'last_polled': 0, 'last_message': None}).update(room_state)
@@ -0,0 +1,213 @@
+import logging
+import re
+from src.config import *
+from src.message_model import ChatMessage
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+URL_RE = re.compile(r'https?://([^/\s)>\]]+)[^\s)>\]]*')
+QUOTE_LINK_RE = re.compile(r'\[ ?\]\([^)]*\?msg=[^)]*\)\s*') # Ссылка-цитата Rocket.Chat: [ ](https://host/channel/x?msg=ID)
+CODE_BLOCK_RE = re.compile(r'```.*?(?:```|$)', re.S)
+TRACE_LINE_RE = re.compile(r'^\s*(Traceback \(most recent call last\)|File ".*", line \d+|at [\w$.<>]+\(.*\)|\.\.\. \d+ more)')
+NOISE_RE = re.compile(r'^[\W_]*$') # Только знаки препинания и эмодзи
+
+
+def estimate_tokens(text):
+    """
+    Грубая оценка количества токенов (около 4 символов на токен).
+    """
+    return (len(text) + 3) // 4
+
+
+# Отчёт об экономии токенов по стадиям предобработки
+class PreprocessReport:
+    def __init__(self):
+        self.input_tokens = 0 # Токены исходных сообщений
+        self.stage_tokens = {} # Стадия -> токены на выходе стадии
+
+    def savings(self):
+        """
+        Возвращает экономию токенов по стадиям.
+
+        :return: Список кортежей (стадия, сэкономлено токенов).
+        """
+        result = []
+        previous = self.input_tokens
+        for stage, tokens in self.stage_tokens.items():
+            result.append((stage, previous - tokens))
+            previous = tokens
+        return result
+
+    def output_tokens(self):
+        """
+        Возвращает количество токенов после всех стадий.
+        """
+        return list(self.stage_tokens.values())[-1] if self.stage_tokens else self.input_tokens
+
+    def __str__(self):
+        stages = ", ".join(f"{stage}: -{saved}" for stage, saved in self.savings())
+        return f"{self.input_tokens} -> {self.output_tokens()} токенов ({stages})"
+
+
+# Потоковая предобработка сообщений чата перед построением промпта
+class MessagePreprocessor:
+    def __init__(self, stages=PREPROCESS_STAGES, max_code_lines=PREPROCESS_MAX_CODE_LINES):
+        """
+        Конструктор класса MessagePreprocessor.
+
+        :param stages: Список включённых стадий в порядке применения:
+            noise (вложения без текста, «+», эмодзи), quotes (цитаты), code (блоки кода
+            и стектрейсы), urls (ссылки до домена), dedupe (повторы), merge (склейка
+            подряд идущих сообщений одного автора).
+        :param max_code_lines: Максимальное количество строк кода/стектрейса, сохраняемых без сворачивания.
+        """
+        self.stages = [stage for stage in stages if stage in self.STAGES]
+        self.max_code_lines = max_code_lines
+
+    def run(self, messages, bot_username):
+        """
+        Строит ленивый конвейер предобработки.
+
+        :param messages: Итерируемые записи ChatMessage (или словари Rocket.Chat) в хронологическом порядке.
+        :param bot_username: Имя пользователя бота (его сообщения отбрасываются).
+        :return: Кортеж (генератор записей (username, text, есть_вложение), PreprocessReport).
+            Отчёт заполняется по мере потребления генератора.
+        """
+        report = PreprocessReport()
+        records = self._parse(messages, bot_username, report)
+        for stage in self.stages:
+            report.stage_tokens[stage] = 0 # Порядок стадий в отчёте совпадает с порядком применения
+            records = self._counted(stage, getattr(self, self.STAGES[stage])(records), report)
+        return records, report
+
+    def format_lines(self, messages, bot_username):
+        """
+        Возвращает генератор строк "@user: текст" и отчёт об экономии токенов.
+        """
+        records, report = self.run(messages, bot_username)
+        return (f"@{username}: {text}" for username, text, _ in records), report
+
+    @staticmethod
+    def _counted(stage, records, report):
+        """
+        Считает токены на выходе стадии, не материализуя поток.
+        """
+        for record in records:
+            report.stage_tokens[stage] += estimate_tokens(record[1])
+            yield record
+
+    @staticmethod
+    def _parse(messages, bot_username, report):
+        """
+        Извлекает автора и текст, отбрасывая сообщения бота и сообщения без текста.
+        """
+        for msg in messages:
+            if isinstance(msg, dict):
+                msg = ChatMessage.from_raw(msg) # Словарь из REST API или вебхука
+            username, text = msg.username, msg.text
+            if not username or username == bot_username or not text:
+                continue
+            report.input_tokens += estimate_tokens(text)
+            yield username, text, msg.has_attachment
+
+    @staticmethod
+    def drop_noise(records):
+        """
+        Убирает вложения, подписанные только ссылкой, и сообщения из одних эмодзи и знаков.
+        """
+        for username, text, has_attachment in records:
+            if NOISE_RE.match(text):
+                continue
+            if has_attachment and URL_RE.fullmatch(text):
+                continue
+            yield username, text, has_attachment
+
+    @staticmethod
+    def fold_quotes(records):
+        """
+        Удаляет ссылки-цитаты Rocket.Chat и сворачивает строки цитирования "> ...".
+        """
+        for username, text, has_attachment in records:
+            text = QUOTE_LINK_RE.sub('', text)
+            lines = []
+            for line in text.split('\n'):
+                if line.lstrip().startswith('>'):
+                    if not lines or lines[-1] != '> …':
+                        lines.append('> …')
+                else:
+                    lines.append(line)
+            text = '\n'.join(lines).strip()
+            if text and text != '> …':
+                yield username, text, has_attachment
+
+    def trim_code(self, records):
+        """
+        Сворачивает длинные блоки кода и стектрейсы до первых max_code_lines строк.
+        """
+        limit = self.max_code_lines
+
+        def fold_block(match):
+            header, _, body = match.group(0).strip('`').partition('\n') # Первая строка — язык блока
+            lines = body.rstrip('\n').split('\n')
+            if len(lines) <= limit:
+                return match.group(0)
+            return f"```{header}\n" + '\n'.join(lines[:limit]) + f"\n… [ещё {len(lines) - limit} строк кода]```"
+
+        for username, text, has_attachment in records:
+            text = CODE_BLOCK_RE.sub(fold_block, text)
+            lines = text.split('\n')
+            trace = [i for i, line in enumerate(lines) if TRACE_LINE_RE.match(line)]
+            if len(trace) > limit:
+                # Оставляем начало стектрейса и всё после него (обычно там текст исключения)
+                kept, last = trace[limit - 1], trace[-1]
+                lines = lines[:kept + 1] + [f"… [ещё {last - kept} строк стектрейса]"] + lines[last + 1:]
+                text = '\n'.join(lines)
+            yield username, text, has_attachment
+
+    @staticmethod
+    def shorten_urls(records):
+        """
+        Заменяет ссылки на их домен.
+        """
+        for username, text, has_attachment in records:
+            yield username, URL_RE.sub(lambda m: f"<{m.group(1)}>", text), has_attachment
+
+    @staticmethod
+    def dedupe(records):
+        """
+        Убирает повторы одного и того же текста от одного автора.
+        """
+        seen = set()
+        for username, text, has_attachment in records:
+            key = (username, ' '.join(text.lower().split()))
+            if key in seen:
+                continue
+            seen.add(key)
+            yield username, text, has_attachment
+
+    @staticmethod
+    def merge_consecutive(records):
+        """
+        Склеивает подряд идущие сообщения одного автора в одну строку.
+        """
+        current_user, parts, attachment = None, [], False
+        for username, text, has_attachment in records:
+            if username != current_user and parts:
+                yield current_user, '; '.join(parts), attachment
+                parts, attachment = [], False
+            current_user = username
+            parts.append(text)
+            attachment = attachment or has_attachment
+        if parts:
+            yield current_user, '; '.join(parts), attachment
+
+    # Имя стадии -> метод
+    STAGES = {
+        'noise': 'drop_noise',
+        'quotes': 'fold_quotes',
+        'code': 'trim_code',
+        'urls': 'shorten_urls',
+        'dedupe': 'dedupe',
+        'merge': 'merge_consecutive'
+    }
@@ -1,5 +1,7 @@
 PROF_SETTINGS = {
-    "temperature": 0.3
+    "temperature": 0.3,
+    "max_tokens": 1500, # Деловая сводка короче творческих
+    "small_max_prompt_tokens": 4000 # Фактическую сводку малая модель делает и для бесед подлиннее
 }
 
 NEUTRAL_RESPONSES = {
@@ -1,5 +1,6 @@
 TARANTINO_SETTINGS = {
-    "temperature": 1.0
+    "temperature": 1.0,
+    "small_max_prompt_tokens": 1200 # Стилизация сложнее: малой модели только совсем короткие беседы
 }
 
 TARANTINO_RESPONSES = {
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from src.config import *
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+
+# HTTP-сессия, учитывающая лимиты частоты запросов Rocket.Chat по каждому эндпоинту
+class RateLimitedSession(requests.Session):
+    def __init__(self, max_retries=RATE_LIMIT_MAX_RETRIES, max_wait=RATE_LIMIT_MAX_WAIT, pacing_threshold=RATE_LIMIT_PACING_THRESHOLD):
+        """
+        Конструктор класса RateLimitedSession.
+        Читает заголовки X-RateLimit-Limit/Remaining/Reset, хранит бюджет запросов
+        по каждому эндпоинту, равномерно распределяет оставшиеся запросы до сброса
+        лимита и повторяет запрос после ответа 429.
+
+        :param max_retries: Количество повторов после ответа 429.
+        :param max_wait: Максимальная пауза перед одним запросом в секундах.
+        :param pacing_threshold: Доля оставшегося бюджета, ниже которой включается равномерное распределение запросов.
+        """
+        super().__init__()
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.pacing_threshold = pacing_threshold
+        self.budgets = {} # Эндпоинт -> {'limit', 'remaining', 'reset', 'throttled'}
+        self.lock = threading.Lock()
+        # Функция повторного входа при ответе 401: принимает отвергнутый токен, возвращает True при успехе
+        self.on_unauthorized = None
+
+    @staticmethod
+    def endpoint_of(url):
+        """
+        Выделяет имя эндпоинта из URL (например, 'im.history').
+        """
+        path = urlsplit(url).path
+        marker = '/api/v1/'
+        return path.split(marker, 1)[1] if marker in path else path
+
+    def _delay_for(self, endpoint):
+        """
+        Вычисляет паузу перед запросом к эндпоинту по известному бюджету.
+        """
+        with self.lock:
+            budget = self.budgets.get(endpoint)
+            if not budget:
+                return 0
+            now = time.time()
+            wait = budget['reset'] - now
+            if wait <= 0:
+                return 0 # Окно лимита уже сброшено
+            if budget['remaining'] <= 0:
+                return wait # Бюджет исчерпан — ждём сброса окна
+            if budget['remaining'] < budget['limit'] * self.pacing_threshold:
+                # Бюджет на исходе — распределяем оставшиеся запросы равномерно до сброса
+                return wait / (budget['remaining'] + 1)
+            return 0
+
+    def _update_budget(self, endpoint, response):
+        """
+        Обновляет бюджет эндпоинта по заголовкам ответа.
+        """
+        headers = response.headers
+        if 'X-RateLimit-Remaining' not in headers:
+            return
+        try:
+            with self.lock:
+                budget = self.budgets.setdefault(endpoint, {'throttled': 0})
+                budget['limit'] = int(headers.get('X-RateLimit-Limit', 0))
+                budget['remaining'] = int(headers['X-RateLimit-Remaining'])
+                budget['reset'] = int(headers.get('X-RateLimit-Reset', 0)) / 1000 # Rocket.Chat отдаёт миллисекунды
+        except ValueError:
+            logger.debug(f"Некорректные заголовки лимита для {endpoint}: {dict(headers)}")
+
+    def request(self, method, url, *args, **kwargs):
+        """
+        Выполняет запрос с учётом бюджета эндпоинта, повтором после 429
+        и однократным повтором после повторного входа, если токен отвергнут (401).
+        """
+        endpoint = self.endpoint_of(url)
+        response = self._paced_request(endpoint, method, url, *args, **kwargs)
+        if response.status_code == 401 and self.on_unauthorized and endpoint != 'login':
+            # Заголовки — тот же словарь, что у клиента RocketChat, поэтому после входа в нём уже новый токен
+            headers = kwargs.get('headers') or {}
+            if self.on_unauthorized(headers.get('X-Auth-Token')):
+                response = self._paced_request(endpoint, method, url, *args, **kwargs)
+        return response
+
+    def _paced_request(self, endpoint, method, url, *args, **kwargs):
+        """
+        Выполняет запрос с учётом бюджета эндпоинта и повтором после 429.
+        """
+        for attempt in range(self.max_retries + 1):
+            delay = min(self._delay_for(endpoint), self.max_wait)
+            if delay > 0:
+                logger.debug(f"Пауза {delay:.2f} с перед {endpoint} (лимит запросов)")
+                time.sleep(delay)
+
+            response = super().request(method, url, *args, **kwargs)
+            self._update_budget(endpoint, response)
+            if response.status_code != 429:
+                return response
+
+            with self.lock:
+                budget = self.budgets.setdefault(endpoint, {'limit': 0, 'remaining': 0, 'reset': 0, 'throttled': 0})
+                budget['remaining'] = 0
+                budget['throttled'] += 1
+                retry_after = response.headers.get('Retry-After')
+                if retry_after and retry_after.isdigit():
+                    budget['reset'] = max(budget['reset'], time.time() + int(retry_after))
+                elif budget['reset'] <= time.time():
+                    budget['reset'] = time.time() + 2 ** attempt # Сервер не сообщил время сброса
+            logger.warning(f"Превышен лимит запросов к {endpoint} (попытка {attempt + 1})")
+        return response
+
+    def metrics(self):
+        """
+        Возвращает оставшийся бюджет запросов по эндпоинтам.
+
+        :return: Словарь {эндпоинт: {'limit', 'remaining', 'reset_in', 'throttled'}}.
+        """
+        now = time.time()
+        with self.lock:
+            return {
+                endpoint: {
+                    'limit': budget.get('limit', 0),
+                    'remaining': budget.get('remaining', 0),
+                    'reset_in': max(0.0, budget.get('reset', 0) - now),
+                    'throttled': budget.get('throttled', 0)
+                }
+                for endpoint, budget in self.budgets.items()
+            }
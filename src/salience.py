@@ -0,0 +1,196 @@
+import logging
+import numpy as np
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+# Байты, из которых состоят слова: ASCII-буквы, цифры, "_" и все байты многобайтовых
+# символов UTF-8 (кириллица и прочие не-ASCII буквы)
+WORD_BYTES = np.zeros(256, dtype=bool)
+for low, high in ((ord('0'), ord('9')), (ord('a'), ord('z')), (0x80, 0xFF)):
+    WORD_BYTES[low:high + 1] = True
+WORD_BYTES[ord('_')] = True
+DIGIT_BYTES = np.zeros(256, dtype=bool)
+DIGIT_BYTES[ord('0'):ord('9') + 1] = True
+
+MIN_TOKEN_CHARS = 3 # Более короткие слова ("да", "ок", "+1") не учитываются; длина в символах, а не в байтах UTF-8
+HASH_PREFIX = 32 # Сколько первых байт слова участвует в хэше
+HASH_POWERS = np.array([pow(1099511628211, k, 2 ** 64) for k in range(HASH_PREFIX)], dtype=np.uint64)
+
+# Основы слов, указывающие на решения и договорённости
+DECISION_STEMS = [stem.encode('utf-8') for stem in (
+    'решил', 'решени', 'договорил', 'утвердил', 'согласовал', 'итог', 'дедлайн', 'срок',
+    'сделаем', 'будем', 'нужно', 'надо', 'блокер',
+    'decid', 'agreed', 'approve', 'deadline', 'todo', 'action item', 'blocker'
+)]
+
+# Бонусы к оценке (центральность нормирована в [0, 1], поэтому строка
+# с решением всегда важнее строки без признаков)
+DECISION_BOOST = 1.0
+MENTION_BOOST = 0.4
+NUMBER_BOOST = 0.3
+LINK_BOOST = 0.3
+RECENCY_BOOST = 0.2 # Максимальная прибавка для самых свежих строк
+
+
+def _encode(lines):
+    """
+    Склеивает тексты строк (без автора) в один буфер байт в нижнем регистре.
+
+    :return: Кортеж (массив байт, позиции разделителей строк).
+    """
+    # Разделитель \x00 не встречается в тексте и, в отличие от \n, не ломается многострочными сообщениями
+    text = "\x00".join(line.split(': ', 1)[-1].replace('\x00', ' ') for line in lines).lower()
+    data = np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+    return data, np.flatnonzero(data == 0)
+
+
+def _rows_of(positions, separators, n):
+    """
+    Возвращает булев массив строк, содержащих хотя бы одну из позиций.
+    """
+    if len(positions) == 0:
+        return np.zeros(n, dtype=bool)
+    return np.bincount(np.searchsorted(separators, positions), minlength=n)[:n] > 0
+
+
+def _find_all(data_bytes, needle):
+    """
+    Находит все вхождения подстроки в буфере (поиск выполняется на уровне C).
+    """
+    positions = []
+    position = data_bytes.find(needle)
+    while position != -1:
+        positions.append(position)
+        position = data_bytes.find(needle, position + 1)
+    return positions
+
+
+def _tokenize(data, separators):
+    """
+    Разбивает буфер на слова и хэширует их без цикла по словам на Python.
+
+    :return: Кортеж (номер строки каждого слова, хэш каждого слова).
+    """
+    is_word = WORD_BYTES[data]
+    edges = np.diff(is_word.astype(np.int8), prepend=np.int8(0), append=np.int8(0))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    lengths = ends - starts
+    # Символы слова — его байты, кроме байтов продолжения UTF-8 (10xxxxxx): "да" — 4 байта, но 2 символа
+    char_starts = np.concatenate(([0], np.cumsum((data & 0xC0) != 0x80)))
+    keep = char_starts[ends] - char_starts[starts] >= MIN_TOKEN_CHARS
+    starts, lengths = starts[keep], lengths[keep]
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64)
+
+    # Полиномиальный хэш первых HASH_PREFIX байт каждого слова (переполнение uint64 — по модулю 2^64)
+    prefix = np.minimum(lengths, HASH_PREFIX)
+    token_offsets = np.cumsum(prefix) - prefix
+    offsets = np.arange(prefix.sum()) - np.repeat(token_offsets, prefix)
+    values = data[np.repeat(starts, prefix) + offsets].astype(np.uint64) * HASH_POWERS[offsets]
+    hashes = np.add.reduceat(values, token_offsets) ^ lengths.astype(np.uint64)
+
+    rows = np.searchsorted(separators, starts)
+    return rows, hashes
+
+
+def score_lines(lines):
+    """
+    Оценивает значимость строк беседы: близость TF-IDF вектора строки
+    к центроиду всей беседы плюс бонусы за решения, упоминания, числа,
+    ссылки и свежесть. Токенизация и все вычисления векторизованы по буферу
+    байт и разреженному представлению (тройки строка/слово/вес).
+
+    :param lines: Список строк "@user: текст" в хронологическом порядке.
+    :return: Массив NumPy с оценкой каждой строки.
+    """
+    n = len(lines)
+    if n == 0:
+        return np.zeros(0)
+
+    data, separators = _encode(lines)
+    rows, hashes = _tokenize(data, separators)
+
+    scores = np.zeros(n)
+    if len(rows):
+        vocabulary, cols = np.unique(hashes, return_inverse=True)
+        vocab_size = len(vocabulary)
+
+        # Частота слова в строке: схлопываем повторяющиеся пары (строка, слово)
+        keys, tf = np.unique(rows * vocab_size + cols, return_counts=True)
+        rows, cols = keys // vocab_size, keys % vocab_size
+        df = np.bincount(cols, minlength=vocab_size)
+        weights = (1 + np.log(tf)) * np.log((1 + n) / (1 + df[cols])) + 1e-9
+
+        # L2-нормировка векторов строк
+        norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=n))
+        weights = weights / norms[rows]
+
+        # Центральность: скалярное произведение строки на центроид беседы
+        centroid = np.bincount(cols, weights=weights, minlength=vocab_size) / n
+        scores = np.bincount(rows, weights=weights * centroid[cols], minlength=n)
+        if scores.max() > 0:
+            scores = scores / scores.max()
+
+    raw = data.tobytes()
+    decisions = [position for stem in DECISION_STEMS for position in _find_all(raw, stem)]
+    links = np.flatnonzero((data[:-1] == ord('<')) & WORD_BYTES[data[1:]]).tolist() + _find_all(raw, b'://')
+
+    scores = scores + DECISION_BOOST * _rows_of(np.asarray(decisions, dtype=np.int64), separators, n)
+    scores = scores + MENTION_BOOST * _rows_of(np.flatnonzero(data == ord('@')), separators, n)
+    scores = scores + NUMBER_BOOST * _rows_of(np.flatnonzero(DIGIT_BYTES[data]), separators, n)
+    scores = scores + LINK_BOOST * _rows_of(np.asarray(links, dtype=np.int64), separators, n)
+    return scores + RECENCY_BOOST * np.linspace(0, 1, n)
+
+
+def select_salient(lines, budget_chars):
+    """
+    Отбирает самые значимые строки беседы, помещающиеся в бюджет длины,
+    и возвращает их в хронологическом порядке. Пропущенные участки
+    обозначаются строкой "[…]".
+
+    :param lines: Список строк "@user: текст" в хронологическом порядке.
+    :param budget_chars: Максимальная длина результата в символах.
+    :return: Список выбранных строк.
+    """
+    if not lines:
+        return []
+
+    scores = score_lines(lines)
+    lengths = np.fromiter((len(line) + 1 for line in lines), dtype=np.int64, count=len(lines))
+    order = np.argsort(-scores, kind='stable')
+    budget = int(budget_chars * 0.95) # Запас под маркеры пропусков
+
+    # Самая значимая строка длиннее всего бюджета обрезается, а не теряется
+    replaced = {}
+    top = int(order[0])
+    if lengths[top] > budget:
+        replaced[top] = lines[top][:max(budget - 2, 0)] + "…"
+        lengths[top] = len(replaced[top]) + 1
+
+    # Берём строки по убыванию значимости; не поместившуюся строку пропускаем
+    # и продолжаем с менее значимыми, пока в бюджете есть место хотя бы для самой короткой
+    taken = []
+    remaining = budget
+    shortest = int(lengths.min())
+    for index, length in zip(order.tolist(), lengths[order].tolist()):
+        if length <= remaining:
+            taken.append(index)
+            remaining -= length
+            if remaining < shortest:
+                break
+    selected = sorted(taken)
+
+    result = []
+    previous = -1
+    for index in selected:
+        if index != previous + 1:
+            result.append("[…]")
+        result.append(replaced.get(index, lines[index]))
+        previous = index
+    if previous != len(lines) - 1:
+        result.append("[…]")
+
+    logger.info(f"Отобрано значимых строк: {len(selected)} из {len(lines)}")
+    return result
@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+from collections import deque
+from src.config import *
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+
+# Очередь исходящих личных сообщений с пакетированием, ограничением частоты и повторами
+class OutboundSendQueue:
+    def __init__(self, deliver, rate=SEND_RATE, max_retries=SEND_MAX_RETRIES, batch_max_chars=SEND_BATCH_MAX_CHARS):
+        """
+        Конструктор класса OutboundSendQueue.
+        Сообщения отправляются одним фоновым потоком в порядке постановки,
+        поэтому обработка команд не ждёт сетевых запросов к Rocket.Chat.
+
+        :param deliver: Функция (username, text) -> bool, выполняющая фактическую отправку ЛС.
+        :param rate: Максимальное количество отправок в секунду.
+        :param max_retries: Количество повторов при неудачной отправке.
+        :param batch_max_chars: Максимальная длина сообщения, получаемого склейкой нескольких подряд идущих.
+        """
+        self.deliver = deliver
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.max_retries = max_retries
+        self.batch_max_chars = batch_max_chars
+        self.pending = deque() # Элементы (username, text)
+        self.condition = threading.Condition()
+        self.in_flight = None # Получатель пакета, который сейчас отправляется
+        self.stopping = False
+        self.thread = None
+        self.last_send = 0.0
+
+    def put(self, username, text):
+        """
+        Ставит личное сообщение в очередь на отправку.
+
+        :param username: Имя получателя.
+        :param text: Текст сообщения.
+        :return: True (сообщение принято в очередь).
+        """
+        with self.condition:
+            self.pending.append((username, text))
+            self.condition.notify()
+        return True
+
+    def start(self):
+        """
+        Запускает поток отправки.
+        """
+        self.thread = threading.Thread(target=self._run, name='send-queue', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Дожидается отправки накопленных сообщений и останавливает поток.
+
+        :param timeout: Максимальное время ожидания в секундах.
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join(timeout)
+        if self.pending:
+            logger.warning(f"Не отправлено сообщений при остановке: {len(self.pending)}")
+
+    def size(self):
+        """
+        Возвращает количество сообщений, ожидающих отправки.
+        """
+        with self.condition:
+            return len(self.pending) + (1 if self.in_flight is not None else 0)
+
+    def wait_user(self, username, timeout=None):
+        """
+        Дожидается отправки всех сообщений пользователю, поставленных в очередь до вызова.
+
+        :param username: Имя получателя.
+        :param timeout: Максимальное время ожидания в секундах.
+        :return: True, если сообщений пользователю в очереди не осталось, False по таймауту.
+        """
+        def sent():
+            return self.in_flight != username and all(item[0] != username for item in self.pending)
+
+        with self.condition:
+            if not self.thread or not self.thread.is_alive():
+                return sent() # Поток отправки не работает — ждать нечего
+            return self.condition.wait_for(sent, timeout)
+
+    def dump_state(self):
+        """
+        Выгружает неотправленные сообщения для снимка тёплого перезапуска.
+        """
+        with self.condition:
+            return [list(item) for item in self.pending]
+
+    def restore_state(self, state):
+        """
+        Возвращает в очередь сообщения, не отправленные до перезапуска.
+        """
+        for username, text in state:
+            self.put(username, text)
+        if state:
+            logger.info(f"Восстановлено неотправленных сообщений: {len(state)}")
+
+    def _next_batch(self):
+        """
+        Забирает из очереди первое сообщение и склеивает с ним следующие
+        подряд идущие сообщения тому же получателю, пока не превышен лимит длины.
+        """
+        username, text = self.pending.popleft()
+        parts = [text]
+        length = len(text)
+        while self.pending and self.pending[0][0] == username:
+            next_text = self.pending[0][1]
+            if length + len(next_text) + 2 > self.batch_max_chars:
+                break
+            self.pending.popleft()
+            parts.append(next_text)
+            length += len(next_text) + 2
+        return username, "\n\n".join(parts), len(parts)
+
+    def _run(self):
+        """
+        Основной цикл отправки.
+        """
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                username, text, count = self._next_batch()
+                self.in_flight = username
+
+            try:
+                self._send_with_retries(username, text, count)
+            finally:
+                with self.condition:
+                    self.in_flight = None
+                    self.condition.notify_all() # Будим ожидающих в wait_user()
+
+    def _send_with_retries(self, username, text, count):
+        """
+        Отправляет пакет с соблюдением частоты и экспоненциальной паузой между повторами.
+        """
+        for attempt in range(self.max_retries + 1):
+            delay = self.last_send + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.last_send = time.monotonic()
+
+            try:
+                if self.deliver(username, text):
+                    if count > 1:
+                        logger.debug(f"Отправлено {count} сообщений одним пакетом пользователю {username}")
+                    return True
+            except Exception as e:
+                logger.error(f"Исключение при отправке из очереди: {e}")
+
+            if attempt < self.max_retries:
+                time.sleep(2 ** attempt)
+
+        logger.error(f"Не удалось отправить ЛС пользователю {username} после {self.max_retries + 1} попыток")
+        return False
@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import threading
+import time
+from src.config import *
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+# Версия формата снимка: при несовместимом изменении состава разделов её нужно увеличить,
+# тогда старый снимок будет проигнорирован и бот стартует «с холода»
+SNAPSHOT_VERSION = 1
+
+
+# Снимок состояния бота для тёплого перезапуска
+class StateSnapshot:
+    def __init__(self, path=STATE_SNAPSHOT_FILE, interval=STATE_SNAPSHOT_INTERVAL, max_age=STATE_SNAPSHOT_MAX_AGE):
+        """
+        Конструктор класса StateSnapshot.
+        Компоненты регистрируют разделы снимка (функции выгрузки и восстановления),
+        снимок пишется атомарно (временный файл + os.replace) в фоне и при остановке.
+
+        :param path: Путь к файлу снимка.
+        :param interval: Интервал фонового сохранения в секундах.
+        :param max_age: Максимальный возраст снимка в секундах, после которого он не восстанавливается.
+        """
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.sections = {} # Имя раздела -> (dump, restore, final_only)
+        self.lock = threading.Lock() # Сохранения из фонового потока и при остановке не пересекаются
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def register(self, name, dump, restore, final_only=False):
+        """
+        Регистрирует раздел снимка.
+
+        :param name: Имя раздела.
+        :param dump: Функция без аргументов, возвращающая JSON-совместимое состояние.
+        :param restore: Функция, принимающая сохранённое состояние.
+        :param final_only: Сохранять раздел только при остановке (например, очередь отправки:
+            после аварийного завершения её восстановление привело бы к повторным ответам).
+        """
+        self.sections[name] = (dump, restore, final_only)
+
+    def save(self, final=False):
+        """
+        Сохраняет снимок всех разделов.
+
+        :param final: Итоговый снимок при остановке (включает разделы final_only).
+        :return: True, если снимок записан.
+        """
+        data = {'version': SNAPSHOT_VERSION, 'saved_at': time.time(), 'sections': {}}
+        for name, (dump, _, final_only) in self.sections.items():
+            if final_only and not final:
+                continue
+            try:
+                data['sections'][name] = dump()
+            except Exception as e:
+                logger.error(f"Ошибка выгрузки раздела снимка '{name}': {e}")
+
+        with self.lock:
+            try:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno()) # Снимок на диске целиком до подмены файла
+                os.replace(tmp_path, self.path)
+                logger.debug(f"Снимок состояния сохранён: {self.path}")
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка сохранения снимка состояния: {e}")
+                return False
+
+    def restore(self):
+        """
+        Восстанавливает зарегистрированные разделы из снимка, если он совместим и не устарел.
+
+        :return: Список восстановленных разделов.
+        """
+        try:
+            if not os.path.exists(self.path):
+                logger.info("Снимок состояния не найден, холодный старт")
+                return []
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.warning(f"Ошибка чтения снимка состояния: {e}")
+            return []
+
+        if data.get('version') != SNAPSHOT_VERSION:
+            logger.warning(f"Версия снимка {data.get('version')} не совпадает с {SNAPSHOT_VERSION}, снимок пропущен")
+            return []
+        age = time.time() - data.get('saved_at', 0)
+        if age > self.max_age:
+            logger.info(f"Снимок состояния устарел ({age:.0f} с), холодный старт")
+            return []
+
+        restored = []
+        for name, state in data.get('sections', {}).items():
+            if name not in self.sections:
+                continue
+            try:
+                self.sections[name][1](state)
+                restored.append(name)
+            except Exception as e:
+                logger.error(f"Ошибка восстановления раздела снимка '{name}': {e}")
+        logger.info(f"Состояние восстановлено из снимка возрастом {age:.0f} с: {', '.join(restored)}")
+        return restored
+
+    def start(self):
+        """
+        Запускает фоновое сохранение снимка.
+        """
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name='state-snapshot', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Останавливает фоновое сохранение и записывает итоговый снимок.
+
+        :param timeout: Максимальное время ожидания потока в секундах.
+        """
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
+        self.save(final=True)
+
+    def _run(self):
+        """
+        Периодически сохраняет снимок.
+        """
+        while not self.stop_event.wait(self.interval):
+            self.save()
@@ -0,0 +1,202 @@
+import hashlib
+import itertools
+import logging
+import threading
+import time
+import numpy as np
+from src.config import *
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+MODE_REUSE = 'reuse' # Беседа почти не изменилась — отдаём готовую сводку
+MODE_DELTA = 'delta' # Беседа изменилась умеренно — дополняем сводку новыми строками
+
+
+def hash_lines(lines, unique=True):
+    """
+    Возвращает стабильные (не зависящие от процесса) 64-битные хэши строк беседы.
+
+    :param lines: Строки "@user: текст".
+    :param unique: Вернуть отсортированное множество хэшей, а не хэши по порядку строк.
+    :return: Массив хэшей uint64.
+    """
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(line.encode('utf-8'), digest_size=8).digest(), 'little') for line in lines),
+        dtype=np.uint64, count=len(lines)
+    )
+    return np.unique(hashes) if unique else hashes
+
+
+# Результат поиска в кэше
+class CacheMatch:
+    __slots__ = ('mode', 'similarity', 'summary', 'new_lines')
+
+    def __init__(self, mode, similarity, summary, new_lines):
+        """
+        :param mode: MODE_REUSE или MODE_DELTA.
+        :param similarity: Оценка сходства Жаккара с сохранённой беседой.
+        :param summary: Сохранённая сводка (без суффикса промпта).
+        :param new_lines: Строки, которых не было в сохранённой беседе (для дельта-обновления).
+        """
+        self.mode = mode
+        self.similarity = similarity
+        self.summary = summary
+        self.new_lines = new_lines
+
+
+# Кэш сводок с поиском почти одинаковых бесед по MinHash и LSH
+class SummaryCache:
+    def __init__(self, reuse_threshold=SUMMARY_CACHE_REUSE_THRESHOLD, delta_threshold=SUMMARY_CACHE_DELTA_THRESHOLD,
+                 ttl=SUMMARY_CACHE_TTL, permutations=SUMMARY_CACHE_PERMUTATIONS, bands=SUMMARY_CACHE_BANDS,
+                 max_entries=SUMMARY_CACHE_MAX_ENTRIES):
+        """
+        Конструктор класса SummaryCache.
+        Беседа рассматривается как множество строк; сходство двух бесед — коэффициент
+        Жаккара, который оценивается по MinHash-сигнатурам. Кандидаты ищутся по LSH:
+        сигнатура делится на полосы, совпадение хотя бы одной полосы делает запись кандидатом.
+
+        :param reuse_threshold: Сходство, начиная с которого сводка отдаётся без запроса к LLM.
+        :param delta_threshold: Сходство, начиная с которого сводка дополняется только новыми строками (0 — выключено).
+        :param ttl: Время жизни записи в секундах.
+        :param permutations: Длина MinHash-сигнатуры.
+        :param bands: Количество полос LSH (должно делить permutations).
+        :param max_entries: Максимальное количество записей.
+        """
+        if permutations % bands:
+            raise ValueError("SUMMARY_CACHE_PERMUTATIONS должно делиться на SUMMARY_CACHE_BANDS")
+        self.reuse_threshold = reuse_threshold
+        self.delta_threshold = delta_threshold or reuse_threshold
+        self.ttl = ttl
+        self.bands = bands
+        self.rows = permutations // bands
+        self.max_entries = max_entries
+
+        # Семейство хэш-функций multiply-shift: h(x) = ((a * x + b) mod 2^64) >> 32, a — нечётное
+        rng = np.random.default_rng(20240501) # Фиксированное зерно: сигнатуры сравнимы между перезапусками
+        self.a = rng.integers(1, 2 ** 63, size=permutations, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.integers(0, 2 ** 63, size=permutations, dtype=np.uint64)
+
+        self.entries = {} # ID -> запись
+        self.index = {} # (комната, промпт, полоса, хэш полосы) -> множество ID
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.counters = {'lookups': 0, MODE_REUSE: 0, MODE_DELTA: 0, 'misses': 0}
+
+    def signature(self, hashes):
+        """
+        Вычисляет MinHash-сигнатуру множества хэшей строк.
+        """
+        if len(hashes) == 0:
+            return np.full(len(self.a), np.iinfo(np.uint64).max, dtype=np.uint64)
+        with np.errstate(over='ignore'): # Переполнение uint64 — это и есть умножение по модулю 2^64
+            values = (self.a[:, None] * hashes[None, :] + self.b[:, None]) >> np.uint64(32)
+        return values.min(axis=1)
+
+    def _band_keys(self, room_name, prompt_name, signature):
+        """
+        Ключи индекса LSH для сигнатуры.
+        """
+        room = room_name.lower()
+        return [(room, prompt_name, band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                for band in range(self.bands)]
+
+    def _remove(self, entry_id):
+        """
+        Удаляет запись и её ключи из индекса. Вызывается под блокировкой.
+        """
+        entry = self.entries.pop(entry_id, None)
+        if entry:
+            for key in entry['band_keys']:
+                bucket = self.index.get(key)
+                if bucket:
+                    bucket.discard(entry_id)
+                    if not bucket:
+                        del self.index[key]
+
+    def lookup(self, room_name, prompt_name, lines):
+        """
+        Ищет сводку похожей беседы той же комнаты и с тем же промптом.
+
+        :param room_name: Имя комнаты.
+        :param prompt_name: Имя промпта.
+        :param lines: Строки беседы "@user: текст".
+        :return: CacheMatch или None.
+        """
+        hashes = hash_lines(lines)
+        signature = self.signature(hashes)
+        now = time.time()
+        best, best_similarity = None, 0.0
+        with self.lock:
+            self.counters['lookups'] += 1
+            candidates = set()
+            for key in self._band_keys(room_name, prompt_name, signature):
+                candidates |= self.index.get(key, set())
+            for entry_id in candidates:
+                entry = self.entries.get(entry_id)
+                if not entry:
+                    continue
+                if now - entry['created_at'] > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                similarity = float(np.mean(entry['signature'] == signature))
+                if similarity > best_similarity:
+                    best, best_similarity = entry, similarity
+
+            if best is None or best_similarity < self.delta_threshold:
+                self.counters['misses'] += 1
+                return None
+            best['used_at'] = now
+
+            new_lines = []
+            if best_similarity < self.reuse_threshold:
+                known = best['hashes']
+                line_hashes = hash_lines(lines, unique=False)
+                positions = np.minimum(np.searchsorted(known, line_hashes), len(known) - 1)
+                new_lines = [line for line, missing in zip(lines, known[positions] != line_hashes) if missing]
+            # Без новых строк беседа лишь потеряла старые сообщения — сводка по-прежнему подходит
+            mode = MODE_DELTA if new_lines else MODE_REUSE
+            self.counters[mode] += 1
+        logger.info(f"Кэш сводок #{room_name} ({prompt_name}): {mode}, сходство {best_similarity:.2f}")
+        return CacheMatch(mode, best_similarity, best['summary'], new_lines)
+
+    def store(self, room_name, prompt_name, lines, summary):
+        """
+        Сохраняет сводку беседы.
+
+        :param room_name: Имя комнаты.
+        :param prompt_name: Имя промпта.
+        :param lines: Строки беседы "@user: текст".
+        :param summary: Сводка (без суффикса промпта).
+        """
+        hashes = hash_lines(lines)
+        signature = self.signature(hashes)
+        band_keys = self._band_keys(room_name, prompt_name, signature)
+        now = time.time()
+        with self.lock:
+            entry_id = next(self.ids)
+            self.entries[entry_id] = {
+                'signature': signature,
+                'hashes': hashes,
+                'summary': summary,
+                'band_keys': band_keys,
+                'created_at': now,
+                'used_at': now
+            }
+            for key in band_keys:
+                self.index.setdefault(key, set()).add(entry_id)
+            # Вытесняем давно не использованные записи
+            while len(self.entries) > self.max_entries:
+                self._remove(min(self.entries, key=lambda i: self.entries[i]['used_at']))
+
+    def stats(self):
+        """
+        Возвращает счётчики обращений и долю попаданий.
+
+        :return: Словарь {'lookups', 'reuse', 'delta', 'misses', 'hit_rate', 'entries'}.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+        stats['hit_rate'] = (stats[MODE_REUSE] + stats[MODE_DELTA]) / stats['lookups'] if stats['lookups'] else 0.0
+        return stats
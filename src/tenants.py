@@ -0,0 +1,269 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.chatbot import RocketChatBot
+from src.digest_scheduler import DigestScheduler
+from src.message_handler import MessageHandler
+from src.poll_scheduler import PollScheduler
+from src.send_queue import OutboundSendQueue
+from src.webhook_server import WebhookServer
+from src.config import *
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+# Имя арендатора используется в путях к данным и в ключах общих компонентов
+TENANT_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def load_tenants(path=TENANTS_FILE):
+    """
+    Загружает и проверяет список арендаторов.
+    Формат файла — JSON-список объектов:
+    {"name", "url", "user", "password" | "password_env", "user_id", "auth_token",
+     "default_prompt", "admins", "webhook_port", "webhook_token"}.
+
+    :param path: Путь к JSON-файлу.
+    :return: Список словарей с настройками арендаторов.
+    :raises ValueError: Если файл содержит ошибки.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        tenants = json.load(f)
+    if not isinstance(tenants, list) or not tenants:
+        raise ValueError(f"{path}: ожидается непустой список арендаторов")
+
+    names = set()
+    for tenant in tenants:
+        name = tenant.get('name', '')
+        if not TENANT_NAME_PATTERN.match(name):
+            raise ValueError(f"{path}: неверное имя арендатора '{name}' (допустимы буквы, цифры, '_' и '-')")
+        if name in names:
+            raise ValueError(f"{path}: арендатор '{name}' указан дважды")
+        names.add(name)
+        if not tenant.get('url'):
+            raise ValueError(f"{path}: у арендатора '{name}' не задан url")
+        if tenant.get('password_env'):
+            tenant['password'] = os.getenv(tenant['password_env']) # Пароль не хранится в файле
+        if not (tenant.get('user') and tenant.get('password')) and not (tenant.get('user_id') and tenant.get('auth_token')):
+            raise ValueError(f"{path}: у арендатора '{name}' нет ни user/password, ни user_id/auth_token")
+        if tenant.get('webhook_port') and not tenant.get('webhook_token'):
+            # Без токена кто угодно мог бы писать боту от имени администраторов арендатора
+            raise ValueError(f"{path}: у арендатора '{name}' задан webhook_port, но не задан webhook_token")
+    return tenants
+
+
+# Бот одного арендатора: свой сервер, учётная запись, обработанные сообщения и промпт по умолчанию
+class Tenant:
+    def __init__(self, config, llm_service, job_queue=None, fast_lane=None, digest_executor=None):
+        """
+        Конструктор класса Tenant.
+        Собственные компоненты арендатора — подключение к Rocket.Chat, опрос ЛС, очередь отправки,
+        обработчик команд и подписки (в каталоге TENANTS_DATA_DIR/<имя>). LLM, очередь задач,
+        быстрая полоса и пул расчёта сводок общие для всех арендаторов процесса.
+
+        :param config: Настройки арендатора из load_tenants().
+        :param llm_service: Общий экземпляр LLMService.
+        :param job_queue: Общая очередь задач SummaryJobQueue.
+        :param fast_lane: Общая быстрая полоса FastLane.
+        :param digest_executor: Общий пул потоков расчёта регулярных сводок.
+        """
+        self.name = config['name']
+        self.data_dir = os.path.join(TENANTS_DATA_DIR, self.name)
+        os.makedirs(self.data_dir, exist_ok=True)
+
+        self.chatbot = RocketChatBot(
+            server_url=config['url'],
+            user=config.get('user'),
+            password=config.get('password'),
+            user_id=config.get('user_id'),
+            auth_token=config.get('auth_token'),
+            data_dir=self.data_dir
+        )
+        self.poll_scheduler = PollScheduler()
+        self.chatbot.poll_scheduler = self.poll_scheduler
+        self.send_queue = OutboundSendQueue(self.chatbot.deliver_direct_message)
+        self.chatbot.send_queue = self.send_queue
+
+        default_prompt = config.get('default_prompt')
+        if default_prompt and default_prompt not in llm_service.prompts:
+            logger.warning(f"[{self.name}] Промпт '{default_prompt}' не найден, используется промпт по умолчанию")
+            default_prompt = None
+        self.message_handler = MessageHandler(
+            self.chatbot, llm_service, job_queue, fast_lane=fast_lane,
+            tenant=self.name, admins=config.get('admins', []), default_prompt=default_prompt
+        )
+        # Расписание проверяет общий цикл TenantRuntime, а сводки считаются в общем пуле
+        self.digest_scheduler = DigestScheduler(
+            self.message_handler.compute_room_summary, self.chatbot.send_direct_message,
+            db_path=os.path.join(self.data_dir, 'digests.sqlite3'), executor=digest_executor
+        )
+        self.message_handler.digest_scheduler = self.digest_scheduler
+
+        self.webhook_server = None
+        if config.get('webhook_port'):
+            self.webhook_server = WebhookServer(
+                self.message_handler.process_direct_message, token=config.get('webhook_token'),
+                port=int(config['webhook_port']), bot_username=self.chatbot.bot_username
+            )
+
+    def start(self):
+        """
+        Запускает очередь отправки и, если настроен, приём вебхуков.
+        """
+        self.send_queue.start()
+        if self.webhook_server:
+            self.webhook_server.start()
+
+    def poll(self):
+        """
+        Один шаг опроса личных сообщений арендатора.
+
+        :return: True, если были новые сообщения.
+        """
+        direct_messages = self.chatbot.get_direct_messages()
+        for message in direct_messages:
+            self.message_handler.process_direct_message(message)
+        self.save_processed()
+        return bool(direct_messages)
+
+    def save_processed(self):
+        """
+        Ограничивает и сохраняет список обработанных сообщений.
+        """
+        self.chatbot.clear_processed_messages()
+        self.chatbot.save_processed_messages()
+
+    def register_snapshot(self, snapshot):
+        """
+        Регистрирует разделы арендатора в общем снимке тёплого перезапуска.
+        """
+        snapshot.register(f"{self.name}.chatbot", self.chatbot.dump_state, self.chatbot.restore_state)
+        snapshot.register(f"{self.name}.poll_scheduler", self.poll_scheduler.dump_state, self.poll_scheduler.restore_state)
+        snapshot.register(f"{self.name}.send_queue", self.send_queue.dump_state, self.send_queue.restore_state, final_only=True)
+        snapshot.register(f"{self.name}.message_handler", self.message_handler.dump_state, self.message_handler.restore_state)
+
+    def stop_ingestion(self, timeout=None):
+        """
+        Останавливает приём сообщений арендатора (вебхуки) и сохраняет обработанные сообщения.
+        """
+        if self.webhook_server:
+            self.webhook_server.stop(timeout=timeout) # Дожидаемся обработки принятых вебхуков
+        self.chatbot.save_processed_messages()
+
+    def stop(self, timeout=None):
+        """
+        Дожидается отправки накопленных ответов арендатора.
+        """
+        self.send_queue.stop(timeout=timeout)
+
+
+# Общий цикл опроса и расписания для всех арендаторов процесса
+class TenantRuntime:
+    def __init__(self, tenants, poll_workers=TENANT_POLL_WORKERS, digest_tick=DIGEST_TICK):
+        """
+        Конструктор класса TenantRuntime.
+        Один поток планирует опрос всех арендаторов: каждый опрашивается со своим адаптивным
+        интервалом в небольшом общем пуле, поэтому простаивающие арендаторы не держат своих потоков,
+        а медленный сервер одного арендатора не задерживает опрос остальных.
+
+        :param tenants: Список экземпляров Tenant.
+        :param poll_workers: Количество потоков опроса.
+        :param digest_tick: Интервал проверки расписания подписок в секундах.
+        """
+        self.tenants = {tenant.name: tenant for tenant in tenants}
+        self.executor = ThreadPoolExecutor(max_workers=max(1, poll_workers), thread_name_prefix='tenant-poll')
+        self.digest_tick = digest_tick
+        self.next_poll = {name: 0.0 for name in self.tenants} # Имя -> время следующего опроса (monotonic)
+        self.polling = set() # Арендаторы, опрос которых сейчас выполняется
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event() # Опрос завершён — пора пересчитать ближайший срок
+        self.stop_event = threading.Event()
+
+    def job_handler(self, method):
+        """
+        Возвращает обработчик задач общей очереди, передающий задачу обработчику её арендатора.
+
+        :param method: Имя метода MessageHandler (run_summary_job, run_digest_job).
+        """
+        def handle(job):
+            tenant = self.tenants.get(job.get('tenant'))
+            if tenant is None:
+                raise ValueError(f"Неизвестный арендатор '{job.get('tenant')}'")
+            return getattr(tenant.message_handler, method)(job)
+        return handle
+
+    def notify_failed(self, job, error):
+        """
+        Сообщает пользователю арендатора, что задача окончательно провалена.
+        """
+        tenant = self.tenants.get(job.get('tenant'))
+        if tenant:
+            tenant.message_handler.notify_summary_failed(job, error)
+
+    def run(self):
+        """
+        Основной цикл: запускает опрос арендаторов, чей срок наступил, и проверяет расписание подписок.
+        Возвращается после stop().
+        """
+        next_digest = 0.0
+        while not self.stop_event.is_set():
+            self.wakeup.clear()
+            now = time.monotonic()
+            with self.lock:
+                due = [tenant for name, tenant in self.tenants.items()
+                       if not tenant.webhook_server and name not in self.polling and self.next_poll[name] <= now]
+                self.polling.update(tenant.name for tenant in due)
+            for tenant in due:
+                self.executor.submit(self._poll, tenant)
+
+            if now >= next_digest:
+                for tenant in self.tenants.values():
+                    try:
+                        tenant.digest_scheduler.run_due()
+                        if tenant.webhook_server:
+                            tenant.save_processed() # У арендаторов с вебхуками нет шага опроса
+                    except Exception as e:
+                        logger.error(f"[{tenant.name}] Ошибка планировщика сводок: {e}")
+                next_digest = now + self.digest_tick
+
+            with self.lock:
+                deadlines = [self.next_poll[name] for name, tenant in self.tenants.items()
+                             if not tenant.webhook_server and name not in self.polling]
+            self.wakeup.wait(max(0.0, min(deadlines + [next_digest]) - time.monotonic()))
+
+    def _poll(self, tenant):
+        """
+        Опрашивает арендатора и назначает следующий опрос по его собственному интервалу.
+        """
+        had_activity = False
+        try:
+            had_activity = tenant.poll()
+        except Exception as e:
+            logger.error(f"[{tenant.name}] Ошибка опроса: {e}") # Ошибка одного арендатора не влияет на остальных
+        interval = tenant.poll_scheduler.next_interval(had_activity)
+        with self.lock:
+            self.next_poll[tenant.name] = time.monotonic() + interval
+            self.polling.discard(tenant.name)
+        self.wakeup.set()
+
+    def stop(self):
+        """
+        Прерывает основной цикл (можно вызывать из обработчика сигнала).
+        """
+        self.stop_event.set()
+        self.wakeup.set()
+
+    def close(self, timeout=None):
+        """
+        Дожидается текущих опросов и останавливает приём сообщений всех арендаторов.
+        Очереди отправки останавливаются отдельно (Tenant.stop), после выполнения принятых команд.
+
+        :param timeout: Максимальное время ожидания для каждого арендатора в секундах.
+        """
+        self.executor.shutdown(wait=True)
+        for tenant in self.tenants.values():
+            tenant.stop_ingestion(timeout=timeout)
@@ -1,17 +1,58 @@
-import requests
+import argparse
+import json
 import os
-from dotenv import load_dotenv
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from src.config import *
+from src.latency_stats import percentile
+
+# Эндпоинты, от которых зависит бот. chat.postMessage пишет в комнату, поэтому
+# замеряется только при явно указанной тестовой комнате (--sandbox-room)
+ENDPOINTS = ['info', 'me', 'im.list', 'im.history', 'channels.list', 'channels.history', 'chat.postMessage', 'llm']
 
-load_dotenv()
 
-def test_connection():
-    base_url = os.getenv('ROCKETCHAT_URL', '')
-    user_id = os.getenv('ROCKETCHAT_USER_ID')
-    auth_token = os.getenv('ROCKETCHAT_AUTH_TOKEN')
-    
+def auth_headers():
+    """
+    Возвращает заголовки аутентификации Rocket.Chat: токен из окружения,
+    сохранённый ботом токен или новый токен, полученный по логину и паролю.
+    """
+    user_id, auth_token = ROCKETCHAT_USER_ID, ROCKETCHAT_AUTH_TOKEN
+    if not (user_id and auth_token) and os.path.exists(AUTH_TOKEN_CACHE):
+        try:
+            with open(AUTH_TOKEN_CACHE, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get('server_url') == ROCKETCHAT_URL and cached.get('user') == ROCKETCHAT_USER:
+                user_id, auth_token = cached.get('user_id'), cached.get('auth_token')
+        except Exception:
+            pass
+    if not (user_id and auth_token) and ROCKETCHAT_USER and ROCKETCHAT_PASSWORD:
+        response = requests.post(f"{ROCKETCHAT_URL}/api/v1/login",
+                                 json={'user': ROCKETCHAT_USER, 'password': ROCKETCHAT_PASSWORD}, timeout=10)
+        if response.status_code == 200:
+            data = response.json().get('data', {})
+            user_id, auth_token = data.get('userId'), data.get('authToken')
+    return {
+        'X-User-Id': user_id or '',
+        'X-Auth-Token': auth_token or '',
+        'Content-Type': 'application/json'
+    }
+
+
+def test_connection(headers=None):
+    """
+    Однократная проверка доступности сервера, аутентификации и списка комнат.
+
+    :param headers: Заголовки аутентификации (по умолчанию auth_headers()).
+    :return: True, если сервер доступен и аутентификация успешна.
+    """
+    base_url = ROCKETCHAT_URL
+    headers = headers or auth_headers()
+
     print("🔍 Тестирование подключения к Rocket.Chat")
     print("=" * 50)
-    
+
     # 1. Проверка базового подключения
     print("1. Проверка доступности Rocket.Chat...")
     try:
@@ -26,15 +67,9 @@ def test_connection():
     except Exception as e:
         print(f"❌ Ошибка подключения: {e}")
         return False
-    
+
     # 2. Проверка аутентификации
     print("\n2. Проверка аутентификации...")
-    headers = {
-        'X-User-Id': user_id,
-        'X-Auth-Token': auth_token,
-        'Content-Type': 'application/json'
-    }
-    
     try:
         response = requests.get(f"{base_url}/api/v1/me", headers=headers, timeout=10)
         if response.status_code == 200:
@@ -52,7 +87,7 @@ def test_connection():
     except Exception as e:
         print(f"❌ Ошибка при аутентификации: {e}")
         return False
-    
+
     # 3. Проверка получения списка комнат
     print("\n3. Проверка получения списка комнат...")
     try:
@@ -69,8 +104,205 @@ def test_connection():
             print(f"❌ Ошибка HTTP при получении комнат: {response.status_code}")
     except Exception as e:
         print(f"❌ Ошибка при получении комнат: {e}")
-    
+
     return True
 
+
+def build_probes(args, headers):
+    """
+    Описывает запросы для замера: имя -> (метод, URL, функция номера вызова -> аргументы requests).
+    Эндпоинты, для которых нет нужных данных (ЛС, тестовой комнаты, настроек LLM), пропускаются с причиной.
+
+    :return: Кортеж (пробы, {имя: причина пропуска}).
+    """
+    api = f"{ROCKETCHAT_URL}/api/v1"
+    probes, skipped = {}, {}
+    probes['info'] = ('GET', f"{ROCKETCHAT_URL}/api/info", lambda i: {})
+    probes['me'] = ('GET', f"{api}/me", lambda i: {'headers': headers})
+    probes['im.list'] = ('GET', f"{api}/im.list", lambda i: {'headers': headers, 'params': {'count': 50}})
+    probes['channels.list'] = ('GET', f"{api}/channels.list", lambda i: {'headers': headers, 'params': {'count': 50}})
+    probes['channels.history'] = ('GET', f"{api}/channels.history",
+                                  lambda i: {'headers': headers, 'params': {'roomName': args.room, 'count': args.history_count}})
+
+    # Для im.history нужна комната ЛС бота: берём первую из списка
+    try:
+        ims = requests.get(f"{api}/im.list", headers=headers, params={'count': 1}, timeout=args.timeout).json().get('ims', [])
+    except Exception:
+        ims = []
+    if ims:
+        probes['im.history'] = ('GET', f"{api}/im.history",
+                                lambda i: {'headers': headers, 'params': {'roomId': ims[0]['_id'], 'count': args.history_count}})
+    else:
+        skipped['im.history'] = "у бота нет личных сообщений"
+
+    if args.sandbox_room:
+        run_id = int(time.time())
+        probes['chat.postMessage'] = ('POST', f"{api}/chat.postMessage", lambda i: {
+            'headers': headers,
+            'json': {'channel': f"#{args.sandbox_room.lstrip('#')}", 'text': f"latency probe {run_id}/{i}"}
+        })
+    else:
+        skipped['chat.postMessage'] = "не задана --sandbox-room"
+
+    if OPEN_AI_BASE_URL and OPEN_AI_API_KEY and LLM_NAME:
+        # Минимальный запрос: измеряем задержку API, а не генерацию
+        probes['llm'] = ('POST', f"{OPEN_AI_BASE_URL}{OPEN_AI_COMPLETIONS_PATHNAME}", lambda i: {
+            'headers': {"Authorization": f"Bearer {OPEN_AI_API_KEY}", "Content-Type": "application/json"},
+            'json': {"model": LLM_NAME, "messages": [{"role": "user", "content": "ping"}], "max_tokens": 1}
+        })
+    else:
+        skipped['llm'] = "не настроен OPEN_AI_BASE_URL/OPEN_AI_API_KEY/LLM_NAME"
+
+    selected = [name for name in ENDPOINTS if name in args.endpoints]
+    return ({name: probes[name] for name in selected if name in probes},
+            {name: skipped[name] for name in selected if name in skipped})
+
+
+def bench_endpoint(method, url, make_kwargs, count, concurrency, timeout, reuse=True):
+    """
+    Выполняет count запросов к эндпоинту с заданной параллельностью.
+
+    :param reuse: Использовать общий пул keep-alive соединений (иначе новое соединение на каждый запрос).
+    :return: Словарь с перцентилями задержки, пропускной способностью, ошибками и переиспользованием соединений.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def call(i):
+        client = session if reuse else requests.Session()
+        started = time.perf_counter()
+        try:
+            response = client.request(method, url, timeout=timeout, **make_kwargs(i))
+            response.content # Тело читается целиком, как при обычной работе бота
+            status = str(response.status_code)
+        except Exception as e:
+            status = type(e).__name__
+        finally:
+            if not reuse:
+                client.close()
+        return time.perf_counter() - started, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(call, range(count)))
+    elapsed = time.perf_counter() - started
+
+    # urllib3 считает открытые пулом соединения: остальные запросы прошли по уже открытым
+    pools = adapter.poolmanager.pools
+    connections = sum(pools[key].num_connections for key in pools.keys()) if reuse else count
+    session.close()
+
+    latencies = sorted(latency * 1000 for latency, _ in results)
+    statuses = {}
+    for _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    errors = sum(n for status, n in statuses.items() if not status.startswith('2'))
+    return {
+        'requests': count,
+        'errors': errors,
+        'error_rate': errors / count,
+        'statuses': statuses,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1],
+        'mean_ms': sum(latencies) / count,
+        'throughput_rps': count / elapsed,
+        'connections': connections,
+        'reuse_rate': 1 - connections / count
+    }
+
+
+def compare(results, baseline_path, max_regression):
+    """
+    Сравнивает p95 с сохранённым JSON-отчётом и возвращает список регрессий.
+    """
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f).get('endpoints', {})
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before and before['p95_ms'] and result['p95_ms'] > before['p95_ms'] * (1 + max_regression / 100):
+            regressions.append(f"{name}: p95 {before['p95_ms']:.1f} → {result['p95_ms']:.1f} мс")
+        if before and result['error_rate'] > before['error_rate'] + 0.01:
+            regressions.append(f"{name}: ошибки {before['error_rate'] * 100:.1f}% → {result['error_rate'] * 100:.1f}%")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка подключения и бенчмарк эндпоинтов Rocket.Chat и LLM")
+    parser.add_argument('-n', '--requests', type=int, default=20, help="запросов к каждому эндпоинту (0 — только проверка подключения)")
+    parser.add_argument('-c', '--concurrency', type=int, default=4)
+    parser.add_argument('-e', '--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument('--room', default='general', help="комната для channels.history")
+    parser.add_argument('--history-count', type=int, default=100, help="сообщений в запросах истории")
+    parser.add_argument('--sandbox-room', help="тестовая комната для chat.postMessage (без неё эндпоинт пропускается)")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--no-reuse', action='store_true', help="новое соединение на каждый запрос (для сравнения с keep-alive)")
+    parser.add_argument('--json', action='store_true', help="вывести отчёт в JSON")
+    parser.add_argument('--output', help="сохранить JSON-отчёт в файл")
+    parser.add_argument('--baseline', help="JSON-отчёт для сравнения; при регрессии код выхода 1")
+    parser.add_argument('--max-regression', type=float, default=20, help="допустимый рост p95, %%")
+    args = parser.parse_args()
+    if args.requests < 0:
+        parser.error("-n не может быть отрицательным")
+    if args.concurrency < 1:
+        parser.error("-c должно быть не меньше 1")
+    if args.json and not args.requests:
+        parser.error("--json выводит отчёт бенчмарка: укажите -n 1 или больше")
+
+    headers = auth_headers()
+    if not args.json:
+        if not test_connection(headers):
+            sys.exit(1)
+        if not args.requests:
+            return
+
+    probes, skipped = build_probes(args, headers)
+    results = {}
+    for name, (method, url, make_kwargs) in probes.items():
+        if not args.json:
+            print(f"\n⏱  {name}: {args.requests} запросов, параллельно {args.concurrency}...")
+        results[name] = bench_endpoint(method, url, make_kwargs, args.requests, args.concurrency, args.timeout, not args.no_reuse)
+
+    report = {
+        'server_url': ROCKETCHAT_URL,
+        'llm_url': OPEN_AI_BASE_URL,
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'reuse': not args.no_reuse,
+        'endpoints': results,
+        'skipped': skipped
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    regressions = compare(results, args.baseline, args.max_regression) if args.baseline else []
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print("\n📊 Результаты (мс)")
+        print("=" * 50)
+        print(f"{'эндпоинт':<18}{'p50':>8}{'p95':>8}{'p99':>8}{'запр./с':>9}{'ошибки':>8}{'reuse':>7}")
+        for name, r in results.items():
+            print(f"{name:<18}{r['p50_ms']:>8.1f}{r['p95_ms']:>8.1f}{r['p99_ms']:>8.1f}{r['throughput_rps']:>9.1f}"
+                  f"{r['error_rate'] * 100:>7.1f}%{r['reuse_rate'] * 100:>6.0f}%")
+            failed = {status: n for status, n in r['statuses'].items() if not status.startswith('2')}
+            if failed:
+                print(f"   ❌ {failed}")
+        for name, reason in skipped.items():
+            print(f"⏭  {name}: пропущен ({reason})")
+        if args.output:
+            print(f"\n💾 Отчёт сохранён: {args.output}")
+        for regression in regressions:
+            print(f"📉 Регрессия {regression}")
+    if regressions:
+        sys.exit(1)
+
+
 if __name__ == "__main__":
-    test_connection()
\ No newline at end of file
+    main()
@@ -0,0 +1,235 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from src.config import *
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+# Поля корзины скользящего окна
+REQUESTS, ERRORS, PROMPT_TOKENS, COMPLETION_TOKENS, LATENCY = range(1, 6)
+
+
+# Запрос к LLM отклонён из-за превышения квоты
+class QuotaExceededError(Exception):
+    def __init__(self, message, retry_after=0):
+        """
+        :param message: Понятное пользователю описание превышенной квоты.
+        :param retry_after: Через сколько секунд квота освободится.
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Учёт использования LLM по пользователям, комнатам и промптам и контроль квот
+class UsageMeter:
+    def __init__(self, user_tokens_per_hour=LLM_USER_TOKENS_PER_HOUR, room_tokens_per_hour=LLM_ROOM_TOKENS_PER_HOUR,
+                 user_concurrency=LLM_USER_CONCURRENCY, room_concurrency=LLM_ROOM_CONCURRENCY,
+                 window=USAGE_WINDOW, bucket=USAGE_BUCKET):
+        """
+        Конструктор класса UsageMeter.
+        Использование хранится в скользящем окне из поминутных корзин
+        [начало, запросы, ошибки, токены промпта, токены ответа, сумма задержек],
+        поэтому объём памяти не зависит от количества запросов.
+
+        :param user_tokens_per_hour: Квота токенов пользователя на окно (0 — без ограничения).
+        :param room_tokens_per_hour: Квота токенов комнаты на окно (0 — без ограничения).
+        :param user_concurrency: Одновременных запросов от пользователя (0 — без ограничения).
+        :param room_concurrency: Одновременных запросов по комнате (0 — без ограничения).
+        :param window: Длина скользящего окна в секундах.
+        :param bucket: Длина корзины в секундах.
+        """
+        self.token_limits = {'user': user_tokens_per_hour, 'room': room_tokens_per_hour}
+        self.concurrency_limits = {'user': user_concurrency, 'room': room_concurrency}
+        self.window = window
+        self.bucket = bucket
+        self.buckets = {} # (область, имя) -> deque корзин
+        self.active = {} # (область, имя) -> выполняющихся запросов
+        self.outcomes = {} # Исход -> количество за всё время работы
+        self.rejected = 0 # Запросов отклонено по квотам
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _keys(username, room_name):
+        """
+        Возвращает ключи квотируемых областей для запроса.
+        """
+        keys = []
+        if username:
+            keys.append(('user', username))
+        if room_name:
+            keys.append(('room', room_name.lower()))
+        return keys
+
+    def _expire(self, buckets, now):
+        """
+        Удаляет корзины, вышедшие за пределы окна.
+        """
+        while buckets and buckets[0][0] <= now - self.window:
+            buckets.popleft()
+
+    def _tokens(self, key, now):
+        """
+        Возвращает токены за окно и время, когда освободится самая старая корзина.
+        """
+        buckets = self.buckets.get(key)
+        if not buckets:
+            return 0, 0
+        self._expire(buckets, now)
+        tokens = sum(b[PROMPT_TOKENS] + b[COMPLETION_TOKENS] for b in buckets)
+        retry_after = buckets[0][0] + self.window - now if buckets else 0
+        return tokens, retry_after
+
+    def _check_tokens(self, keys, now):
+        """
+        Вызывает QuotaExceededError, если квота токенов исчерпана. Вызывается под блокировкой.
+        """
+        for scope, name in keys:
+            limit = self.token_limits[scope]
+            if not limit:
+                continue
+            used, retry_after = self._tokens((scope, name), now)
+            if used >= limit:
+                target = "ваша квота" if scope == 'user' else f"квота комнаты #{name}"
+                raise QuotaExceededError(
+                    f"Исчерпана {target}: {used} из {limit} токенов за {self.window // 60} мин. "
+                    f"Попробуйте через {max(1, round(retry_after / 60))} мин.",
+                    retry_after
+                )
+
+    def check(self, username=None, room_name=None):
+        """
+        Проверяет квоты токенов без занятия слота (для быстрого ответа до постановки задачи).
+
+        :raises QuotaExceededError: Если квота исчерпана.
+        """
+        with self.lock:
+            try:
+                self._check_tokens(self._keys(username, room_name), time.time())
+            except QuotaExceededError:
+                self.rejected += 1
+                raise
+
+    def acquire(self, username=None, room_name=None, fanout=False):
+        """
+        Проверяет квоты токенов и одновременных запросов и занимает слот запроса.
+        После запроса нужно вызвать release().
+
+        :param fanout: Запрос — часть сводки нескольких комнат: слот пользователя
+            уже занят через user_slot(), проверяется только квота токенов пользователя.
+        :raises QuotaExceededError: Если квота исчерпана или слишком много одновременных запросов.
+        """
+        keys = self._keys(username, room_name)
+        slot_keys = self._keys(None if fanout else username, room_name)
+        with self.lock:
+            try:
+                self._check_tokens(keys, time.time())
+                for scope, name in slot_keys:
+                    limit = self.concurrency_limits[scope]
+                    if limit and self.active.get((scope, name), 0) >= limit:
+                        target = "у вас" if scope == 'user' else f"по комнате #{name}"
+                        raise QuotaExceededError(f"Уже выполняется {limit} запрос(ов) {target}. Дождитесь результата.")
+            except QuotaExceededError:
+                self.rejected += 1
+                raise
+            for key in slot_keys:
+                self.active[key] = self.active.get(key, 0) + 1
+
+    @contextmanager
+    def user_slot(self, username):
+        """
+        Занимает слот одновременных запросов пользователя на время составной операции
+        (например, сводки нескольких комнат), внутри которой запросы идут с fanout=True.
+
+        :raises QuotaExceededError: Если у пользователя уже выполняется максимум запросов.
+        """
+        self.acquire(username)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active[('user', username)] = max(0, self.active.get(('user', username), 0) - 1)
+
+    def release(self, username=None, room_name=None, persona=None, prompt_tokens=0, completion_tokens=0, latency=0.0, outcome='ok', fanout=False):
+        """
+        Освобождает слот и записывает использование запроса.
+
+        :param username: Имя пользователя.
+        :param room_name: Имя комнаты.
+        :param persona: Имя промпта.
+        :param prompt_tokens: Токены промпта.
+        :param completion_tokens: Токены ответа.
+        :param latency: Длительность запроса в секундах.
+        :param outcome: Исход запроса: ok, rate_limited, api_error, timeout, cancelled, error.
+        :param fanout: Запрос был занят с fanout=True (слот пользователя не освобождается).
+        """
+        now = time.time()
+        start = now - now % self.bucket
+        with self.lock:
+            for key in self._keys(None if fanout else username, room_name):
+                self.active[key] = max(0, self.active.get(key, 0) - 1)
+            for key in self._keys(username, room_name) + ([('persona', persona)] if persona else []):
+                buckets = self.buckets.setdefault(key, deque())
+                self._expire(buckets, now)
+                if not buckets or buckets[-1][0] != start:
+                    buckets.append([start, 0, 0, 0, 0, 0.0])
+                current = buckets[-1]
+                current[REQUESTS] += 1
+                current[ERRORS] += outcome != 'ok'
+                current[PROMPT_TOKENS] += prompt_tokens
+                current[COMPLETION_TOKENS] += completion_tokens
+                current[LATENCY] += latency
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        logger.info(f"LLM: {username or '-'} #{room_name or '-'} ({persona}) — {outcome}, "
+                    f"{prompt_tokens}+{completion_tokens} токенов, {latency:.1f} с")
+
+    def report(self, scope, top=10, prefix=None):
+        """
+        Возвращает использование за окно по области, отсортированное по токенам.
+
+        :param scope: 'user', 'room' или 'persona'.
+        :param top: Количество записей.
+        :param prefix: Только имена с этим префиксом (например, пользователи и комнаты одного арендатора).
+        :return: Список словарей {'name', 'requests', 'errors', 'tokens', 'avg_latency', 'limit'}.
+        """
+        now = time.time()
+        rows = []
+        with self.lock:
+            for (key_scope, name), buckets in self.buckets.items():
+                if key_scope != scope or (prefix and not name.startswith(prefix)):
+                    continue
+                self._expire(buckets, now)
+                requests_count = sum(b[REQUESTS] for b in buckets)
+                if not requests_count:
+                    continue
+                rows.append({
+                    'name': name,
+                    'requests': requests_count,
+                    'errors': sum(b[ERRORS] for b in buckets),
+                    'tokens': sum(b[PROMPT_TOKENS] + b[COMPLETION_TOKENS] for b in buckets),
+                    'avg_latency': sum(b[LATENCY] for b in buckets) / requests_count,
+                    'limit': self.token_limits.get(scope, 0)
+                })
+        rows.sort(key=lambda row: row['tokens'], reverse=True)
+        return rows[:top]
+
+    def dump_state(self):
+        """
+        Выгружает корзины окна для снимка тёплого перезапуска.
+        """
+        with self.lock:
+            return [[scope, name, [list(b) for b in buckets]] for (scope, name), buckets in self.buckets.items() if buckets]
+
+    def restore_state(self, state):
+        """
+        Восстанавливает корзины окна из снимка, чтобы перезапуск не обнулял квоты.
+        """
+        now = time.time()
+        with self.lock:
+            for scope, name, buckets in state:
+                restored = deque(buckets)
+                self._expire(restored, now)
+                if restored:
+                    self.buckets[(scope, name)] = restored
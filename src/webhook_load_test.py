@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from src.latency_stats import percentile
+from src.webhook_server import WebhookServer
+
+
+def load_test(url, token, requests_count, concurrency):
+    """
+    Отправляет requests_count вебхуков с заданной параллельностью
+    и измеряет время подтверждения каждого запроса.
+    """
+    session = requests.Session()
+    session.mount(url, requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def send(i):
+        payload = {
+            'token': token,
+            'channel_id': f"user{i % 50}bot",
+            'user_id': f"user{i % 50}",
+            'user_name': f"load_user_{i % 50}",
+            'message_id': f"load-{i}-{time.time_ns()}",
+            'text': 'help'
+        }
+        started = time.perf_counter()
+        try:
+            response = session.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'}, timeout=10)
+            ok = response.status_code == 200
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, range(requests_count)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency * 1000 for latency, _ in results)
+    errors = sum(1 for _, ok in results if not ok)
+    return latencies, errors, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест приёма вебхуков")
+    parser.add_argument('--url', help="URL работающего сервера вебхуков (по умолчанию поднимается локальный сервер без Rocket.Chat)")
+    parser.add_argument('--token', default=os.getenv('WEBHOOK_TOKEN') or 'load-test-token')
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=32)
+    parser.add_argument('--handler-delay', type=float, default=0.0, help="имитация времени обработки сообщения локальным сервером, с")
+    args = parser.parse_args()
+    if args.requests < 1:
+        parser.error("-n должно быть не меньше 1")
+    if args.concurrency < 1:
+        parser.error("-c должно быть не меньше 1")
+
+    server = None
+    processed = []
+    if not args.url:
+        # Локальный сервер с обработчиком-заглушкой: измеряем только приём и очередь
+        def dispatch(message):
+            if args.handler_delay:
+                time.sleep(args.handler_delay)
+            processed.append(time.perf_counter())
+
+        server = WebhookServer(dispatch, token=args.token, host='127.0.0.1', port=0, queue_size=args.requests)
+        server.start()
+        args.url = f"http://127.0.0.1:{server.address[1]}/"
+
+    print("🚀 Нагрузочный тест вебхуков")
+    print("=" * 50)
+    print(f"URL: {args.url}")
+    print(f"Запросов: {args.requests}, параллельно: {args.concurrency}")
+
+    latencies, errors, elapsed = load_test(args.url, args.token, args.requests, args.concurrency)
+
+    print(f"\n⏱  Время подтверждения, мс: p50={percentile(latencies, 50):.1f} p95={percentile(latencies, 95):.1f} p99={percentile(latencies, 99):.1f} max={latencies[-1]:.1f}")
+    print(f"📈 Пропускная способность приёма: {args.requests / elapsed:.0f} запр./с")
+    print(f"❌ Ошибок: {errors}")
+
+    if server:
+        deadline = time.time() + 60
+        while len(processed) < server.received and time.time() < deadline:
+            time.sleep(0.05)
+        server.stop(timeout=5)
+        print(f"✅ Обработано сообщений: {len(processed)} из {server.received}, отклонено: {server.rejected}")
+
+
+if __name__ == "__main__":
+    main()
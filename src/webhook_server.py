@@ -0,0 +1,193 @@
+import hmac
+import json
+import logging
+import queue
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src.config import *
+from src.message_model import ChatMessage
+
+# Настройка логирования для данного модуля
+logger = logging.getLogger(__name__)
+
+
+def normalize_webhook_payload(payload, bot_username=None):
+    """
+    Приводит данные исходящего вебхука Rocket.Chat к виду, который возвращает
+    RocketChatBot.get_direct_messages() (запись ChatMessage с room_id и room_user).
+
+    :param payload: Словарь, полученный от Rocket.Chat.
+    :param bot_username: Имя пользователя бота (для удаления упоминания из текста).
+    :return: Запись ChatMessage.
+    """
+    room_id = payload.get('channel_id')
+    user_id = payload.get('user_id') or ''
+    username = payload.get('user_name')
+    text = payload.get('text') or ''
+
+    # ID личной комнаты в Rocket.Chat — склейка ID двух участников,
+    # поэтому содержит ID отправителя. Для упоминаний в каналах ответ уйдёт в ЛС.
+    is_direct = bool(room_id and user_id and user_id in room_id and len(room_id) > len(user_id))
+    if bot_username:
+        text = re.sub(rf'^\s*@{re.escape(bot_username)}\b[:,]?\s*', '', text) # Убираем обращение к боту
+
+    return ChatMessage(
+        id=payload.get('message_id'),
+        username=username,
+        text=text.strip(),
+        room_id=room_id if is_direct else None,
+        room_user=username or 'Unknown'
+    )
+
+
+# Многопоточный HTTP-сервер с увеличенной очередью входящих соединений
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # Значение по умолчанию (5) приводит к сбросу соединений под нагрузкой
+
+
+# HTTP-сервер приёма исходящих вебхуков Rocket.Chat
+class WebhookServer:
+    def __init__(self, dispatch, token=WEBHOOK_TOKEN, host=WEBHOOK_HOST, port=WEBHOOK_PORT,
+                 bot_username=None, queue_size=WEBHOOK_QUEUE_SIZE):
+        """
+        Конструктор класса WebhookServer.
+        Запрос подтверждается сразу после проверки токена, а сообщение
+        обрабатывается отдельным потоком, чтобы Rocket.Chat не ждал ответа LLM.
+
+        :param dispatch: Функция, принимающая нормализованное сообщение (например, MessageHandler.process_direct_message).
+        :param token: Токен исходящей интеграции Rocket.Chat (обязателен: без него кто угодно
+            мог бы писать боту от имени любого пользователя, в том числе администратора).
+        :param host: Адрес для прослушивания.
+        :param port: Порт для прослушивания.
+        :param bot_username: Имя пользователя бота.
+        :param queue_size: Максимальное количество сообщений, ожидающих обработки.
+        :raises ValueError: Если токен не задан.
+        """
+        if not token:
+            raise ValueError("Для приёма вебхуков задайте WEBHOOK_TOKEN (токен исходящей интеграции Rocket.Chat)")
+        self.dispatch = dispatch
+        self.token = token
+        self.bot_username = bot_username
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.received = 0 # Количество принятых сообщений
+        self.rejected = 0 # Количество отклонённых запросов
+        self.counters_lock = threading.Lock() # Запросы обрабатываются параллельно в потоках HTTP-сервера
+        self.httpd = _HTTPServer((host, port), self._make_handler())
+        self.threads = []
+
+    @property
+    def address(self):
+        """
+        Адрес и порт, на которых слушает сервер.
+        """
+        return self.httpd.server_address
+
+    def _make_handler(self):
+        """
+        Создаёт класс обработчика HTTP-запросов, привязанный к этому серверу.
+        """
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # Keep-alive: Rocket.Chat переиспользует соединение
+
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get('Content-Length', 0) or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    status = server.reject(400)
+                    self.close_connection = True # Тело не прочитано — соединение нельзя переиспользовать
+                else:
+                    status = server.accept(self.rfile.read(length))
+                body = b'{}' # Пустой ответ: Rocket.Chat не публикует ничего в чат
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Вебхук: {format % args}")
+
+        return Handler
+
+    def accept(self, raw_body):
+        """
+        Проверяет и ставит в очередь тело запроса вебхука.
+
+        :param raw_body: Тело HTTP-запроса.
+        :return: HTTP-код ответа.
+        """
+        try:
+            payload = json.loads(raw_body or b'{}')
+        except ValueError:
+            return self.reject(400)
+        if not isinstance(payload, dict):
+            return self.reject(400)
+
+        if not hmac.compare_digest(str(payload.get('token', '')).encode('utf-8'), self.token.encode('utf-8')):
+            logger.warning("Вебхук с неверным токеном отклонён")
+            return self.reject(403)
+
+        if payload.get('bot') or payload.get('user_name') == self.bot_username:
+            return 200 # Собственные сообщения бота не обрабатываем
+
+        try:
+            self.queue.put_nowait(normalize_webhook_payload(payload, self.bot_username))
+        except queue.Full:
+            logger.warning("Очередь вебхуков переполнена, сообщение отклонено")
+            return self.reject(503)
+        with self.counters_lock:
+            self.received += 1
+        return 200
+
+    def reject(self, status):
+        """
+        Учитывает отклонённый запрос.
+
+        :param status: HTTP-код ответа.
+        :return: Тот же HTTP-код.
+        """
+        with self.counters_lock:
+            self.rejected += 1
+        return status
+
+    def start(self):
+        """
+        Запускает HTTP-сервер и поток обработки сообщений.
+        """
+        for target, name in ((self.httpd.serve_forever, 'webhook-http'), (self._run, 'webhook-dispatch')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"Приём вебхуков запущен на {self.address[0]}:{self.address[1]}")
+
+    def stop(self, timeout=None):
+        """
+        Останавливает приём запросов и дожидается обработки принятых сообщений.
+
+        :param timeout: Максимальное время ожидания в секундах.
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.queue.put(None) # Сигнал завершения потоку обработки
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def _run(self):
+        """
+        Последовательно передаёт принятые сообщения в обработчик.
+        """
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            try:
+                self.dispatch(message)
+            except Exception as e:
+                logger.error(f"Ошибка обработки сообщения из вебхука: {e}")